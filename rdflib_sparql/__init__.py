@@ -14,6 +14,53 @@ named graphs (like RDFLib's ConjunctiveGraph)
 """
 SPARQL_DEFAULT_GRAPH_UNION = True
 
+"""
+Number of worker processes used for computing the aggregates of
+large groupings in parallel, 0 aggregates in the query process.
+The solutions are split into batches of SPARQL_AGGREGATE_BATCH_SIZE,
+less solutions than that are always aggregated in the query process.
+The workers get the query from the forked process, where processes
+are not forked (i.e. on Windows) this is ignored.
+"""
+SPARQL_AGGREGATE_PROCESSES = 0
+SPARQL_AGGREGATE_BATCH_SIZE = 10000
+
+"""
+Maximum length of the strings built by GROUP_CONCAT, longer results
+are cut off. None for no limit.
+"""
+SPARQL_GROUP_CONCAT_MAX_LENGTH = None
+
+"""
+If True, COUNT(DISTINCT ...) is estimated with a HyperLogLog sketch
+of 2**SPARQL_APPROX_COUNT_PRECISION bytes per group instead of keeping
+all distinct values. The error is about 1.6% for a precision of 12.
+Single aggregates can also be made approximate with the
+rdflib_sparql.aggregates.APPROX_COUNT_DISTINCT function.
+"""
+SPARQL_APPROX_COUNT_DISTINCT = False
+SPARQL_APPROX_COUNT_PRECISION = 12
+
+"""
+If True, and NumPy is installed, numeric filters are evaluated on
+batches of solutions with NumPy, see rdflib_sparql.vectorize
+"""
+SPARQL_VECTORIZED_FILTERS = False
+
+"""
+If True, and NumPy is installed, SUM, AVG, MIN and MAX over groups of
+only floats or only integers are computed with NumPy, see
+rdflib_sparql.vectorize
+"""
+SPARQL_VECTORIZED_AGGREGATES = False
+
+"""
+If True, queries and updates are parsed with the hand-written parser
+in rdflib_sparql.fastparser instead of the (slower) pyparsing grammar.
+Both give the same parse-trees.
+"""
+SPARQL_FAST_PARSER = False
+
 """
 Custom evaluation functions
 
@@ -25,15 +72,32 @@ PLUGIN_ENTRY_POINT = 'rdf.plugins.sparqleval'
 
 CUSTOM_EVALS = {}
 
-import rdflib_sparql.parser as parser
 import rdflib_sparql.operators as operators
 import rdflib_sparql.parserutils as parserutils
 
+# rdflib_sparql.parser is not imported here, building the pyparsing
+# grammar is slow, it is only imported for the first parse
+
+_entryPointsLoaded = False
+
+
+def loadCustomEvals():
+    """
+    Add the custom evaluation functions registered for
+    PLUGIN_ENTRY_POINT to CUSTOM_EVALS. Scanning the entry points
+    is slow, so this is done once, on the first evaluation.
+    Functions already in CUSTOM_EVALS are not replaced.
+    """
+    global _entryPointsLoaded
+    if _entryPointsLoaded:
+        return
+    _entryPointsLoaded = True
+
+    try:
+        from pkg_resources import iter_entry_points
+    except ImportError:
+        return  # TODO: log a message
 
-try:
-    from pkg_resources import iter_entry_points
-except ImportError:
-    pass  # TODO: log a message
-else:
     for ep in iter_entry_points(PLUGIN_ENTRY_POINT):
-        CUSTOM_EVALS[ep.name] = ep.load()
+        if ep.name not in CUSTOM_EVALS:
+            CUSTOM_EVALS[ep.name] = ep.load()
@@ -1,164 +1,655 @@
-from rdflib import Literal, XSD
+import hashlib
+import math
+import struct
 
+from rdflib import Literal, URIRef, XSD
+
+import rdflib_sparql
+from rdflib_sparql.compat import Mapping
 from rdflib_sparql.evalutils import _eval
+from rdflib_sparql.parserutils import CompValue
 from rdflib_sparql.operators import numeric
 from rdflib_sparql.datatypes import type_promotion
+from rdflib_sparql import vectorize
 
-from rdflib_sparql.compat import num_max,num_min
+from rdflib_sparql.compat import num_max, num_min
 
 from decimal import Decimal
 
 """
 Aggregation functions
+
+Each aggregate is an accumulator, created once per group, updated with
+step(row) for each solution of the group and finally asked to bind its
+result with finish(bindings). Only the accumulator state is kept, not
+the solutions themselves.
 """
 
 
-def _eval_rows(expr, group):
-    for row in group:
+def _scale(n, fraction):
+    """
+    scale up a number counted over a sample, keeping its type
+    """
+    if isinstance(n, float):
+        return n / fraction
+    elif isinstance(n, Decimal):
+        return n / Decimal(str(fraction))
+    try:
+        return int(round(n / float(fraction)))
+    except OverflowError:  # too large for a float
+        return int(n / Decimal(str(fraction)))
+
+
+def _add(s, n):
+    """
+    add two numbers, mixing Decimal and float gives a float
+    """
+    if type(s) == float and type(n) == Decimal:
+        return s + float(n)
+    elif type(n) == float and type(s) == Decimal:
+        return float(s) + n
+    return s + n
+
+
+def _square(n):
+    """
+    the square of n as a float, infinite if it is too large
+    """
+    try:
+        return float(n) ** 2
+    except OverflowError:
+        return float('inf')
+
+
+class Accumulator(object):
+    """
+    Base class for the aggregate accumulators
+
+    Subclasses implement update(value) for each aggregated value and
+    finish(bindings), and combine(other) to add the state of another
+    accumulator for the same aggregate, i.e. from another part of
+    the same group.
+
+    If ignore_errors is false, the first error means the aggregate
+    is not bound at all.
+    """
+
+    ignore_errors = False
+
+    def __init__(self, a):
+        self.res = a.res
+        self.expr = a.vars
+        self.distinct = bool(a.distinct)
+        self.error = False
+        if self.distinct:
+            self.seen = set()
+
+    def __getstate__(self):
+        # expressions are not picklable, only the state is needed
+        # for merging with another accumulator
+        d = self.__dict__.copy()
+        d.pop('expr', None)
+        return d
+
+    def evaluate(self, row):
+        return _eval(self.expr, row)
+
+    def step(self, row):
+        if self.error:
+            return
         try:
-            yield _eval(expr, row)
+            v = self.evaluate(row)
+            if self.distinct:
+                if v in self.seen:
+                    return
+                self.seen.add(v)
+            self.update(v)
         except:
-            pass
-
-
-def agg_Sum(a, group, bindings):
-    c = 0
-
-    dt = None
-    for x in group:
-        try:
-            e = _eval(a.vars, x)
-            n = numeric(e)
-            if dt == None:
-                dt = e.datatype
-            else:
-                dt = type_promotion(dt, e.datatype)
-
-            if type(c) == float and type(n) == Decimal:
-                c += float(n)
-            elif type(n) == float and type(c) == Decimal:
-                c = float(c) + n
-            else:
-                c += n
-        except:
-            pass  # simply dont count
-
-    bindings[a.res] = Literal(c, datatype=dt)
+            if not self.ignore_errors:
+                self.error = True
+
+    def merge(self, other):
+        """
+        Merge the state of other into this accumulator
+        """
+        if self.error:
+            return
+        if other.error:
+            self.error = True
+        elif self.distinct:
+            # values seen by both must only be counted once
+            for v in other.seen:
+                if v not in self.seen:
+                    self.seen.add(v)
+                    try:
+                        self.update(v)
+                    except:
+                        if not self.ignore_errors:
+                            self.error = True
+                            return
+        else:
+            self.combine(other)
+
+    def update(self, value):
+        raise NotImplementedError()
+
+    def combine(self, other):
+        raise NotImplementedError()
+
+    def finish(self, bindings):
+        raise NotImplementedError()
+
+    def startSample(self):
+        """
+        Called before the first step if the solutions are a sample,
+        to keep what approximate needs
+        """
+
+    def approximate(self, fraction):
+        """
+        For aggregates over a sample of the given fraction of the data,
+        return (estimate, error) - the scaled up value (None if the
+        value needs no scaling) and the half width of its 95%
+        confidence interval (None if it is not known). Returns None if
+        there is no estimate.
+        """
+        return None
+
+
+class Numeric(Accumulator):
+    """
+    Base class for Sum and Min/Max
+
+    Subclasses implement add(n) for a single number and
+    reduce(values, kind) for a list of only floats or only integers.
+    If SPARQL_VECTORIZED_AGGREGATES is set and NumPy is available,
+    runs of such numbers are collected and reduced together with
+    NumPy, other numbers (i.e. decimals) are added one by one.
+    """
+
+    def __init__(self, a):
+        Accumulator.__init__(self, a)
+        self.pending = None
+        self.kind = None
+        if rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES and \
+                vectorize.numpy is not None:
+            self.pending = []
+
+    def __getstate__(self):
+        self.flush()
+        return Accumulator.__getstate__(self)
+
+    def push(self, n):
+        if self.pending is not None:
+            kind = vectorize.numberKind(n)
+            if kind is not None:
+                if kind is not self.kind:
+                    self.flush()
+                    self.kind = kind
+                self.pending.append(n)
+                if len(self.pending) >= vectorize.BATCH_SIZE:
+                    self.flush()
+                return
+            self.flush()
+        self.add(n)
+
+    def flush(self):
+        if self.pending:
+            try:
+                self.reduce(self.pending, self.kind)
+            finally:
+                self.pending = []
+
+    def combine(self, other):
+        self.flush()
+        other.flush()
+        self.combineFlushed(other)
+
+    def add(self, n):
+        raise NotImplementedError()
+
+    def reduce(self, values, kind):
+        raise NotImplementedError()
+
+    def combineFlushed(self, other):
+        raise NotImplementedError()
+
+
+class Sum(Numeric):
+
+    ignore_errors = True  # simply dont count
+
+    def __init__(self, a):
+        Numeric.__init__(self, a)
+        self.sum = 0
+        self.sumsq = None  # for the variance of estimates from a sample
+        self.dt = None
+
+    def startSample(self):
+        self.sumsq = 0.0
+
+    def _promote(self, dt):
+        if self.dt is None:
+            self.dt = dt
+        elif dt is not None:
+            self.dt = type_promotion(self.dt, dt)
+
+    def update(self, e):
+        n = numeric(e)
+        self._promote(e.datatype)
+        self.push(n)
+
+    def add(self, n):
+        self.sum = _add(self.sum, n)
+        if self.sumsq is not None:
+            self.sumsq += _square(n)
+
+    def reduce(self, values, kind):
+        self.sum = _add(self.sum, vectorize.vectorSum(values, kind))
+        if self.sumsq is not None:
+            sq = vectorize.vectorSumSquares(values, kind)
+            if sq is None:
+                sq = sum(_square(n) for n in values)
+            self.sumsq += sq
+
+    def combineFlushed(self, other):
+        self._promote(other.dt)
+        self.sum = _add(self.sum, other.sum)
+        if self.sumsq is not None:
+            self.sumsq += other.sumsq
+
+    def finish(self, bindings):
+        self.flush()
+        bindings[self.res] = Literal(self.sum, datatype=self.dt)
+
+    def approximate(self, fraction):
+        if self.distinct:
+            return None
+        error = None
+        # no variance if the values are too large for a float
+        if self.sumsq is not None and not math.isinf(self.sumsq):
+            error = 1.96 * math.sqrt((1 - fraction) * self.sumsq) / fraction
+        return _scale(self.sum, fraction), error
+
+
+class Avg(Sum):
+
+    ignore_errors = False  # error in aggregate => no binding
+
+    def __init__(self, a):
+        Sum.__init__(self, a)
+        self.count = 0
+
+    def update(self, e):
+        Sum.update(self, e)
+        self.count += 1
+
+    def combineFlushed(self, other):
+        Sum.combineFlushed(self, other)
+        self.count += other.count
+
+    def finish(self, bindings):
+        if self.error:
+            return
+        self.flush()
+        if self.count == 0:
+            bindings[self.res] = Literal(0)
+        elif self.dt == XSD.float or self.dt == XSD.double:
+            bindings[self.res] = Literal(self.sum / self.count)
+        else:
+            bindings[self.res] = Literal(
+                Decimal(self.sum) / Decimal(self.count))
+
+    def approximate(self, fraction):
+        # the average needs no scaling, only its standard error
+        if self.distinct or self.count == 0 or self.sumsq is None or \
+                math.isinf(self.sumsq):
+            return None
+        n = self.count
+        mean = float(self.sum) / n
+        var = 0.0
+        if n > 1:
+            var = max(self.sumsq - n * mean * mean, 0.0) / (n - 1)
+        return None, 1.96 * math.sqrt(var / n * (1 - fraction))
 
 # Perhaps TODO: keep datatype for max/min?
 
 
-def agg_Min(a, group, bindings):
-    m = None
-
-    for x in group:
-        try:
-            v = numeric(_eval(a.vars, x))
-            if m is None:
-                m = v
-            else:
-                m = num_min(v, m)
-        except:
-            return  # error in aggregate => no binding
-
-    if m is not None:
-        bindings[a.res] = Literal(m)
-
-
-def agg_Max(a, group, bindings):
-    m = None
-
-    for x in group:
-        try:
-            v = numeric(_eval(a.vars, x))
-            if m is None:
-                m = v
-            else:
-                m = num_max(v, m)
-        except:
-            return  # error in aggregate => no binding
+class Extremum(Numeric):
+    """
+    Base class for Min and Max
+    """
 
-    if m is not None:
-        bindings[a.res] = Literal(m)
+    def __init__(self, a):
+        Numeric.__init__(self, a)
+        self.m = None
 
+    def update(self, v):
+        self.push(numeric(v))
 
-def agg_Count(a, group, bindings):
+    def add(self, v):
+        if self.m is None:
+            self.m = v
+        else:
+            self.m = self.compare(v, self.m)
+
+    def reduce(self, values, kind):
+        m = self.vector(values, kind)
+        if m is None:
+            for v in values:
+                self.add(v)
+        else:
+            self.add(m)
+
+    def combineFlushed(self, other):
+        if other.m is not None:
+            self.add(other.m)
+
+    def finish(self, bindings):
+        self.flush()
+        if not self.error and self.m is not None:
+            bindings[self.res] = Literal(self.m)
+
+
+class Min(Extremum):
+    compare = staticmethod(num_min)
+    vector = staticmethod(vectorize.vectorMin)
+
+
+class Max(Extremum):
+    compare = staticmethod(num_max)
+    vector = staticmethod(vectorize.vectorMax)
+
+
+class Count(Accumulator):
+
+    def __init__(self, a):
+        Accumulator.__init__(self, a)
+        self.count = 0
+
+    def evaluate(self, row):
+        if self.expr == '*':
+            return row
+        return _eval(self.expr, row)
 
-    c = 0
-    for x in group:
-        try:
-            if a.vars != '*':
-                _eval(a.vars, x)
-            c += 1
-        except:
-            return  # error in aggregate => no binding
-            # pass  # simply dont count
+    def update(self, v):
+        self.count += 1
 
-    bindings[a.res] = Literal(c)
+    def combine(self, other):
+        self.count += other.count
 
+    def finish(self, bindings):
+        if not self.error:
+            bindings[self.res] = Literal(self.count)
+
+    def approximate(self, fraction):
+        if self.distinct:
+            return None
+        return (_scale(self.count, fraction),
+                1.96 * math.sqrt((1 - fraction) * self.count) / fraction)
 
-def agg_Sample(a, group, bindings):
+
+def _hashKey(v):
+    """
+    A string for v that is the same for equal values, in any process
+    """
+    if hasattr(v, 'n3'):
+        return v.n3().encode('utf-8')
+    elif isinstance(v, Mapping):  # a solution for COUNT(DISTINCT *)
+        return repr(sorted((k.n3(), _hashKey(x)) for k, x in v.iteritems()))
+    return repr(v)
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog sketch, estimating the number of distinct values
+    added to it with 2**precision bytes of memory.
+
+    The standard error is about 1.04/sqrt(2**precision), i.e. 1.6%
+    for the default precision of 12.
+    Sketches with the same precision can be merged.
+
+    http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, v):
+        x = struct.unpack('>Q', hashlib.sha1(_hashKey(v)).digest()[:8])[0]
+        bits = 64 - self.precision
+        i = x >> bits
+        w = x & ((1 << bits) - 1)
+        rank = bits - w.bit_length() + 1  # position of the first 1 bit
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise Exception(
+                "Cannot merge HyperLogLog sketches of different precision")
+        r = self.registers
+        for i, x in enumerate(other.registers):
+            if x > r[i]:
+                r[i] = x
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum(2.0 ** -x for x in self.registers)
+        zeros = self.registers.count('\x00')
+        if e <= 2.5 * m and zeros:
+            # small range correction
+            e = m * math.log(float(m) / zeros)
+        return int(round(e))
+
+
+class ApproxCount(Count):
+    """
+    COUNT(DISTINCT ...) estimated with a HyperLogLog sketch,
+    this uses constant memory per group.
+    """
+
+    def __init__(self, a):
+        Count.__init__(self, a)
+        self.distinct = False  # no seen set
+        self.sketch = HyperLogLog(
+            rdflib_sparql.SPARQL_APPROX_COUNT_PRECISION)
+
+    def update(self, v):
+        self.sketch.add(v)
+
+    def combine(self, other):
+        self.sketch.merge(other.sketch)
+
+    def finish(self, bindings):
+        if not self.error:
+            bindings[self.res] = Literal(len(self.sketch))
+
+    def approximate(self, fraction):
+        return None  # distinct values cannot be scaled up
+
+
+class Sample(Accumulator):
+
+    def __init__(self, a):
+        Accumulator.__init__(self, a)
+        self.sample = None
+        self.sampled = False
+
+    def step(self, row):
+        if not self.sampled:
+            self.sample = _eval(self.expr, row)
+            self.sampled = True
+
+    def merge(self, other):
+        if not self.sampled and other.sampled:
+            self.sample = other.sample
+            self.sampled = True
+
+    def finish(self, bindings):
+        if self.sampled:
+            bindings[self.res] = self.sample
+
+
+class GroupConcat(Accumulator):
+    """
+    The string is built as the values come in, only the strings of the
+    values are kept (and the values themselves for DISTINCT).
+    If SPARQL_GROUP_CONCAT_MAX_LENGTH is set, the result is cut off
+    at that length and no more values are evaluated.
+    """
+
+    ignore_errors = True
+
+    def __init__(self, a):
+        Accumulator.__init__(self, a)
+        self.separator = a.separator or " "
+        self.maxLength = rdflib_sparql.SPARQL_GROUP_CONCAT_MAX_LENGTH
+        self.chunks = []
+        self.length = 0
+        self.truncated = False
+        if self.distinct:
+            self.values = []  # in order, for merging
+
+    def step(self, row):
+        if not self.truncated:
+            Accumulator.step(self, row)
+
+    def update(self, v):
+        if self.distinct:
+            self.values.append(v)
+        self.append(unicode(v))
+
+    def append(self, s):
+        if self.truncated:
+            return
+        if self.chunks:
+            s = self.separator + s
+        if self.maxLength is not None and \
+                self.length + len(s) >= self.maxLength:
+            s = s[:self.maxLength - self.length]
+            self.truncated = True
+        self.chunks.append(s)
+        self.length += len(s)
+
+    def merge(self, other):
+        # keep the order of the values
+        if self.distinct:
+            for v in other.values:
+                if v not in self.seen:
+                    self.seen.add(v)
+                    self.update(v)
+        elif other.chunks:
+            self.append(u"".join(other.chunks))
+            self.truncated = self.truncated or other.truncated
+
+    def finish(self, bindings):
+        bindings[self.res] = Literal(u"".join(self.chunks))
+
+
+ACCUMULATORS = {
+    'Aggregate_Count': Count,
+    'Aggregate_Sum': Sum,
+    'Aggregate_Sample': Sample,
+    'Aggregate_GroupConcat': GroupConcat,
+    'Aggregate_Avg': Avg,
+    'Aggregate_Min': Min,
+    'Aggregate_Max': Max,
+}
+
+
+def accumulator(a, sampled=False):
+    """
+    Create a new accumulator for the aggregate a, sampled tells
+    if the solutions are a sample (see Accumulator.approximate)
+    """
     try:
-        bindings[a.res] = _eval(a.vars, iter(group).next())
-    except StopIteration:
-        pass  # no res
-
-
-def agg_GroupConcat(a, group, bindings):
+        cls = ACCUMULATORS[a.name]
+    except KeyError:
+        raise Exception("Unknown aggregate function " + a.name)
+    if cls is Count and a.distinct and (
+            a.approximate or rdflib_sparql.SPARQL_APPROX_COUNT_DISTINCT):
+        cls = ApproxCount
+    acc = cls(a)
+    if sampled:
+        acc.startSample()
+    return acc
 
-    sep = a.separator or " "
 
-    bindings[a.res] = Literal(
-        sep.join(unicode(x) for x in _eval_rows(a.vars, group)))
+APPROX_COUNT_DISTINCT = URIRef(
+    'http://rdflib.net/sparql/aggregate#approxCountDistinct')
 
 
-def agg_Avg(a, group, bindings):
+def approxCountDistinct(e):
+    """
+    Replace a call of the approxCountDistinct function with an
+    approximate COUNT(DISTINCT ...) aggregate
+    """
+    if len(e.expr) != 1:
+        raise Exception(
+            "%s takes exactly one argument" % APPROX_COUNT_DISTINCT)
+    return CompValue('Aggregate_Count', vars=e.expr[0],
+                     distinct='DISTINCT', approximate=True)
 
-    c = 0
-    s = 0
-    dt = None
-    for x in group:
-        try:
-            e = _eval(a.vars, x)
-            n = numeric(e)
-            if dt == None:
-                dt = e.datatype
-            else:
-                dt = type_promotion(dt, e.datatype)
 
-            if type(s) == float and type(n) == Decimal:
-                s += float(n)
-            elif type(n) == float and type(s) == Decimal:
-                s = float(s) + n
+"""
+Custom aggregate functions, used as iri(args) in queries and
+replaced with an aggregate when the query is translated
+"""
+CUSTOM_AGGREGATES = {
+    APPROX_COUNT_DISTINCT: approxCountDistinct
+}
+
+
+class Aggregator(object):
+    """
+    The accumulators of all aggregates for one group
+    """
+
+    def __init__(self, aggregates, sampled=False):
+        self.accumulators = [accumulator(a, sampled) for a in aggregates]
+
+    def step(self, row):
+        for acc in self.accumulators:
+            acc.step(row)
+
+    def merge(self, other):
+        """
+        Merge the state of the aggregator for another part of the group
+        """
+        for acc, o in zip(self.accumulators, other.accumulators):
+            acc.merge(o)
+
+    def finish(self, sampling=None):
+        """
+        Return the bindings for all aggregates, if the solutions were
+        a sample (see rdflib_sparql.sparql.Sampling) the estimates
+        for the whole data are returned
+        """
+        bindings = {}
+        for acc in self.accumulators:
+            acc.finish(bindings)
+            if sampling is None or acc.res not in bindings:
+                continue
+            est = acc.approximate(sampling.fraction)
+            if est is None:
+                continue
+            value, error = est
+            if value is not None:
+                bindings[acc.res] = Literal(
+                    value, datatype=bindings[acc.res].datatype)
             else:
-                s += n
-            c += 1
-        except:
-            return  # error in aggregate => no binding
-
-    if c == 0:
-        bindings[a.res] = Literal(0)
-    if dt == XSD.float or dt == XSD.double:
-        bindings[a.res] = Literal(s / c)
-    else:
-        bindings[a.res] = Literal(Decimal(s) / Decimal(c))
+                value = bindings[acc.res].toPython()
+            if error is not None:
+                sampling.estimate(bindings[acc.res],
+                                  float(value) - error, float(value) + error)
+        return bindings
 
 
 def evalAgg(a, group, bindings):
-    if a.name == 'Aggregate_Count':
-        return agg_Count(a, group, bindings)
-    elif a.name == 'Aggregate_Sum':
-        return agg_Sum(a, group, bindings)
-    elif a.name == 'Aggregate_Sample':
-        return agg_Sample(a, group, bindings)
-    elif a.name == 'Aggregate_GroupConcat':
-        return agg_GroupConcat(a, group, bindings)
-    elif a.name == 'Aggregate_Avg':
-        return agg_Avg(a, group, bindings)
-    elif a.name == 'Aggregate_Min':
-        return agg_Min(a, group, bindings)
-    elif a.name == 'Aggregate_Max':
-        return agg_Max(a, group, bindings)
-
-    else:
-        raise Exception("Unknown aggregate function " + a.name)
+    acc = accumulator(a)
+    for row in group:
+        acc.step(row)
+    acc.finish(bindings)
@@ -8,15 +8,17 @@ http://www.w3.org/TR/sparql11-query/#sparqlQuery
 
 import functools
 import collections
+import itertools
 
 from rdflib import Literal, Variable, URIRef, BNode
 
 from rdflib_sparql.sparql import Prologue, Query
-from rdflib_sparql.parserutils import CompValue, Expr
-from rdflib_sparql.operators import (
-    and_, TrueFilter, simplify as simplifyFilters)
+from rdflib_sparql.parserutils import (
+    CompValue, Expr, SlotValue, slotValue)
+from rdflib_sparql.operators import and_, TrueFilter
 from rdflib_sparql.paths import (
     InvPath, AlternativePath, SequencePath, ModPath, NegatedPath)
+from rdflib_sparql.aggregates import CUSTOM_AGGREGATES
 
 from pyparsing import ParseResults
 
@@ -67,8 +69,12 @@ def Project(p, PV):
     return CompValue('Project', p=p, PV=PV)
 
 
-def Group(p, expr=None):
-    return CompValue('Group', p=p, expr=expr)
+def Group(p, expr=None, sorted=False):
+    """
+    sorted means the solutions of p are already ordered on expr,
+    the groups can then be aggregated one after the other
+    """
+    return CompValue('Group', p=p, expr=expr, sorted=sorted)
 
 
 def _knownterms(triple):
@@ -77,7 +83,7 @@ def _knownterms(triple):
 
 
 def triples(l):
-    l = reduce(lambda x, y: x + y, l)
+    l = list(itertools.chain.from_iterable(l))
     if (len(l) % 3) != 0:
         # import pdb ; pdb.set_trace()
         raise Exception('these aint triples')
@@ -85,20 +91,121 @@ def triples(l):
                    for x in range(0, len(l), 3)], key=_knownterms)
 
 
-def translatePName(p, prologue):
+def translatePName(p, prologue, terms=None):
     """
     Expand prefixed/relative URIs
+
+    terms caches the already translated prefixed names and literals,
+    so that equal ones are translated into the same object
     """
     if isinstance(p, CompValue):
         if p.name == 'pname':
-            return prologue.absolutize(p)
+            if terms is None:
+                return prologue.absolutize(p)
+            key = (p.prefix, p.localname)
+            try:
+                return terms[key]
+            except KeyError:
+                t = terms[key] = prologue.absolutize(p)
+                return t
         if p.name == 'literal':
-            return Literal(p.string, lang=p.lang,
-                           datatype=prologue.absolutize(p.datatype))
+            datatype = translatePName(p.datatype, prologue, terms)
+            if terms is None:
+                return Literal(p.string, lang=p.lang, datatype=datatype)
+            key = (p.string, p.lang, datatype)
+            try:
+                return terms[key]
+            except KeyError:
+                t = terms[key] = Literal(
+                    p.string, lang=p.lang, datatype=datatype)
+                return t
     elif isinstance(p, URIRef):
         return prologue.absolutize(p)
 
 
+def _translateTerms(terms, prologue, cache):
+    """
+    Expand the prefixed names in a flat list of terms,
+    cache is passed on to translatePName
+    """
+    res = []
+    for t in terms:
+        if isinstance(t, CompValue):
+            t = translatePName(t, prologue, cache)
+        elif isinstance(t, (list, ParseResults)):
+            t = _translateTerms(t, prologue, cache)
+        elif isinstance(t, URIRef):
+            t = prologue.absolutize(t)
+        res.append(t)
+    return res
+
+
+def _translateData(e, prologue, terms=None):
+    """
+    Expand the prefixed names in ground data: the Quads of
+    INSERT/DELETE DATA and the values of VALUES blocks.
+
+    These hold nothing but (lists of) terms, so they are done in one
+    flat loop rather than with the generic traversals, which are slow for
+    large requests.
+    """
+    if not isinstance(e, CompValue):
+        return None
+    if terms is None:
+        terms = {}
+
+    if e.name == 'Quads':
+        if e.triples:
+            e['triples'] = [_translateTerms(t, prologue, terms)
+                            for t in e.triples]
+        if e.quadsNotTriples:
+            for q in e.quadsNotTriples:
+                q['term'] = _translateTerms([q.term], prologue, terms)[0]
+                if q.triples:
+                    q['triples'] = [_translateTerms(t, prologue, terms)
+                                    for t in q.triples]
+        return e
+
+    if e.name in ('InlineData', 'ValuesClause'):
+        if e.value:
+            e['value'] = _translateTerms(e.value, prologue, terms)
+        return e
+
+
+def _translateNode(e, prologue, terms=None):
+    """
+    The translations of the parse-tree done before the algebra is
+    built, for one node whose children are already translated:
+    prefixed names, filter expressions, custom aggregates and
+    property paths
+    """
+    _e = translatePName(e, prologue, terms)
+    if _e is not None:
+        return _e
+    if isinstance(e, Expr):
+        # see rdflib_sparql.operators.simplify
+        if e.name.endswith('Expression') and e.other is None:
+            return e.expr
+    _e = _customAggregate(e)
+    if _e is not None:
+        return _e
+    return translatePath(e)
+
+
+def translateParseTree(tree, prologue):
+    """
+    Translate the prefixed names, filter expressions, custom
+    aggregates and property paths of a query or update parse-tree
+    in a single traversal
+    """
+    terms = {}
+    return traverse(
+        tree, visitPre=functools.partial(
+            _translateData, prologue=prologue, terms=terms),
+        visitPost=functools.partial(
+            _translateNode, prologue=prologue, terms=terms))
+
+
 def translatePath(p):
 
     """
@@ -138,6 +245,9 @@ def translatePath(p):
             else:
                 return InvPath(p.part)
 
+        elif p.name == 'InversePath':
+            return InvPath(p.part)
+
         elif p.name == 'PathNegatedPropertySet':
             if isinstance(p.part, list):
                 return NegatedPath(AlternativePath(*p.part))
@@ -190,15 +300,16 @@ def collectAndRemoveFilters(parts):
 
 
 def translateGroupOrUnionGraphPattern(graphPattern):
-    A = None
+    A = [translateGroupGraphPattern(g) for g in graphPattern.graph]
+    if not A:
+        return None
 
-    for g in graphPattern.graph:
-        g = translateGroupGraphPattern(g)
-        if not A:
-            A = g
-        else:
-            A = Union(A, g)
-    return A
+    # a balanced tree of unions (in the same order), so that thousands
+    # of them do not need deep recursion to evaluate
+    while len(A) > 1:
+        A = [Union(A[i], A[i + 1]) if i + 1 < len(A) else A[i]
+             for i in range(0, len(A), 2)]
+    return A[0]
 
 
 def translateGraphGraphPattern(graphPattern):
@@ -277,28 +388,60 @@ def _traverse(e, visitPre=lambda n: None, visitPost=lambda n: None):
     Traverse a parse-tree, visit each node
 
     if visit functions return a value, replace current node
-    """
-    _e = visitPre(e)
-    if _e is not None:
-        return _e
 
-    if e is None:
-        return None
-
-    if isinstance(e, (list, ParseResults)):
-        return [_traverse(x, visitPre, visitPost) for x in e]
-    elif isinstance(e, tuple):
-        return tuple([_traverse(x, visitPre, visitPost) for x in e])
-
-    elif isinstance(e, CompValue):
-        for k, val in e.iteritems():
-            e[k] = _traverse(val, visitPre, visitPost)
-
-    _e = visitPost(e)
-    if _e is not None:
-        return _e
-
-    return e
+    This keeps its own stack rather than recursing, so that very deep
+    trees (i.e. thousands of UNIONs) can be traversed
+    """
+    # a frame is [node, keys of a CompValue or None, new children]
+    stack = []
+    while True:
+        # visit e, if it has children push it
+        pushed = False
+        _e = visitPre(e)
+        if _e is not None:
+            e = _e
+        elif isinstance(e, (CompValue, SlotValue)):
+            stack.append((e, e.keys(), []))
+            pushed = True
+        elif isinstance(e, (list, ParseResults, tuple)):
+            stack.append((e, None, []))
+            pushed = True
+        elif e is not None:
+            _e = visitPost(e)
+            if _e is not None:
+                e = _e
+
+        # hand e to its parent, finishing all nodes without more
+        # children, until there is a child to visit
+        while stack:
+            node, keys, res = stack[-1]
+            if pushed:
+                pushed = False
+            else:
+                if isinstance(node, SlotValue):
+                    setattr(node, keys[len(res)], e)
+                elif keys is not None:
+                    dict.__setitem__(node, keys[len(res)], e)
+                res.append(e)
+
+            if keys is not None:
+                if len(res) < len(keys):
+                    if isinstance(node, SlotValue):
+                        e = getattr(node, keys[len(res)])
+                    else:
+                        e = dict.__getitem__(node, keys[len(res)])
+                    break
+                stack.pop()
+                _e = visitPost(node)
+                e = node if _e is None else _e
+            else:
+                if len(res) < len(node):
+                    e = node[len(res)]
+                    break
+                stack.pop()
+                e = tuple(res) if isinstance(node, tuple) else res
+        else:
+            return e
 
 
 def traverse(
@@ -319,6 +462,91 @@ def traverse(
         return st.rv
 
 
+def _slotParts(n):
+    """
+    The parameters, other attributes and values of the CompValue n,
+    parameters the translator set as attributes take their value
+    """
+    attrs = vars(n)
+    fields = tuple(n.iterkeys())
+    extra = tuple(sorted(
+        k for k in attrs if k not in fields and k not in ('name', '_evalfn')
+        and not k.startswith('_OrderedDict')))
+    values = [attrs[k] if k in attrs else dict.__getitem__(n, k)
+              for k in fields]
+    values += [attrs[k] for k in extra]
+    return fields, extra, values
+
+
+def toSlotValues(tree):
+    """
+    Replace the CompValues and Exprs of a translated tree with
+    SlotValues and SlotExprs, the last pass of the translation
+
+    Nodes used in several places are replaced with one SlotValue,
+    lists are changed in place. Like traverse this keeps its own
+    stack, rather than recursing.
+    """
+    done = {}
+    # a frame is [node, parts of a CompValue or None, new children]
+    stack = []
+    e = tree
+    while True:
+        pushed = False
+        if id(e) in done:
+            e = done[id(e)]
+        elif isinstance(e, CompValue):
+            parts = _slotParts(e)
+            stack.append((e, parts, []))
+            pushed = True
+        elif isinstance(e, (list, ParseResults, tuple)):
+            stack.append((e, None, []))
+            pushed = True
+
+        while stack:
+            node, parts, res = stack[-1]
+            if pushed:
+                pushed = False
+            else:
+                res.append(e)
+
+            children = parts[2] if parts is not None else node
+            if len(res) < len(children):
+                e = children[len(res)]
+                break
+            stack.pop()
+            if parts is not None:
+                evalfn = node._evalfn.im_func \
+                    if isinstance(node, Expr) and node._evalfn else None
+                e = slotValue(node.name, parts[0], parts[1], res, evalfn)
+            elif isinstance(node, tuple):
+                e = node if all(x is y for x, y in zip(res, node)) \
+                    else tuple(res)
+            else:
+                for i, x in enumerate(res):
+                    node[i] = x
+                e = node
+            done[id(node)] = e
+        else:
+            return e
+
+
+def _sortedOn(p, exprs):
+    """
+    Return True if solutions of p that agree on all exprs are adjacent,
+    i.e. p is ordered by exactly the exprs first, in any order
+    """
+    while p.name in ('ToMultiSet', 'Project', 'Slice', 'Distinct',
+                     'Reduced', 'Filter', 'Extend'):
+        if p.name == 'Extend' and p.var in exprs:
+            return False
+        p = p.p
+    if p.name != 'OrderBy' or len(p.expr) < len(exprs):
+        return False
+    return all(c.expr in exprs for c in p.expr[:len(exprs)]) and \
+        all(e in [c.expr for c in p.expr[:len(exprs)]] for e in exprs)
+
+
 def _hasAggregate(x):
     """
     Traverse parse(sub)Tree
@@ -339,12 +567,26 @@ def _aggs(e, A):
     # TODO: nested Aggregates?
 
     if isinstance(e, CompValue) and e.name.startswith('Aggregate_'):
+        # the same aggregate used again is only computed once
+        key = _aggKey(e)
+        if key is not None:
+            for a in A:
+                if _aggKey(a) == key:
+                    return a.res
+
         A.append(e)
         aggvar = Variable('__agg_%d__' % len(A))
         e["res"] = aggvar
         return aggvar
 
 
+def _aggKey(a):
+    key = _exprKey(a.vars)
+    if key is None:
+        return None
+    return (a.name, key, bool(a.distinct), a.separator, bool(a.approximate))
+
+
 def _findVars(x, res):
     """
     Find all variables in a tree
@@ -361,6 +603,15 @@ def _findVars(x, res):
             return x
 
 
+def _customAggregate(e):
+    """
+    Replace calls of custom aggregate functions with the aggregate
+    """
+    if isinstance(e, CompValue) and e.name == 'Function' and \
+            e.iri in CUSTOM_AGGREGATES:
+        return CUSTOM_AGGREGATES[e.iri](e)
+
+
 def _sample(e, v=None):
     """
     For each unaggregated variable V in expr
@@ -372,12 +623,11 @@ def _sample(e, v=None):
         return CompValue('Aggregate_Sample', vars=e)
 
 
-def _simplifyFilters(e):
-    if isinstance(e, Expr):
-        return simplifyFilters(e)
-
-
-def translateAggregates(q, M):
+def translateAggregates(q, M, havingAggregate, orderAggregate):
+    """
+    havingAggregate and orderAggregate tell if there are aggregates
+    in the HAVING and ORDER BY clauses
+    """
     E = []
     A = []
 
@@ -394,12 +644,12 @@ def translateAggregates(q, M):
         q.expr = es
 
     # having clause
-    if traverse(q.having, _hasAggregate, complete=False):
+    if havingAggregate:
         q.having = traverse(q.having, _sample)
         traverse(q.having, functools.partial(_aggs, A=A))
 
     # order by
-    if traverse(q.orderby, _hasAggregate, complete=False):
+    if orderAggregate:
         q.orderby = traverse(q.orderby, _sample)
         traverse(q.orderby, functools.partial(_aggs, A=A))
 
@@ -440,18 +690,20 @@ def translate(q):
 
     """
 
-    # import pdb; pdb.set_trace()
-    _traverse(q, _simplifyFilters)
-
-    q.where = traverse(q.where, visitPost=translatePath)
+    # the parse-tree is already translated by translateParseTree
 
     # TODO: Var scope test
     VS = set()
-    traverse(q.where, functools.partial(_findVars, res=VS))
+    if not q.var and not q.expr:
+        # select *
+        traverse(q.where, functools.partial(_findVars, res=VS))
 
     # all query types have a where part
     M = translateGroupGraphPattern(q.where)
 
+    havingAggregate = traverse(q.having, _hasAggregate, complete=False)
+    orderAggregate = traverse(q.orderby, _hasAggregate, complete=False)
+
     aggregate = False
     if q.groupby:
         conditions = []
@@ -464,8 +716,7 @@ def translate(q):
 
         M = Group(p=M, expr=conditions)
         aggregate = True
-    elif traverse(q.having, _hasAggregate, complete=False) or \
-            traverse(q.orderby, _hasAggregate, complete=False) or \
+    elif havingAggregate or orderAggregate or \
             any(traverse(x, _hasAggregate, complete=False)
                 for x in q.expr or []):
         # if any aggregate is used, implicit group by
@@ -473,7 +724,7 @@ def translate(q):
         aggregate = True
 
     if aggregate:
-        M, E = translateAggregates(q, M)
+        M, E = translateAggregates(q, M, havingAggregate, orderAggregate)
     else:
         E = []
 
@@ -541,9 +792,168 @@ def simplify(n):
             return n.p1
 
 
+def sortedGroups(n):
+    """Mark groups over solutions already ordered on the group keys"""
+    if isinstance(n, CompValue) and n.name == 'Group' and n.expr:
+        n.sorted = n.sorted or _sortedOn(n.p, n.expr)
+
+
+def _simplifyAlgebra(n):
+    """simplify and sortedGroups in one traversal"""
+    _n = simplify(n)
+    if _n is None:
+        sortedGroups(n)
+    return _n
+
+
+# expressions that must be evaluated every time they are used
+_VOLATILE = frozenset(['Builtin_RAND', 'Builtin_BNODE', 'Builtin_UUID',
+                       'Builtin_STRUUID', 'Builtin_EXISTS',
+                       'Builtin_NOTEXISTS'])
+
+
+class _Volatile(Exception):
+    pass
+
+
+def _key(e):
+    if isinstance(e, CompValue):
+        if e.name in _VOLATILE:
+            raise _Volatile()
+        return (e.name,) + tuple((k, _key(v)) for k, v in e.iteritems())
+    elif isinstance(e, (list, tuple, ParseResults)):
+        return tuple(_key(x) for x in e)
+    elif hasattr(e, 'n3'):
+        # Literal("1") and Literal("01") are ==, but not the same
+        return (type(e), e.n3())
+    return e
+
+
+def _exprKey(e):
+    """
+    A key equal for equal expressions,
+    None if the expression must not be shared
+    """
+    try:
+        return _key(e)
+    except _Volatile:
+        return None
+
+
+def _subexpressions(e):
+    """
+    The keys and expressions of e and all expressions in e
+    """
+    if isinstance(e, Expr):
+        key = _exprKey(e)
+        if key is not None:
+            yield key, e
+        if e.name in _VOLATILE:
+            return
+    if isinstance(e, CompValue):
+        e = e.values()
+    if isinstance(e, (list, ParseResults)):
+        for x in e:
+            for y in _subexpressions(x):
+                yield y
+
+
+def _replaceExprs(e, lookup):
+    """
+    Replace expressions in e with the variable lookup(key, expr)
+    returns for them, outer expressions first
+    """
+    if isinstance(e, Expr):
+        key = _exprKey(e)
+        if key is not None:
+            var = lookup(key, e)
+            if var is not None:
+                return var
+        if e.name in _VOLATILE:
+            return e
+    if isinstance(e, CompValue):
+        for k, x in e.iteritems():
+            e[k] = _replaceExprs(x, lookup)
+    elif isinstance(e, (list, ParseResults)):
+        for i, x in enumerate(e):
+            e[i] = _replaceExprs(x, lookup)
+    return e
+
+
+def _boundExprs(p):
+    """
+    The expressions bound to a variable by the Extends just below
+    a Filter, Extend or OrderBy
+    """
+    bound = {}
+    while p.name in ('Extend', 'Filter'):
+        if p.name == 'Extend' and isinstance(p.expr, Expr):
+            key = _exprKey(p.expr)
+            if key is not None:
+                bound.setdefault(key, p.var)
+        p = p.p
+    return bound
+
+
+def commonExpressions(n, names):
+    """
+    Evaluate each expression in a FILTER, BIND or ORDER BY only once
+    per solution
+
+    Expressions already bound to a variable by a BIND (or select
+    expression) below are replaced with the variable. Expressions used
+    more than once are bound to a new variable, taken from names,
+    with an Extend and replaced with that.
+    """
+    if not isinstance(n, CompValue) or not isinstance(n.p, CompValue):
+        return  # not an algebra node
+    if n.name in ('Filter', 'Extend'):
+        holders = [n]
+    elif n.name == 'OrderBy':
+        holders = n.expr
+    else:
+        return
+
+    bound = _boundExprs(n.p)
+    counts = collections.defaultdict(int)
+    for h in holders:
+        for key, e in _subexpressions(h.expr):
+            counts[key] += 1
+
+    def share(key, e):
+        if key in bound:
+            return bound[key]
+        if counts[key] < 2:
+            return None
+        var = Variable('__cse_%d__' % next(names))
+        n['p'] = Extend(n.p, _replaceExprs(e, lambda k, x: bound.get(k)),
+                        var)
+        bound[key] = var
+        return var
+
+    for h in holders:
+        h['expr'] = _replaceExprs(h.expr, share)
+
+
+# the prologues of the PREFIX and BASE declarations seen before,
+# queries with the same declarations share their prefix map
+_prologues = {}
+MAX_PROLOGUES = 1000
+
+
 def translatePrologue(p, base, initNs=None, prologue=None):
 
+    key = None
     if prologue is None:
+        try:
+            key = (base, frozenset(initNs.iteritems()) if initNs else None,
+                   tuple((x.name, x.prefix, x.iri) for x in p))
+            cached = _prologues.get(key)
+        except TypeError:  # unhashable initNs
+            key = cached = None
+        if cached is not None:
+            return cached.copy()
+
         prologue = Prologue()
         prologue.base = ""
     if base:
@@ -558,6 +968,11 @@ def translatePrologue(p, base, initNs=None, prologue=None):
         elif x.name == 'PrefixDecl':
             prologue.bind(x.prefix, prologue.absolutize(x.iri))
 
+    if key is not None:
+        if len(_prologues) >= MAX_PROLOGUES:
+            _prologues.clear()
+        _prologues[key] = prologue.copy()
+
     return prologue
 
 
@@ -603,26 +1018,27 @@ def translateUpdate1(u, prologue):
     return u
 
 
-def translateUpdate(q, base=None, initNs=None):
+def translateUpdate(q, base=None, initNs=None, prologue=None):
     """
     Returns a list of SPARQL Update Algebra expressions
+
+    If the request is translated in parts, prologue is that of the
+    operations before
     """
 
     res = []
-    prologue = None
     if not q.request:
         return res
     for p, u in zip(q.prologue, q.request):
         prologue = translatePrologue(p, base, initNs, prologue)
 
-        # absolutize/resolve prefixes
-        u = traverse(
-            u, visitPost=functools.partial(translatePName, prologue=prologue))
-        u = _traverse(u, _simplifyFilters)
-
-        u = traverse(u, visitPost=translatePath)
+        if u.name in ('InsertData', 'DeleteData'):
+            # ground data only, no filters or paths
+            _translateData(u.quads, prologue)
+        else:
+            u = translateParseTree(u, prologue)
 
-        res.append(translateUpdate1(u, prologue))
+        res.append(toSlotValues(translateUpdate1(u, prologue)))
 
     return res
 
@@ -638,9 +1054,7 @@ def translateQuery(q, base=None, initNs=None):
 
     prologue = translatePrologue(q[0], base, initNs)
 
-    # absolutize/resolve prefixes
-    q[1] = traverse(
-        q[1], visitPost=functools.partial(translatePName, prologue=prologue))
+    q[1] = translateParseTree(q[1], prologue)
 
     P, PV = translate(q[1])
     datasetClause = q[1].datasetClause
@@ -654,9 +1068,11 @@ def translateQuery(q, base=None, initNs=None):
     else:
         res = CompValue(q[1].name, p=P, datasetClause=datasetClause, PV=PV)
 
-    res = traverse(res, visitPost=simplify)
+    res = traverse(res, visitPost=_simplifyAlgebra)
+    traverse(res, visitPost=functools.partial(
+        commonExpressions, names=itertools.count(1)))
 
-    return Query(prologue, res)
+    return Query(prologue, toSlotValues(res))
 
 
 def pprintAlgebra(q):
@@ -666,7 +1082,7 @@ def pprintAlgebra(q):
         #     for x in p: pp(x,ind)
         #     print "%s ]"%ind
         #     return
-        if not isinstance(p, CompValue):
+        if not isinstance(p, (CompValue, SlotValue)):
             print p
             return
         print "%s(" % (p.name, )
@@ -14,25 +14,90 @@ also return a dict of list of dicts
 
 """
 
+import sys
+import itertools
 import collections
+import multiprocessing
 
-from rdflib import Variable, Graph, BNode, URIRef, Literal
+from rdflib import Variable, Graph, ConjunctiveGraph, BNode, URIRef, Literal
 
+import rdflib_sparql
 from rdflib_sparql import CUSTOM_EVALS
+from rdflib_sparql.compat import OrderedDict
 from rdflib_sparql.parserutils import value
 from rdflib_sparql.sparql import (
-    QueryContext, AlreadyBound, FrozenBindings, SPARQLError)
+    QueryContext, AlreadyBound, FrozenBindings, SPARQLError, Sampling)
 from rdflib_sparql.evalutils import (
-    _filter, _eval, _join, _diff, _minus, _fillTemplate)
+    _filter, _eval, _join, _diff, _minus, _fillTemplate, _batches)
 
-from rdflib_sparql.aggregates import evalAgg
+from rdflib_sparql.aggregates import Aggregator
+from rdflib_sparql.paths import Path, evalPathMany, tripleCount
+from rdflib_sparql.vectorize import compileFilter, vectorFilter
 
 
 def evalBGP(ctx, bgp):
 
     """
     A basic graph pattern
+
+    Property paths that are not the first triple pattern are
+    evaluated once for all solutions of the patterns before them,
+    instead of once per solution.
+    """
+
+    for i in range(len(bgp) - 1, 0, -1):
+        if isinstance(bgp[i][1], Path):
+            res = []
+            for c in _evalPathPattern(ctx, evalBGP(ctx, bgp[:i]), bgp[i]):
+                ctx.push()
+                try:
+                    ctx.bindings.update(c)
+                    res += _evalBGP(ctx, bgp[i + 1:])
+                finally:
+                    ctx.pop()
+            return res
+
+    return _evalBGP(ctx, bgp)
+
+
+def _evalPathPattern(ctx, solutions, triple):
     """
+    Join the given solutions with a single property path pattern,
+    the path is evaluated from all bound subjects in one go
+    """
+
+    s, path, o = triple
+
+    starts = set(c.get(s) for c in solutions)
+    if None in starts:
+        # subject is not always bound, no batching possible
+        res = []
+        for c in solutions:
+            ctx.push()
+            try:
+                ctx.bindings.update(c)
+                res += _evalBGP(ctx, [triple])
+            finally:
+                ctx.pop()
+        return res
+
+    obj = o if not isinstance(o, (Variable, BNode)) else None
+    reached = collections.defaultdict(list)
+    for x, y in evalPathMany(ctx.graph, starts, path, obj):
+        reached[x].append(y)
+
+    res = []
+    for c in solutions:
+        _o = c.get(o)
+        for y in reached.get(c.get(s), ()):
+            if _o is None:
+                res.append(c.merge({o: y}))
+            elif _o == y:
+                res.append(c)
+    return res
+
+
+def _evalBGP(ctx, bgp):
 
     if not bgp:
         return [ctx.solution()]
@@ -44,7 +109,11 @@ def evalBGP(ctx, bgp):
     _p = ctx[p]
     _o = ctx[o]
 
-    for ss, sp, so in ctx.graph.triples((_s, _p, _o)):
+    triples = ctx.graph.triples((_s, _p, _o))
+    if ctx.sampling is not None:
+        triples = ctx.sampling.sample(bgp[0], triples)
+
+    for ss, sp, so in triples:
         try:
             if None in (_s, _p, _o):
                 ctx.push()
@@ -64,7 +133,7 @@ def evalBGP(ctx, bgp):
             except AlreadyBound:
                 continue
 
-            res += evalBGP(ctx, bgp[1:])
+            res += _evalBGP(ctx, bgp[1:])
 
         finally:
             if None in (_s, _p, _o):
@@ -130,6 +199,11 @@ def evalFilter(ctx, part):
 
     # TODO: Deal with dict returned from evalPart!
 
+    if rdflib_sparql.SPARQL_VECTORIZED_FILTERS:
+        f = compileFilter(part.expr)
+        if f is not None:
+            return vectorFilter(evalPart(ctx, part.p), part.expr, f)
+
     return _filter(evalPart(ctx, part.p), part.expr)
 
 
@@ -254,24 +328,231 @@ def evalGroup(ctx, group):
         return res
 
 
+def _aggregate(aggregates, exprs, solutions, sampled=False):
+    """
+    Group the solutions and compute the aggregates,
+    returns a dict of group key to Aggregator
+    """
+    groups = {}
+    if not exprs:
+        # no GROUP BY, everything is one group
+        groups[1] = Aggregator(aggregates, sampled)
+        for c in solutions:
+            groups[1].step(c)
+    else:
+        for c in solutions:
+            k = tuple(_eval(e, c) for e in exprs)
+            try:
+                aggregator = groups[k]
+            except KeyError:
+                aggregator = groups[k] = Aggregator(aggregates, sampled)
+            aggregator.step(c)
+    return groups
+
+
+def _tied(k1, k2):
+    """
+    True if ORDER BY may put solutions with the group keys k1 and k2
+    in any order
+    """
+    for a, b in zip(k1, k2):
+        a, b = _orderKey(a), _orderKey(b)
+        if a < b or b < a:
+            return False
+    return True
+
+
+def _aggregateSorted(aggregates, exprs, solutions, sampled=False):
+    """
+    Group solutions that arrive ordered on the group keys,
+    yields the Aggregator for each group as soon as the key changes
+
+    Different keys that ORDER BY does not tell apart (i.e. "x" and
+    "x"^^xsd:string) may come interleaved, the groups of such a run of
+    keys are all yielded at its end.
+    """
+    run = OrderedDict()
+    key = aggregator = None
+    for c in solutions:
+        k = tuple(_eval(e, c) for e in exprs)
+        if aggregator is None or k != key:
+            aggregator = run.get(k)
+            if aggregator is None:
+                if not any(_tied(k, r) for r in run):
+                    for a in run.itervalues():
+                        yield a
+                    run = OrderedDict()
+                aggregator = run[k] = Aggregator(aggregates, sampled)
+            key = k
+        aggregator.step(c)
+    for a in run.itervalues():
+        yield a
+
+
+_partition = None
+
+
+def _forking():
+    """
+    True if worker processes are forked, only then they get the
+    aggregates and the context without pickling them
+    """
+    try:
+        return multiprocessing.get_start_method() == 'fork'
+    except AttributeError:  # python 2 forks, except on windows
+        return sys.platform != 'win32'
+
+
+def _initPartition(ctx, aggregates, exprs):
+    # runs in the forked worker, nothing here is pickled
+    global _partition
+    _partition = (ctx, aggregates, exprs)
+
+
+def _aggregateBatch(batch):
+    """
+    Partial aggregation of a batch of solutions in a worker process
+    """
+    ctx, aggregates, exprs = _partition
+    for c in batch:
+        c.ctx = ctx
+    return _aggregate(aggregates, exprs, batch, ctx.sampling is not None)
+
+
+def _aggregateParallel(ctx, aggregates, exprs, solutions, processes):
+    """
+    Compute partial aggregates for batches of solutions in a pool of
+    worker processes, and merge them in the order of the batches
+    """
+    pool = multiprocessing.Pool(
+        processes, _initPartition, (ctx, aggregates, exprs))
+    try:
+        groups = {}
+        for part in pool.imap(_aggregateBatch, _batches(
+                solutions, rdflib_sparql.SPARQL_AGGREGATE_BATCH_SIZE)):
+            for k, aggregator in part.iteritems():
+                if k in groups:
+                    groups[k].merge(aggregator)
+                else:
+                    groups[k] = aggregator
+        pool.close()
+    finally:
+        pool.terminate()
+
+    if not exprs and not groups:
+        groups[1] = Aggregator(aggregates, ctx.sampling is not None)
+    return groups
+
+
+def _pushdownCount(ctx, agg):
+    """
+    Answer COUNT(*) or COUNT(?var) without grouping or filters over a
+    single triple pattern, or a star of patterns sharing the subject,
+    from the number of matching triples in the graph (see tripleCount,
+    this uses the node index only if enableNodeIndex was called).
+    Returns the count, or None for any other query.
+    """
+    group = agg.p
+    if group.expr or ctx.sampling is not None or group.p.name != 'BGP' \
+            or not group.p.triples:
+        return None
+
+    bgp = group.p.triples
+    subject = bgp[0][0]
+    others = [x for t in bgp for x in t[1:] if type(x) in (Variable, BNode)]
+    if any(t[0] != subject or isinstance(t[1], Path) for t in bgp) or \
+            subject in others or len(set(others)) != len(others):
+        # patterns are only joined on the subject
+        return None
+
+    for a in agg.A:
+        if a.name != 'Aggregate_Count' or a.distinct or \
+                not (a.vars == '*' or a.vars == subject or a.vars in others):
+            return None
+
+    patterns = [tuple(ctx[x] for x in t) for t in bgp]
+    s = patterns[0][0]
+    if s is not None or len(patterns) == 1:
+        count = 1
+        for t in patterns:
+            count *= tripleCount(ctx.graph, t)
+        return count
+
+    count = 0
+    for ts, tp, to in ctx.graph.triples(patterns[0]):
+        n = 1
+        for _, p, o in patterns[1:]:
+            n *= tripleCount(ctx.graph, (ts, p, o))
+        count += n
+    return count
+
+
 def evalAggregateJoin(ctx, agg):
-    # import pdb ; pdb.set_trace()
-    p = evalPart(ctx, agg.p)
-    # p is always a Group, we always get a dict back
+    """
+    Group and aggregate in one pass over the solutions,
+    only the aggregate state of each group is kept
+    """
+    # agg.p is always a Group
+    group = agg.p
+    count = _pushdownCount(ctx, agg)
+    if count is not None:
+        return [FrozenBindings(
+            ctx, dict((a.res, Literal(count)) for a in agg.A))]
+    if group.sorted and group.expr:
+        return evalSortedAggregateJoin(ctx, agg)
+    p = evalPart(ctx, group.p)
 
-    res = []
-    for row in p:
-        bindings = {}
-        for a in agg.A:
-            evalAgg(a, p[row], bindings)
+    processes = rdflib_sparql.SPARQL_AGGREGATE_PROCESSES
+    if processes and not _forking():
+        processes = 0
+    if processes and not hasattr(p, '__len__'):
+        p = list(p)
+    if processes and len(p) > rdflib_sparql.SPARQL_AGGREGATE_BATCH_SIZE:
+        groups = _aggregateParallel(ctx, agg.A, group.expr, p, processes)
+    else:
+        groups = _aggregate(agg.A, group.expr, p, ctx.sampling is not None)
 
-        res.append(FrozenBindings(ctx, bindings))
+    res = []
+    for aggregator in groups.itervalues():
+        res.append(FrozenBindings(ctx, aggregator.finish(ctx.sampling)))
 
-    if len(p) == 0:
+    if len(groups) == 0:
         res.append(FrozenBindings(ctx))
     return res
 
 
+def evalSortedAggregateJoin(ctx, agg):
+    """
+    Aggregate solutions ordered on the group keys (group.sorted),
+    one group at a time, the result for each group is generated
+    as soon as it is complete
+    """
+    group = agg.p
+    empty = True
+    for aggregator in _aggregateSorted(agg.A, group.expr,
+                                       evalPart(ctx, group.p),
+                                       ctx.sampling is not None):
+        empty = False
+        yield FrozenBindings(ctx, aggregator.finish(ctx.sampling))
+
+    if empty:
+        yield FrozenBindings(ctx)
+
+
+def _orderKey(v):
+    """
+    The key ORDER BY sorts the value v by
+    """
+    if isinstance(v, Variable):
+        return (0, v)
+    elif isinstance(v, BNode):
+        return (1, v)
+    elif isinstance(v, URIRef):
+        return (2, v)
+    elif isinstance(v, Literal):
+        return (3, v)
+
+
 def evalOrderBy(ctx, part):
 
     res = evalPart(ctx, part.p)
@@ -279,15 +560,7 @@ def evalOrderBy(ctx, part):
     for e in reversed(part.expr):
 
         def val(x):
-            v = value(x, e.expr, variables=True)
-            if isinstance(v, Variable):
-                return (0, v)
-            elif isinstance(v, BNode):
-                return (1, v)
-            elif isinstance(v, URIRef):
-                return (2, v)
-            elif isinstance(v, Literal):
-                return (3, v)
+            return _orderKey(value(x, e.expr, variables=True))
 
         reverse = bool(e.order and e.order == 'DESC')
         res = sorted(res, key=val, reverse=reverse)
@@ -308,17 +581,16 @@ def evalReduced(ctx, part):
     return evalPart(ctx, part.p)  # TODO!
 
 
-def evalDistinct(ctx, part):
-    res = evalPart(ctx, part.p)
-
-    nodups = []
+def _distinct(solutions):
     done = set()
-    for x in res:
+    for x in solutions:
         if x not in done:
-            nodups.append(x)
             done.add(x)
+            yield x
+
 
-    return nodups
+def evalDistinct(ctx, part):
+    return list(_distinct(evalPart(ctx, part.p)))
 
 
 def evalProject(ctx, project):
@@ -366,10 +638,113 @@ def evalConstructQuery(ctx, query):
     return res
 
 
-def evalQuery(graph, query, initBindings, base=None):
+def _simplePattern(query):
+    """
+    Return (triple, PV, distinct, start, length) for a SELECT or ASK
+    query of a single triple pattern (with at most DISTINCT, REDUCED,
+    LIMIT and OFFSET), None for any other query
+    """
+    main = query.algebra
+    if main.name not in ('SelectQuery', 'AskQuery') or main.datasetClause:
+        return None
+
+    p = main.p
+    start, length = 0, None
+    if p.name == 'Slice':
+        start, length = p.start, p.length
+        p = p.p
+    distinct = p.name == 'Distinct'
+    if p.name in ('Distinct', 'Reduced'):
+        p = p.p
+
+    if p.name != 'Project' or p.p.name != 'BGP' or len(p.p.triples) != 1:
+        return None
+    triple = p.p.triples[0]
+    if any(isinstance(t, (BNode, Path)) for t in triple):
+        return None
+
+    return triple, p.PV, distinct, start, length
+
+
+def evalSimpleQuery(graph, query, initBindings):
+    """
+    Evaluate a query of a single triple pattern directly with
+    graph.triples, without a QueryContext and algebra evaluation
+
+    Returns None if the query is not such a query
+    """
+    # the same for every evaluation of a prepared query
+    simple = getattr(query, '_simple', False)
+    if simple is False:
+        simple = query._simple = _simplePattern(query)
+    if simple is None:
+        return None
+    triple, PV, distinct, start, length = simple
+
+    bound = {}
+    if initBindings:
+        for k, v in initBindings.iteritems():
+            if not isinstance(k, Variable):
+                k = Variable(k)
+            bound[k] = v
+
+    pattern = tuple(bound.get(t) if isinstance(t, Variable) else t
+                    for t in triple)
+    free = [(i, t) for i, t in enumerate(triple)
+            if isinstance(t, Variable) and t not in bound]
+
+    if isinstance(graph, ConjunctiveGraph) and \
+            not rdflib_sparql.SPARQL_DEFAULT_GRAPH_UNION:
+        graph = graph.default_context
+
+    if query.algebra.name == 'AskQuery' and not free:
+        return {"type_": "ASK", "askAnswer": pattern in graph}
+
+    projected = dict((v, bound[v]) for v in PV if v in bound)
+
+    def _solutions():
+        for t in graph.triples(pattern):
+            d = dict(projected)
+            for i, v in free:
+                if v in d and d[v] != t[i]:
+                    break  # i.e. ?x :p ?x
+                d[v] = t[i]
+            else:
+                yield FrozenBindings(
+                    None, ((v, x) for v, x in d.iteritems() if v in PV))
+
+    res = _solutions()
+    if distinct:
+        res = _distinct(res)
+    if length is not None:
+        res = itertools.islice(res, start, start + length)
+    elif start:
+        res = itertools.islice(res, start, None)
+
+    if query.algebra.name == 'AskQuery':
+        return {"type_": "ASK", "askAnswer": any(True for x in res)}
+
+    return {"type_": "SELECT", "bindings": list(res), "vars_": PV}
+
+
+def evalQuery(graph, query, initBindings, base=None,
+              sample=None, sampleSeed=None):
+    """
+    If sample is given, the query is evaluated approximately on
+    that fraction of the data, see rdflib_sparql.sparql.Sampling
+    """
+    rdflib_sparql.loadCustomEvals()
+
+    if not CUSTOM_EVALS and sample is None:
+        res = evalSimpleQuery(graph, query, initBindings)
+        if res is not None:
+            return res
+
     ctx = QueryContext(graph)
 
     ctx.prologue = query.prologue
+    if sample is not None:
+        ctx.sampling = Sampling(sample, sampleSeed)
 
     if initBindings:
         for k, v in initBindings.iteritems():
@@ -405,4 +780,15 @@ def evalQuery(graph, query, initBindings, base=None):
                 g = d.named
                 ctx.load(g, default=False)
 
-    return evalPart(ctx, main)
+    res = evalPart(ctx, main)
+
+    if ctx.sampling is not None:
+        res["sample"] = ctx.sampling.fraction
+        if res.get("bindings") is not None:
+            res["intervals"] = [
+                dict((v, i) for v, i in (
+                    (v, ctx.sampling.interval(x)) for v, x in b.iteritems())
+                    if i is not None)
+                for b in res["bindings"]]
+
+    return res
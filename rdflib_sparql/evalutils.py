@@ -3,7 +3,7 @@ import collections
 from rdflib.term import Variable, Literal, BNode, URIRef
 
 from rdflib_sparql.operators import EBV
-from rdflib_sparql.parserutils import Expr, CompValue
+from rdflib_sparql.parserutils import Expr, CompValue, SlotExpr, SlotValue
 from rdflib_sparql.sparql import SPARQLError, NotBoundError
 
 
@@ -45,16 +45,17 @@ def _ebv(expr, ctx):
     an error is false
     """
 
-    try:
-        return EBV(expr)
-    except SPARQLError:
-        pass
-    if isinstance(expr, Expr):
+    if isinstance(expr, Literal):
+        try:
+            return EBV(expr)
+        except SPARQLError:
+            return False
+    if isinstance(expr, (SlotExpr, Expr)):
         try:
             return EBV(expr.eval(ctx))
         except SPARQLError:
             return False  # filter error == False
-    elif isinstance(expr, CompValue):
+    elif isinstance(expr, (SlotValue, CompValue)):
         raise Exception(
             "Weird - filter got a CompValue without evalfn! %r" % expr)
     elif isinstance(expr, Variable):
@@ -68,14 +69,14 @@ def _ebv(expr, ctx):
 def _eval(expr, ctx):
     if isinstance(expr, (Literal, URIRef)):
         return expr
-    if isinstance(expr, Expr):
+    if isinstance(expr, (SlotExpr, Expr)):
         return expr.eval(ctx)
     elif isinstance(expr, Variable):
         try:
             return ctx[expr]
         except KeyError:
             return NotBoundError("Variable %s is not bound" % expr)
-    elif isinstance(expr, CompValue):
+    elif isinstance(expr, (SlotValue, CompValue)):
         raise Exception(
             "Weird - _eval got a CompValue without evalfn! %r" % expr)
     else:
@@ -88,6 +89,20 @@ def _filter(a, expr):
             yield c
 
 
+def _batches(solutions, size):
+    """
+    Split solutions into lists of at most size solutions
+    """
+    batch = []
+    for c in solutions:
+        batch.append(c)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def _fillTemplate(template, solution):
 
     """
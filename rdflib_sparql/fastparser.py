@@ -0,0 +1,1417 @@
+"""
+A hand-written SPARQL parser
+
+This is a recursive-descent parser with a regex driven tokenizer,
+it builds exactly the same CompValue parse-trees as the pyparsing
+grammar in rdflib_sparql.parser, but without the overhead of
+pyparsing's backtracking.
+
+Terms (IRIs, prefixed names, variables, literals, keywords, ...) are
+read by one regular expression, punctuation is matched directly on the
+query string, so that i.e. < is an operator where an operator is
+expected and starts an IRI elsewhere, just like in the pyparsing
+grammar.
+
+It is used instead of the pyparsing grammar if
+rdflib_sparql.SPARQL_FAST_PARSER is true, or can be called directly.
+"""
+
+import re
+
+from pyparsing import ParseException, ParseResults
+
+from rdflib import URIRef, BNode, Literal, Variable, RDF, XSD
+
+from rdflib_sparql.parserutils import CompValue, Expr, plist, Terms
+from rdflib_sparql.parser import (
+    PN_CHARS_BASE_re, PN_CHARS_U_re, PN_CHARS_re, EXPONENT_re,
+    PathModRange_re, pathModRange, expandTriples, expandCollection,
+    expandUnicodeEscapes, neg)
+from rdflib_sparql.py3compat import decodeStringEscape
+
+import rdflib_sparql.operators as op
+
+
+_PLX_re = r'%[0-9a-fA-F]{2}|\\[_~\.\-!$&"\'()*+,;=/?#@%]'
+
+_TERM = re.compile(u'|'.join([
+    # IRIREF
+    u'(?P<iri><(?P<iriref>[^<>"{}|^`\\\\%s]*)>)' % ''.join(
+        '\\x%02X' % i for i in range(33)),
+    # BLANK_NODE_LABEL
+    u'(?P<bnode>_:[0-9%s](?:[\\.%s]*[%s])?)' % (
+        PN_CHARS_U_re, PN_CHARS_re, PN_CHARS_re),
+    # PNAME_LN | PNAME_NS, like the pyparsing grammar this allows a
+    # trailing . in the local name
+    u'(?P<pname>(?P<prefix>[%s](?:[%s\\.]*[%s])?)?:'
+    u'(?P<local>(?:[%s0-9:]|%s)(?:[%s\\.:]|%s)*)?)' % (
+        PN_CHARS_BASE_re, PN_CHARS_re, PN_CHARS_re,
+        PN_CHARS_U_re, _PLX_re, PN_CHARS_re, _PLX_re),
+    # VAR1 | VAR2
+    u'(?P<var>[?$](?P<varname>[%s0-9]'
+    u'[%s0-9\u00B7\u0300-\u036F\u203F-\u2040]*))' % (
+        PN_CHARS_U_re, PN_CHARS_U_re),
+    # STRING_LITERAL_LONG1 | STRING_LITERAL_LONG2
+    u"(?P<long>'''(?:(?:'|'')?(?:[^'\\\\]|\\\\['ntbrf\\\\]))*'''"
+    u'|"""(?:(?:"|"")?(?:[^"\\\\]|\\\\["ntbrf\\\\]))*""")',
+    # STRING_LITERAL1 | STRING_LITERAL2
+    u"(?P<string>'(?:[^'\\n\\r\\\\]|\\\\['ntbrf\\\\])*'(?!')"
+    u'|"(?:[^"\\n\\r\\\\]|\\\\["ntbrf\\\\])*"(?!"))',
+    # DOUBLE | DECIMAL | INTEGER
+    u'(?P<double>[0-9]+\\.[0-9]*%(e)s|\\.[0-9]+%(e)s|[0-9]+%(e)s)' % {
+        'e': EXPONENT_re},
+    u'(?P<decimal>[0-9]*\\.[0-9]+)',
+    u'(?P<integer>[0-9]+)',
+    # LANGTAG
+    u'(?P<lang>@(?P<langtag>[a-zA-Z]+(?:-[a-zA-Z0-9]+)*))',
+    # keywords
+    u'(?P<word>[A-Za-z_][A-Za-z0-9_]*)',
+]), re.U)
+
+_NUMBER_TYPES = {
+    'integer': XSD.integer, 'decimal': XSD.decimal, 'double': XSD.double}
+
+_WS = re.compile(r'(?:[ \t\r\n]+|#[^\n]*)*')
+
+_PLX = re.compile(_PLX_re)
+
+_PATHMODRANGE = re.compile(PathModRange_re)
+
+
+def _plx(m):
+    x = m.group()
+    if x[0] == '%':
+        return unichr(int(x[1:], 16))
+    return x[1:]
+
+
+def _add(comp, name, value):
+    """
+    Append value to the list name of comp, like a pyparsing ParamList
+    """
+    if name not in comp:
+        comp[name] = plist()
+    dict.__getitem__(comp, name).append(value)
+
+
+def _unwrap(tokens):
+    """
+    The value of a pyparsing Param matching these tokens
+    """
+    if len(tokens) == 1:
+        return tokens[0]
+    return ParseResults(tokens)
+
+
+# keyword: (name, evalfn, parameters, optional parameters)
+_BUILTINS = {
+    'STR': ('Builtin_STR', op.Builtin_STR, ('arg',), ()),
+    'LANG': ('Builtin_LANG', op.Builtin_LANG, ('arg',), ()),
+    'LANGMATCHES': ('Builtin_LANGMATCHES', op.Builtin_LANGMATCHES,
+                    ('arg1', 'arg2'), ()),
+    'DATATYPE': ('Builtin_DATATYPE', op.Builtin_DATATYPE, ('arg',), ()),
+    'IRI': ('Builtin_IRI', op.Builtin_IRI, ('arg',), ()),
+    'URI': ('Builtin_URI', op.Builtin_IRI, ('arg',), ()),
+    'ABS': ('Builtin_ABS', op.Builtin_ABS, ('arg',), ()),
+    'CEIL': ('Builtin_CEIL', op.Builtin_CEIL, ('arg',), ()),
+    'FLOOR': ('Builtin_FLOOR', op.Builtin_FLOOR, ('arg',), ()),
+    'ROUND': ('Builtin_ROUND', op.Builtin_ROUND, ('arg',), ()),
+    'SUBSTR': ('Builtin_SUBSTR', op.Builtin_SUBSTR,
+               ('arg', 'start'), ('length',)),
+    'STRLEN': ('Builtin_STRLEN', op.Builtin_STRLEN, ('arg',), ()),
+    'REPLACE': ('Builtin_REPLACE', op.Builtin_REPLACE,
+                ('arg', 'pattern', 'replacement'), ('flags',)),
+    'UCASE': ('Builtin_UCASE', op.Builtin_UCASE, ('arg',), ()),
+    'LCASE': ('Builtin_LCASE', op.Builtin_LCASE, ('arg',), ()),
+    'ENCODE_FOR_URI': ('Builtin_ENCODE_FOR_URI', op.Builtin_ENCODE_FOR_URI,
+                       ('arg',), ()),
+    'CONTAINS': ('Builtin_CONTAINS', op.Builtin_CONTAINS,
+                 ('arg1', 'arg2'), ()),
+    'STRSTARTS': ('Builtin_STRSTARTS', op.Builtin_STRSTARTS,
+                  ('arg1', 'arg2'), ()),
+    'STRENDS': ('Builtin_STRENDS', op.Builtin_STRENDS,
+                ('arg1', 'arg2'), ()),
+    'STRBEFORE': ('Builtin_STRBEFORE', op.Builtin_STRBEFORE,
+                  ('arg1', 'arg2'), ()),
+    'STRAFTER': ('Builtin_STRAFTER', op.Builtin_STRAFTER,
+                 ('arg1', 'arg2'), ()),
+    'YEAR': ('Builtin_YEAR', op.Builtin_YEAR, ('arg',), ()),
+    'MONTH': ('Builtin_MONTH', op.Builtin_MONTH, ('arg',), ()),
+    'DAY': ('Builtin_DAY', op.Builtin_DAY, ('arg',), ()),
+    'HOURS': ('Builtin_HOURS', op.Builtin_HOURS, ('arg',), ()),
+    'MINUTES': ('Builtin_MINUTES', op.Builtin_MINUTES, ('arg',), ()),
+    'SECONDS': ('Builtin_SECONDS', op.Builtin_SECONDS, ('arg',), ()),
+    'TIMEZONE': ('Builtin_TIMEZONE', op.Builtin_TIMEZONE, ('arg',), ()),
+    'TZ': ('Builtin_TZ', op.Builtin_TZ, ('arg',), ()),
+    'MD5': ('Builtin_MD5', op.Builtin_MD5, ('arg',), ()),
+    'SHA1': ('Builtin_SHA1', op.Builtin_SHA1, ('arg',), ()),
+    'SHA256': ('Builtin_SHA256', op.Builtin_SHA256, ('arg',), ()),
+    'SHA384': ('Builtin_SHA384', op.Builtin_SHA384, ('arg',), ()),
+    'SHA512': ('Builtin_SHA512', op.Builtin_SHA512, ('arg',), ()),
+    'IF': ('Builtin_IF', op.Builtin_IF, ('arg1', 'arg2', 'arg3'), ()),
+    'STRLANG': ('Builtin_STRLANG', op.Builtin_STRLANG,
+                ('arg1', 'arg2'), ()),
+    'STRDT': ('Builtin_STRDT', op.Builtin_STRDT, ('arg1', 'arg2'), ()),
+    'SAMETERM': ('Builtin_sameTerm', op.Builtin_sameTerm,
+                 ('arg1', 'arg2'), ()),
+    'ISIRI': ('Builtin_isIRI', op.Builtin_isIRI, ('arg',), ()),
+    'ISURI': ('Builtin_isURI', op.Builtin_isIRI, ('arg',), ()),
+    'ISBLANK': ('Builtin_isBLANK', op.Builtin_isBLANK, ('arg',), ()),
+    'ISLITERAL': ('Builtin_isLITERAL', op.Builtin_isLITERAL, ('arg',), ()),
+    'ISNUMERIC': ('Builtin_isNUMERIC', op.Builtin_isNUMERIC, ('arg',), ()),
+    'REGEX': ('Builtin_REGEX', op.Builtin_REGEX,
+              ('text', 'pattern'), ('flags',)),
+}
+
+# keyword: (name, evalfn), these take no arguments
+_NIL_BUILTINS = {
+    'RAND': ('Builtin_RAND', op.Builtin_RAND),
+    'NOW': ('Builtin_NOW', op.Builtin_NOW),
+    'UUID': ('Builtin_UUID', op.Builtin_UUID),
+    'STRUUID': ('Builtin_STRUUID', op.Builtin_STRUUID),
+}
+
+# and these an ExpressionList
+_LIST_BUILTINS = {
+    'CONCAT': ('Builtin_CONCAT', op.Builtin_CONCAT),
+    'COALESCE': ('Builtin_COALESCE', op.Builtin_COALESCE),
+}
+
+_AGGREGATES = {
+    'COUNT': 'Aggregate_Count',
+    'SUM': 'Aggregate_Sum',
+    'MIN': 'Aggregate_Min',
+    'MAX': 'Aggregate_Max',
+    'AVG': 'Aggregate_Avg',
+    'SAMPLE': 'Aggregate_Sample',
+    'GROUP_CONCAT': 'Aggregate_GroupConcat',
+}
+
+_KEYWORD_BUILTINS = frozenset(
+    ['BOUND', 'BNODE', 'EXISTS', 'NOT'] + _BUILTINS.keys() +
+    _NIL_BUILTINS.keys() + _LIST_BUILTINS.keys() + _AGGREGATES.keys())
+
+_RELATIONAL = ('=', '!=', '<=', '>=', '<', '>')
+
+_GRAPH_PATTERNS = frozenset(
+    ['OPTIONAL', 'MINUS', 'GRAPH', 'SERVICE', 'FILTER', 'BIND', 'VALUES'])
+
+
+class Parser(object):
+
+    """
+    Parses one query or update string
+    """
+
+    def __init__(self, s):
+        self.s = s
+        self.pos = 0
+        self._peeked = None
+        self.terms = Terms()
+
+    # ------ TOKENS
+
+    def error(self, expected):
+        self.skip()
+        raise ParseException(self.s, self.pos, 'Expected %s' % expected)
+
+    def skip(self):
+        self.pos = _WS.match(self.s, self.pos).end()
+
+    def peek(self, skip=True):
+        """
+        The match of the term at the current position, or None
+        """
+        if skip:
+            self.skip()
+        if self._peeked is not None and self._peeked[0] == self.pos:
+            return self._peeked[1]
+        m = _TERM.match(self.s, self.pos)
+        self._peeked = (self.pos, m)
+        return m
+
+    def take(self, m):
+        self.pos = m.end()
+        return m
+
+    def keyword(self):
+        """
+        The upper-cased keyword at the current position, or None
+        """
+        m = self.peek()
+        if m is not None and m.lastgroup == 'word':
+            return m.group().upper()
+
+    def acceptKeyword(self, *words):
+        k = self.keyword()
+        if k in words:
+            self.take(self._peeked[1])
+            return k
+
+    def expectKeyword(self, word):
+        if not self.acceptKeyword(word):
+            self.error(word)
+        return word
+
+    def accept(self, literal, skip=True):
+        if skip:
+            self.skip()
+        if self.s.startswith(literal, self.pos):
+            self.pos += len(literal)
+            return True
+        return False
+
+    def expect(self, literal):
+        if not self.accept(literal):
+            self.error('"%s"' % literal)
+
+    def nil(self):
+        """
+        Accept a NIL, '(' followed by ')'
+        """
+        pos = self.pos
+        if self.accept('('):
+            if self.accept(')'):
+                return True
+            self.pos = pos
+        return False
+
+    def end(self):
+        self.skip()
+        if self.pos != len(self.s):
+            self.error('end of text')
+
+    # ------ TERMS
+
+    def iri(self, skip=True):
+        """
+        An IRIREF as URIRef or a prefixed name as pname CompValue,
+        None if there is none
+        """
+        m = self.peek(skip)
+        if m is None:
+            return None
+        kind = m.lastgroup
+        if kind == 'iri':
+            self.take(m)
+            return self.terms.term(URIRef, m.group('iriref'))
+        if kind == 'pname':
+            self.take(m)
+            res = CompValue('pname')
+            prefix, local = m.group('prefix', 'local')
+            if prefix is not None:
+                res['prefix'] = prefix
+            if local is not None:
+                if '%' in local or '\\' in local:
+                    local = _PLX.sub(_plx, local)
+                res['localname'] = local
+            return res
+
+    def expectIri(self):
+        res = self.iri()
+        if res is None:
+            self.error('iri')
+        return res
+
+    def iriref(self):
+        m = self.peek()
+        if m is None or m.lastgroup != 'iri':
+            self.error('IRIREF')
+        self.take(m)
+        return self.terms.term(URIRef, m.group('iriref'))
+
+    def var(self):
+        m = self.peek()
+        if m is not None and m.lastgroup == 'var':
+            self.take(m)
+            return self.terms.term(Variable, m.group('varname'))
+
+    def expectVar(self):
+        res = self.var()
+        if res is None:
+            self.error('Var')
+        return res
+
+    def varOrIri(self):
+        res = self.var()
+        if res is None:
+            res = self.iri()
+        return res
+
+    def expectVarOrIri(self):
+        res = self.varOrIri()
+        if res is None:
+            self.error('Var or iri')
+        return res
+
+    def string(self):
+        """
+        A String as Literal, None if there is none
+        """
+        m = self.peek()
+        if m is None:
+            return None
+        if m.lastgroup == 'string':
+            self.take(m)
+            return self.terms.term(
+                Literal, decodeStringEscape(m.group()[1:-1]))
+        if m.lastgroup == 'long':
+            self.take(m)
+            return self.terms.term(
+                Literal, decodeStringEscape(m.group()[3:-3]))
+
+    def rdfLiteral(self):
+        """
+        A String with optional language or datatype, as literal CompValue
+        """
+        string = self.string()
+        if string is None:
+            return None
+        res = CompValue('literal')
+        res['string'] = string
+        m = self.peek(False)
+        if m is not None and m.lastgroup == 'lang':
+            self.take(m)
+            res['lang'] = m.group('langtag')
+        elif self.s.startswith('^^', self.pos):
+            pos = self.pos
+            self.pos += 2
+            datatype = self.iri(False)
+            if datatype is None:
+                self.pos = pos
+            else:
+                res['datatype'] = datatype
+        return res
+
+    def numericLiteral(self, signed=True):
+        """
+        A NumericLiteral, signed ones only if signed is true
+        """
+        m = self.peek()
+        if m is None:
+            if not signed:
+                return None
+            c = self.s[self.pos:self.pos + 1]
+            if c not in ('+', '-'):
+                return None
+            m = _TERM.match(self.s, self.pos + 1)
+            if m is None or m.lastgroup not in _NUMBER_TYPES:
+                return None
+            self.take(m)
+            n = self.terms.term(
+                Literal, m.group(), _NUMBER_TYPES[m.lastgroup])
+            if c == '-':
+                return neg(n)
+            if m.lastgroup == 'integer':
+                return self.terms.term(Literal, '+' + m.group(), XSD.integer)
+            return n
+
+        if m.lastgroup in _NUMBER_TYPES:
+            self.take(m)
+            return self.terms.term(
+                Literal, m.group(), _NUMBER_TYPES[m.lastgroup])
+
+    def booleanLiteral(self):
+        k = self.keyword()
+        if k == 'TRUE':
+            self.take(self._peeked[1])
+            return Literal(True)
+        if k == 'FALSE':
+            self.take(self._peeked[1])
+            return Literal(False)
+
+    def blankNode(self):
+        m = self.peek()
+        if m is not None and m.lastgroup == 'bnode':
+            self.take(m)
+            return BNode(m.group())
+        pos = self.pos
+        if self.accept('['):
+            if self.accept(']'):
+                return BNode()
+            self.pos = pos
+
+    def graphTerm(self):
+        """
+        A GraphTerm, None if there is none
+        """
+        res = self.iri()
+        if res is None:
+            res = self.rdfLiteral()
+        if res is None:
+            res = self.numericLiteral()
+        if res is None:
+            res = self.booleanLiteral()
+        if res is None:
+            res = self.blankNode()
+        if res is None and self.nil():
+            res = RDF.nil
+        return res
+
+    def varOrTerm(self):
+        res = self.var()
+        if res is None:
+            res = self.graphTerm()
+        return res
+
+    def dataBlockValue(self):
+        res = self.iri()
+        if res is None:
+            res = self.rdfLiteral()
+        if res is None:
+            res = self.numericLiteral()
+        if res is None:
+            res = self.booleanLiteral()
+        if res is None and self.acceptKeyword('UNDEF'):
+            res = 'UNDEF'
+        return res
+
+    # ------ TRIPLES
+
+    def verb(self, path):
+        """
+        A verb, which may be a property path if path is true,
+        None if there is none
+        """
+        if path:
+            res = self.path()
+            if res is None:
+                res = self.var()
+            return res
+        res = self.varOrIri()
+        if res is None and self.acceptA():
+            res = RDF.type
+        return res
+
+    def acceptA(self):
+        m = self.peek()
+        if m is not None and m.lastgroup == 'word' and m.group() == 'a':
+            self.take(m)
+            return True
+        return False
+
+    def graphNode(self, path):
+        res = self.varOrTerm()
+        if res is None:
+            res = self.triplesNode(path)
+        return res
+
+    def objectList(self, path, terms):
+        """
+        Append the objects and , tokens of an ObjectList to terms
+        """
+        o = self.graphNode(path)
+        if o is None:
+            self.error('object')
+        terms.append(o)
+        while self.accept(','):
+            o = self.graphNode(path)
+            if o is None:
+                self.error('object')
+            terms.append(',')
+            terms.append(o)
+
+    def propertyList(self, path, terms):
+        """
+        Append the tokens of a PropertyListNotEmpty (or
+        PropertyListPathNotEmpty if path is true) to terms,
+        False if there is no property list
+        """
+        v = self.verb(path)
+        if v is None:
+            return False
+        terms.append(v)
+        self.objectList(path, terms)
+        while self.accept(';'):
+            terms.append(';')
+            v = self.verb(path)
+            if v is not None:
+                terms.append(v)
+                # the object lists after ; are never paths
+                self.objectList(False, terms)
+        return True
+
+    def triplesNode(self, path):
+        """
+        A Collection or BlankNodePropertyList, as list of expanded
+        triples, None if there is none
+        """
+        pos = self.pos
+        if self.accept('('):
+            if self.accept(')'):
+                self.pos = pos
+                return None
+            nodes = []
+            while not self.accept(')'):
+                n = self.graphNode(path)
+                if n is None:
+                    self.error('")"')
+                nodes.append(n)
+            return expandCollection(nodes)[0]
+        if self.accept('['):
+            terms = [BNode()]
+            if not self.propertyList(path, terms):
+                self.pos = pos
+                return None
+            self.expect(']')
+            return expandTriples(terms)
+
+    def triplesSameSubject(self, path):
+        """
+        The expanded triples of a TriplesSameSubject (or
+        TriplesSameSubjectPath), None if there are none
+        """
+        s = self.varOrTerm()
+        if s is not None:
+            terms = [s]
+            if not self.propertyList(path, terms):
+                self.error('property list')
+        else:
+            s = self.triplesNode(path)
+            if s is None:
+                return None
+            terms = [s]
+            self.propertyList(path, terms)
+        return ParseResults(expandTriples(terms))
+
+    def triplesBlock(self, comp, name, path):
+        """
+        Add the triples of a TriplesBlock (or TriplesTemplate,
+        ConstructTriples) to comp, False if there are none
+        """
+        t = self.triplesSameSubject(path)
+        if t is None:
+            return False
+        _add(comp, name, t)
+        while self.accept('.'):
+            t = self.triplesSameSubject(path)
+            if t is None:
+                break
+            _add(comp, name, t)
+        return True
+
+    # ------ PATHS
+
+    def path(self):
+        """
+        A PathAlternative, None if there is none
+        """
+        seq = self.pathSequence()
+        if seq is None:
+            return None
+        res = CompValue('PathAlternative')
+        _add(res, 'part', seq)
+        while self.accept('|'):
+            seq = self.pathSequence()
+            if seq is None:
+                self.error('path')
+            _add(res, 'part', seq)
+        return res
+
+    def pathSequence(self):
+        elt = self.pathEltOrInverse()
+        if elt is None:
+            return None
+        res = CompValue('PathSequence')
+        _add(res, 'part', elt)
+        while self.accept('/'):
+            elt = self.pathEltOrInverse()
+            if elt is None:
+                self.error('path')
+            _add(res, 'part', elt)
+        return res
+
+    def pathEltOrInverse(self):
+        pos = self.pos
+        if self.accept('^'):
+            elt = self.pathElt()
+            if elt is None:
+                self.pos = pos
+                return None
+            res = CompValue('PathEltOrInverse')
+            res['part'] = elt
+            return res
+        return self.pathElt()
+
+    def pathElt(self):
+        primary = self.pathPrimary()
+        if primary is None:
+            return None
+        res = CompValue('PathElt')
+        res['part'] = primary
+        # the modifier must follow without whitespace
+        c = self.s[self.pos:self.pos + 1]
+        if c in ('?', '*', '+'):
+            self.pos += 1
+            res['mod'] = c
+        elif c == '{':
+            m = _PATHMODRANGE.match(self.s, self.pos)
+            if m is not None:
+                try:
+                    res['mod'] = pathModRange(self.s, self.pos, [m.group()])
+                    self.pos = m.end()
+                except ParseException:
+                    pass
+        return res
+
+    def pathPrimary(self):
+        res = self.iri()
+        if res is not None:
+            return res
+        if self.acceptA():
+            return RDF.type
+        if self.accept('!'):
+            return self.pathNegatedPropertySet()
+        pos = self.pos
+        if self.accept('('):
+            res = self.path()
+            if res is None:
+                self.pos = pos
+                return None
+            self.expect(')')
+            return res
+        if self.acceptKeyword('DISTINCT'):
+            self.expect('(')
+            res = CompValue('DistinctPath')
+            res['part'] = self.path()
+            if res['part'] is None:
+                self.error('path')
+            self.expect(')')
+            return res
+
+    def pathNegatedPropertySet(self):
+        res = CompValue('PathNegatedPropertySet')
+        if self.accept('('):
+            one = self.pathOneInPropertySet()
+            if one is not None:
+                _add(res, 'part', one)
+                while self.accept('|'):
+                    one = self.pathOneInPropertySet()
+                    if one is None:
+                        self.error('iri')
+                    _add(res, 'part', one)
+            self.expect(')')
+        else:
+            one = self.pathOneInPropertySet()
+            if one is None:
+                self.error('iri')
+            _add(res, 'part', one)
+        return res
+
+    def pathOneInPropertySet(self):
+        res = self.iri()
+        if res is None and self.acceptA():
+            res = RDF.type
+        if res is None and self.accept('^'):
+            part = self.iri()
+            if part is None:
+                if not self.acceptA():
+                    self.error('iri')
+                part = RDF.type
+            res = CompValue('InversePath', part=part)
+        return res
+
+    # ------ EXPRESSIONS
+
+    def expression(self):
+        res = Expr('ConditionalOrExpression', op.ConditionalOrExpression)
+        res['expr'] = self.conditionalAndExpression()
+        while self.accept('||'):
+            _add(res, 'other', self.conditionalAndExpression())
+        return res
+
+    def conditionalAndExpression(self):
+        res = Expr('ConditionalAndExpression', op.ConditionalAndExpression)
+        res['expr'] = self.relationalExpression()
+        while self.accept('&&'):
+            _add(res, 'other', self.relationalExpression())
+        return res
+
+    def relationalExpression(self):
+        res = Expr('RelationalExpression', op.RelationalExpression)
+        res['expr'] = self.additiveExpression()
+        self.skip()
+        for o in _RELATIONAL:
+            if self.accept(o, False):
+                res['op'] = o
+                res['other'] = self.additiveExpression()
+                return res
+        k = self.keyword()
+        if k == 'IN':
+            self.take(self._peeked[1])
+            res['op'] = 'IN'
+            res['other'] = self.expressionList()
+        elif k == 'NOT':
+            pos = self.pos
+            self.take(self._peeked[1])
+            if self.acceptKeyword('IN'):
+                res['op'] = 'NOT IN'
+                res['other'] = self.expressionList()
+            else:
+                self.pos = pos
+        return res
+
+    def additiveExpression(self):
+        res = Expr('AdditiveExpression', op.AdditiveExpression)
+        res['expr'] = self.multiplicativeExpression()
+        while True:
+            if self.accept('+'):
+                _add(res, 'op', '+')
+            elif self.accept('-'):
+                _add(res, 'op', '-')
+            else:
+                return res
+            _add(res, 'other', self.multiplicativeExpression())
+
+    def multiplicativeExpression(self):
+        res = Expr('MultiplicativeExpression', op.MultiplicativeExpression)
+        res['expr'] = self.unaryExpression()
+        while True:
+            if self.accept('*'):
+                _add(res, 'op', '*')
+            elif self.accept('/'):
+                _add(res, 'op', '/')
+            else:
+                return res
+            _add(res, 'other', self.unaryExpression())
+
+    def unaryExpression(self):
+        if self.accept('!'):
+            res = Expr('UnaryNot', op.UnaryNot)
+        elif self.accept('+'):
+            res = Expr('UnaryPlus', op.UnaryPlus)
+        elif self.accept('-'):
+            res = Expr('UnaryMinus', op.UnaryMinus)
+        else:
+            return self.primaryExpression()
+        res['expr'] = self.primaryExpression()
+        return res
+
+    def primaryExpression(self):
+        res = self.bracketted()
+        if res is None:
+            res = self.builtInCall()
+        if res is None:
+            res = self.iriOrFunction()
+        if res is None:
+            res = self.rdfLiteral()
+        if res is None:
+            res = self.numericLiteral(False)
+        if res is None:
+            res = self.booleanLiteral()
+        if res is None:
+            res = self.var()
+        if res is None:
+            self.error('expression')
+        return res
+
+    def bracketted(self):
+        if self.accept('('):
+            res = self.expression()
+            self.expect(')')
+            return res
+
+    def expressionList(self):
+        if self.nil():
+            return RDF.nil
+        self.expect('(')
+        res = [self.expression()]
+        while self.accept(','):
+            res.append(self.expression())
+        self.expect(')')
+        return ParseResults(res)
+
+    def argList(self, res):
+        """
+        Add the parameters of an ArgList to a Function
+        """
+        if self.nil():
+            return
+        self.expect('(')
+        res['distinct'] = self.distinct()
+        _add(res, 'expr', self.expression())
+        while self.accept(','):
+            _add(res, 'expr', self.expression())
+        self.expect(')')
+
+    def distinct(self):
+        if self.acceptKeyword('DISTINCT'):
+            return 'DISTINCT'
+        return ParseResults([])
+
+    def iriOrFunction(self):
+        res = self.iri()
+        if res is None:
+            return None
+        self.skip()
+        if not self.s.startswith('(', self.pos):
+            return res
+        f = Expr('Function', op.Function)
+        f['iri'] = res
+        self.argList(f)
+        return f
+
+    def functionCall(self):
+        res = self.iri()
+        if res is None:
+            return None
+        f = Expr('Function', op.Function)
+        f['iri'] = res
+        self.skip()
+        if not self.s.startswith('(', self.pos):
+            self.error('"("')
+        self.argList(f)
+        return f
+
+    def builtInCall(self):
+        k = self.keyword()
+        if k not in _KEYWORD_BUILTINS:
+            return None
+        self.take(self._peeked[1])
+
+        if k in _BUILTINS:
+            name, evalfn, params, optional = _BUILTINS[k]
+            res = Expr(name, evalfn)
+            self.expect('(')
+            for i, p in enumerate(params):
+                if i:
+                    self.expect(',')
+                res[p] = self.expression()
+            for p in optional:
+                if self.accept(','):
+                    res[p] = self.expression()
+            self.expect(')')
+            return res
+
+        if k in _AGGREGATES:
+            res = CompValue(_AGGREGATES[k])
+            self.expect('(')
+            res['distinct'] = self.distinct()
+            if k == 'COUNT' and self.accept('*'):
+                res['vars'] = '*'
+            else:
+                res['vars'] = self.expression()
+            if k == 'GROUP_CONCAT' and self.accept(';'):
+                self.expectKeyword('SEPARATOR')
+                self.expect('=')
+                res['separator'] = self.string()
+                if res['separator'] is None:
+                    self.error('String')
+            self.expect(')')
+            return res
+
+        if k in _NIL_BUILTINS:
+            res = Expr(*_NIL_BUILTINS[k])
+            if not self.nil():
+                self.error('NIL')
+            return res
+
+        if k in _LIST_BUILTINS:
+            res = Expr(*_LIST_BUILTINS[k])
+            res['arg'] = self.expressionList()
+            return res
+
+        if k == 'BOUND':
+            res = Expr('Builtin_BOUND', op.Builtin_BOUND)
+            self.expect('(')
+            res['arg'] = self.expectVar()
+            self.expect(')')
+            return res
+
+        if k == 'BNODE':
+            res = Expr('Builtin_BNODE', op.Builtin_BNODE)
+            if not self.nil():
+                self.expect('(')
+                res['arg'] = self.expression()
+                self.expect(')')
+            return res
+
+        if k == 'EXISTS':
+            res = Expr('Builtin_EXISTS', op.Builtin_EXISTS)
+        else:
+            self.expectKeyword('EXISTS')
+            res = Expr('Builtin_NOTEXISTS', op.Builtin_EXISTS)
+        res['graph'] = self.groupGraphPattern()
+        return res
+
+    def constraint(self):
+        """
+        A Constraint, None if there is none
+        """
+        res = self.bracketted()
+        if res is None:
+            res = self.builtInCall()
+        if res is None:
+            res = self.functionCall()
+        return res
+
+    # ------ GRAPH PATTERNS
+
+    def groupGraphPattern(self):
+        self.expect('{')
+        if self.keyword() == 'SELECT':
+            res = self.subSelect()
+        else:
+            res = self.groupGraphPatternSub()
+        self.expect('}')
+        return res
+
+    def groupGraphPatternSub(self):
+        res = CompValue('GroupGraphPatternSub')
+        self.triplesBlockPart(res)
+        while True:
+            part = self.graphPatternNotTriples()
+            if part is None:
+                return res
+            _add(res, 'part', part)
+            self.accept('.')
+            self.triplesBlockPart(res)
+
+    def triplesBlockPart(self, res):
+        block = CompValue('TriplesBlock')
+        if self.triplesBlock(block, 'triples', True):
+            _add(res, 'part', block)
+
+    def graphPatternNotTriples(self):
+        self.skip()
+        if self.s.startswith('{', self.pos):
+            res = CompValue('GroupOrUnionGraphPattern')
+            _add(res, 'graph', self.groupGraphPattern())
+            while self.acceptKeyword('UNION'):
+                _add(res, 'graph', self.groupGraphPattern())
+            return res
+
+        k = self.keyword()
+        if k not in _GRAPH_PATTERNS:
+            return None
+        self.take(self._peeked[1])
+
+        if k == 'OPTIONAL':
+            res = CompValue('OptionalGraphPattern')
+        elif k == 'MINUS':
+            res = CompValue('MinusGraphPattern')
+        elif k == 'GRAPH':
+            res = CompValue('GraphGraphPattern')
+            res['term'] = self.expectVarOrIri()
+        elif k == 'SERVICE':
+            res = CompValue('ServiceGraphPattern')
+            self.silent(res)
+            res['term'] = self.expectVarOrIri()
+        elif k == 'FILTER':
+            res = CompValue('Filter')
+            res['expr'] = self.constraint()
+            if res['expr'] is None:
+                self.error('constraint')
+            return res
+        elif k == 'BIND':
+            res = CompValue('Bind')
+            self.expect('(')
+            res['expr'] = self.expression()
+            self.expectKeyword('AS')
+            res['var'] = self.expectVar()
+            self.expect(')')
+            return res
+        else:
+            res = CompValue('InlineData')
+            self.dataBlock(res)
+            return res
+        res['graph'] = self.groupGraphPattern()
+        return res
+
+    def dataBlock(self, res):
+        v = self.var()
+        if v is not None:
+            _add(res, 'var', v)
+            self.expect('{')
+            while not self.accept('}'):
+                value = self.dataBlockValue()
+                if value is None:
+                    self.error('"}"')
+                _add(res, 'value', value)
+            return
+
+        if not self.nil():
+            self.expect('(')
+            while not self.accept(')'):
+                _add(res, 'var', self.expectVar())
+        self.expect('{')
+        while not self.accept('}'):
+            self.expect('(')
+            values = []
+            while not self.accept(')'):
+                value = self.dataBlockValue()
+                if value is None:
+                    self.error('")"')
+                values.append(value)
+            _add(res, 'value', ParseResults(values))
+
+    # ------ QUERIES
+
+    def prologue(self):
+        res = []
+        while True:
+            k = self.acceptKeyword('BASE', 'PREFIX')
+            if k == 'BASE':
+                decl = CompValue('Base')
+            elif k == 'PREFIX':
+                decl = CompValue('PrefixDecl')
+                m = self.peek()
+                if m is None or m.lastgroup != 'pname' or \
+                        m.group('local') is not None:
+                    self.error('PNAME_NS')
+                self.take(m)
+                if m.group('prefix') is not None:
+                    decl['prefix'] = m.group('prefix')
+            else:
+                return ParseResults(res)
+            decl['iri'] = self.iriref()
+            res.append(decl)
+
+    def selectClause(self, res):
+        self.expectKeyword('SELECT')
+        modifier = self.acceptKeyword('DISTINCT', 'REDUCED')
+        if modifier:
+            res['modifier'] = modifier
+        if self.accept('*'):
+            return
+        while True:
+            v = self.var()
+            if v is not None:
+                _add(res, 'var', v)
+            elif self.accept('('):
+                _add(res, 'expr', self.expression())
+                self.expectKeyword('AS')
+                _add(res, 'evar', self.expectVar())
+                self.expect(')')
+            else:
+                break
+        if 'var' not in res and 'expr' not in res:
+            self.error('projection')
+
+    def datasetClause(self):
+        if not self.acceptKeyword('FROM'):
+            return None
+        res = CompValue('DatasetClause')
+        if self.acceptKeyword('NAMED'):
+            res['named'] = self.expectIri()
+        else:
+            res['default'] = self.expectIri()
+        return res
+
+    def datasetClauses(self, res):
+        dc = self.datasetClause()
+        while dc is not None:
+            _add(res, 'datasetClause', dc)
+            dc = self.datasetClause()
+
+    def datasetClauseParam(self, res):
+        clauses = []
+        dc = self.datasetClause()
+        while dc is not None:
+            clauses.append(dc)
+            dc = self.datasetClause()
+        res['datasetClause'] = _unwrap(clauses)
+
+    def whereClause(self, res):
+        self.acceptKeyword('WHERE')
+        res['where'] = self.groupGraphPattern()
+
+    def solutionModifier(self, res):
+        if self.acceptKeyword('GROUP'):
+            self.expectKeyword('BY')
+            group = CompValue('GroupClause')
+            c = self.groupCondition()
+            if c is None:
+                self.error('group condition')
+            while c is not None:
+                _add(group, 'condition', c)
+                c = self.groupCondition()
+            res['groupby'] = group
+
+        if self.acceptKeyword('HAVING'):
+            having = CompValue('HavingClause')
+            c = self.constraint()
+            if c is None:
+                self.error('constraint')
+            while c is not None:
+                _add(having, 'condition', c)
+                c = self.constraint()
+            res['having'] = having
+
+        if self.acceptKeyword('ORDER'):
+            self.expectKeyword('BY')
+            order = CompValue('OrderClause')
+            c = self.orderCondition()
+            if c is None:
+                self.error('order condition')
+            while c is not None:
+                _add(order, 'condition', c)
+                c = self.orderCondition()
+            res['orderby'] = order
+
+        k = self.acceptKeyword('LIMIT', 'OFFSET')
+        if k:
+            lo = CompValue('LimitOffsetClauses')
+            lo[k.lower()] = self.integer()
+            other = 'OFFSET' if k == 'LIMIT' else 'LIMIT'
+            if self.acceptKeyword(other):
+                lo[other.lower()] = self.integer()
+            res['limitoffset'] = lo
+
+    def integer(self):
+        m = self.peek()
+        if m is None or m.lastgroup != 'integer':
+            self.error('INTEGER')
+        self.take(m)
+        return Literal(m.group(), datatype=XSD.integer)
+
+    def groupCondition(self):
+        res = self.builtInCall()
+        if res is None:
+            res = self.functionCall()
+        if res is None and self.accept('('):
+            res = CompValue('GroupAs')
+            res['expr'] = self.expression()
+            if self.acceptKeyword('AS'):
+                res['var'] = self.expectVar()
+            self.expect(')')
+        if res is None:
+            res = self.var()
+        return res
+
+    def orderCondition(self):
+        k = self.acceptKeyword('ASC', 'DESC')
+        if k:
+            res = CompValue('OrderCondition')
+            res['order'] = k
+            res['expr'] = self.bracketted()
+            if res['expr'] is None:
+                self.error('"("')
+            return res
+        expr = self.constraint()
+        if expr is None:
+            expr = self.var()
+        if expr is None:
+            return None
+        res = CompValue('OrderCondition')
+        res['expr'] = expr
+        return res
+
+    def valuesClause(self, res):
+        if self.acceptKeyword('VALUES'):
+            values = CompValue('ValuesClause')
+            self.dataBlock(values)
+            res['valuesClause'] = values
+
+    def subSelect(self):
+        res = CompValue('SubSelect')
+        self.selectClause(res)
+        self.whereClause(res)
+        self.solutionModifier(res)
+        self.valuesClause(res)
+        return res
+
+    def selectQuery(self):
+        res = CompValue('SelectQuery')
+        self.selectClause(res)
+        self.datasetClauses(res)
+        self.whereClause(res)
+        self.solutionModifier(res)
+        self.valuesClause(res)
+        return res
+
+    def constructQuery(self):
+        self.expectKeyword('CONSTRUCT')
+        res = CompValue('ConstructQuery')
+        if self.accept('{'):
+            self.triplesBlock(res, 'template', False)
+            self.expect('}')
+            self.datasetClauses(res)
+            self.whereClause(res)
+        else:
+            self.datasetClauses(res)
+            self.expectKeyword('WHERE')
+            self.expect('{')
+            block = CompValue('TriplesBlock')
+            if self.triplesBlock(block, 'triples', False):
+                where = CompValue('FakeGroupGraphPatten')
+                _add(where, 'part', block)
+                res['where'] = where
+            self.expect('}')
+        self.solutionModifier(res)
+        self.valuesClause(res)
+        return res
+
+    def askQuery(self):
+        self.expectKeyword('ASK')
+        res = CompValue('AskQuery')
+        self.datasetClauseParam(res)
+        self.whereClause(res)
+        self.solutionModifier(res)
+        self.valuesClause(res)
+        return res
+
+    def describeQuery(self):
+        self.expectKeyword('DESCRIBE')
+        res = CompValue('DescribeQuery')
+        if not self.accept('*'):
+            v = self.varOrIri()
+            if v is None:
+                self.error('Var or iri')
+            while v is not None:
+                _add(res, 'var', v)
+                v = self.varOrIri()
+        self.datasetClauseParam(res)
+        self.skip()
+        if self.keyword() == 'WHERE' or self.s.startswith('{', self.pos):
+            self.whereClause(res)
+        self.solutionModifier(res)
+        self.valuesClause(res)
+        return res
+
+    def query(self):
+        prologue = self.prologue()
+        k = self.keyword()
+        if k == 'SELECT':
+            res = self.selectQuery()
+        elif k == 'CONSTRUCT':
+            res = self.constructQuery()
+        elif k == 'DESCRIBE':
+            res = self.describeQuery()
+        elif k == 'ASK':
+            res = self.askQuery()
+        else:
+            self.error('query')
+        self.end()
+        return ParseResults([prologue, res])
+
+    # ------ UPDATES
+
+    def silent(self, res):
+        if self.acceptKeyword('SILENT'):
+            res['silent'] = 'SILENT'
+
+    def graphRef(self, res):
+        self.expectKeyword('GRAPH')
+        res['graphiri'] = self.expectIri()
+
+    def graphRefAll(self, res):
+        k = self.acceptKeyword('DEFAULT', 'NAMED', 'ALL')
+        if k:
+            res['graphiri'] = k
+        else:
+            self.graphRef(res)
+
+    def graphOrDefault(self, res):
+        if self.acceptKeyword('DEFAULT'):
+            _add(res, 'graph', 'DEFAULT')
+        else:
+            self.acceptKeyword('GRAPH')
+            _add(res, 'graph', self.expectIri())
+
+    def quads(self):
+        """
+        '{' Quads '}', as Quads CompValue
+        """
+        self.expect('{')
+        res = CompValue('Quads')
+        self.triplesBlock(res, 'triples', False)
+        while self.acceptKeyword('GRAPH'):
+            q = CompValue('QuadsNotTriples')
+            q['term'] = self.expectVarOrIri()
+            self.expect('{')
+            self.triplesBlock(q, 'triples', False)
+            self.expect('}')
+            _add(res, 'quadsNotTriples', q)
+            self.accept('.')
+            self.triplesBlock(res, 'triples', False)
+        self.expect('}')
+        return res
+
+    def update1(self):
+        """
+        A single update operation, None if there is none
+        """
+        k = self.keyword()
+        if k in ('LOAD', 'CLEAR', 'DROP', 'CREATE', 'ADD', 'MOVE', 'COPY'):
+            self.take(self._peeked[1])
+            res = CompValue(k.capitalize())
+            self.silent(res)
+            if k == 'LOAD':
+                res['iri'] = self.expectIri()
+                if self.acceptKeyword('INTO'):
+                    self.graphRef(res)
+            elif k == 'CREATE':
+                self.graphRef(res)
+            elif k in ('CLEAR', 'DROP'):
+                self.graphRefAll(res)
+            else:
+                self.graphOrDefault(res)
+                self.expectKeyword('TO')
+                self.graphOrDefault(res)
+            return res
+
+        if k in ('INSERT', 'DELETE'):
+            pos = self.pos
+            self.take(self._peeked[1])
+            k2 = self.acceptKeyword('DATA', 'WHERE')
+            if k2 == 'DATA':
+                res = CompValue(k.capitalize() + 'Data')
+                res['quads'] = self.quads()
+                return res
+            if k2 == 'WHERE' and k == 'DELETE':
+                res = CompValue('DeleteWhere')
+                res['quads'] = self.quads()
+                return res
+            self.pos = pos
+        elif k != 'WITH':
+            return None
+
+        res = CompValue('Modify')
+        if self.acceptKeyword('WITH'):
+            res['withClause'] = self.expectIri()
+        if self.acceptKeyword('DELETE'):
+            res['delete'] = CompValue('DeleteClause')
+            res['delete']['quads'] = self.quads()
+        if self.acceptKeyword('INSERT'):
+            res['insert'] = CompValue('InsertClause')
+            res['insert']['quads'] = self.quads()
+        if 'delete' not in res and 'insert' not in res:
+            self.error('DELETE or INSERT')
+        while self.acceptKeyword('USING'):
+            using = CompValue('UsingClause')
+            if self.acceptKeyword('NAMED'):
+                using['named'] = self.expectIri()
+            else:
+                using['default'] = self.expectIri()
+            _add(res, 'using', using)
+        self.expectKeyword('WHERE')
+        res['where'] = self.groupGraphPattern()
+        return res
+
+    def update(self):
+        res = CompValue('Update')
+        while True:
+            _add(res, 'prologue', self.prologue())
+            request = self.update1()
+            if request is None:
+                break
+            _add(res, 'request', request)
+            if not self.accept(';'):
+                break
+        self.end()
+        return res
+
+
+def parseQuery(q):
+    if hasattr(q, 'read'):
+        q = q.read()
+    q = expandUnicodeEscapes(q)
+    return Parser(q).query()
+
+
+def parseUpdate(q):
+    if hasattr(q, 'read'):
+        q = q.read()
+    q = expandUnicodeEscapes(q)
+    return Parser(q).update()
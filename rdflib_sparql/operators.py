@@ -2,7 +2,8 @@
 This contains evaluation functions for expressions
 
 They get bound as instances-methods to the CompValue objects from parserutils
-using setEvalFn
+using setEvalFn, and are called with the expression and the context.
+They evaluate the parameters they need with value(ctx, ...)
 
 """
 
@@ -19,7 +20,7 @@ import operator as pyop  # python operators
 
 import isodate
 
-from rdflib_sparql.parserutils import CompValue, Expr
+from rdflib_sparql.parserutils import CompValue, Expr, value
 from rdflib_sparql.datatypes import XSD_DTs, type_promotion
 from rdflib import URIRef, BNode, Variable, Literal, XSD, RDF
 from rdflib.term import Node
@@ -38,7 +39,7 @@ def Builtin_IRI(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-iri
     """
 
-    a = expr.arg
+    a = value(ctx, expr.arg)
 
     if isinstance(a, URIRef):
         return a
@@ -49,20 +50,20 @@ def Builtin_IRI(expr, ctx):
 
 
 def Builtin_isBLANK(expr, ctx):
-    return Literal(isinstance(expr.arg, BNode))
+    return Literal(isinstance(value(ctx, expr.arg), BNode))
 
 
 def Builtin_isLITERAL(expr, ctx):
-    return Literal(isinstance(expr.arg, Literal))
+    return Literal(isinstance(value(ctx, expr.arg), Literal))
 
 
 def Builtin_isIRI(expr, ctx):
-    return Literal(isinstance(expr.arg, URIRef))
+    return Literal(isinstance(value(ctx, expr.arg), URIRef))
 
 
 def Builtin_isNUMERIC(expr, ctx):
     try:
-        numeric(expr.arg)
+        numeric(value(ctx, expr.arg))
         return Literal(True)
     except:
         return Literal(False)
@@ -73,7 +74,7 @@ def Builtin_BNODE(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-bnode
     """
 
-    a = expr.arg
+    a = value(ctx, expr.arg)
 
     if a is None:
         return BNode()
@@ -90,7 +91,7 @@ def Builtin_ABS(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-abs
     """
 
-    return Literal(abs(numeric(expr.arg)))
+    return Literal(abs(numeric(value(ctx, expr.arg))))
 
 
 def Builtin_IF(expr, ctx):
@@ -98,7 +99,9 @@ def Builtin_IF(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-if
     """
 
-    return expr.arg2 if EBV(expr.arg1) else expr.arg3
+    if EBV(value(ctx, expr.arg1)):
+        return value(ctx, expr.arg2)
+    return value(ctx, expr.arg3)
 
 
 def Builtin_RAND(expr, ctx):
@@ -126,27 +129,27 @@ def Builtin_STRUUID(expr, ctx):
 
 
 def Builtin_MD5(expr, ctx):
-    s = string(expr.arg).encode("utf-8")
+    s = string(value(ctx, expr.arg)).encode("utf-8")
     return Literal(hashlib.md5(s).hexdigest())
 
 
 def Builtin_SHA1(expr, ctx):
-    s = string(expr.arg).encode("utf-8")
+    s = string(value(ctx, expr.arg)).encode("utf-8")
     return Literal(hashlib.sha1(s).hexdigest())
 
 
 def Builtin_SHA256(expr, ctx):
-    s = string(expr.arg).encode("utf-8")
+    s = string(value(ctx, expr.arg)).encode("utf-8")
     return Literal(hashlib.sha256(s).hexdigest())
 
 
 def Builtin_SHA384(expr, ctx):
-    s = string(expr.arg).encode("utf-8")
+    s = string(value(ctx, expr.arg)).encode("utf-8")
     return Literal(hashlib.sha384(s).hexdigest())
 
 
 def Builtin_SHA512(expr, ctx):
-    s = string(expr.arg).encode("utf-8")
+    s = string(value(ctx, expr.arg)).encode("utf-8")
     return Literal(hashlib.sha512(s).hexdigest())
 
 
@@ -154,7 +157,7 @@ def Builtin_COALESCE(expr, ctx):
     """
     http://www.w3.org/TR/sparql11-query/#func-coalesce
     """
-    for x in expr.get('arg', variables=True):
+    for x in value(ctx, expr.arg, variables=True):
         if x is not None and not isinstance(x, (SPARQLError, Variable)):
             return x
     raise SPARQLError(
@@ -166,7 +169,7 @@ def Builtin_CEIL(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-ceil
     """
 
-    l = expr.arg
+    l = value(ctx, expr.arg)
     return Literal(int(math.ceil(numeric(l))), datatype=l.datatype)
 
 
@@ -174,7 +177,7 @@ def Builtin_FLOOR(expr, ctx):
     """
     http://www.w3.org/TR/sparql11-query/#func-floor
     """
-    l = expr.arg
+    l = value(ctx, expr.arg)
     return Literal(int(math.floor(numeric(l))), datatype=l.datatype)
 
 
@@ -187,7 +190,7 @@ def Builtin_ROUND(expr, ctx):
     # but in py3k bound was changed to
     # "round-to-even" behaviour
     # this is an ugly work-around
-    l = expr.arg
+    l = value(ctx, expr.arg)
     v = numeric(l)
     v = int(Decimal(v).quantize(1, ROUND_HALF_UP))
     return Literal(v, datatype=l.datatype)
@@ -201,9 +204,9 @@ def Builtin_REGEX(expr, ctx):
     Functions and Operators section 7.6.1 Regular Expression Syntax
     """
 
-    text = string(expr.text)
-    pattern = string(expr.pattern)
-    flags = expr.flags
+    text = string(value(ctx, expr.text))
+    pattern = string(value(ctx, expr.pattern))
+    flags = value(ctx, expr.flags)
 
     cFlag = 0
     if flags:
@@ -220,10 +223,10 @@ def Builtin_REPLACE(expr, ctx):
     """
     http://www.w3.org/TR/sparql11-query/#func-substr
     """
-    text = string(expr.arg)
-    pattern = string(expr.pattern)
-    replacement = string(expr.replacement)
-    flags = expr.flags
+    text = string(value(ctx, expr.arg))
+    pattern = string(value(ctx, expr.pattern))
+    replacement = string(value(ctx, expr.replacement))
+    flags = value(ctx, expr.flags)
 
     # python uses \1, xpath/sparql uses $1
     replacement = re.sub('\\$([0-9]*)', r'\\\1', replacement)
@@ -268,7 +271,8 @@ def Builtin_STRDT(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strdt
     """
 
-    return Literal(unicode(expr.arg1), datatype=expr.arg2)
+    return Literal(unicode(value(ctx, expr.arg1)),
+                   datatype=value(ctx, expr.arg2))
 
 
 def Builtin_STRLANG(expr, ctx):
@@ -276,13 +280,13 @@ def Builtin_STRLANG(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strlang
     """
 
-    s = string(expr.arg1)
+    s = string(value(ctx, expr.arg1))
     if s.language or s.datatype:
         raise SPARQLError('STRLANG expects a simple literal')
 
     # TODO: normalisation of lang tag to lower-case
     # should probably happen in literal __init__
-    return Literal(unicode(s), lang=str(expr.arg2).lower())
+    return Literal(unicode(s), lang=str(value(ctx, expr.arg2)).lower())
 
 
 def Builtin_CONCAT(expr, ctx):
@@ -292,14 +296,16 @@ def Builtin_CONCAT(expr, ctx):
 
     # dt/lang passed on only if they all match
 
-    dt = set(x.datatype for x in expr.arg)
+    args = value(ctx, expr.arg)
+
+    dt = set(x.datatype for x in args)
     dt = dt.pop() if len(dt) == 1 else None
 
-    lang = set(x.language for x in expr.arg)
+    lang = set(x.language for x in args)
     lang = lang.pop() if len(lang) == 1 else None
 
     return Literal("".join(string(x)
-                           for x in expr.arg), datatype=dt, lang=lang)
+                           for x in args), datatype=dt, lang=lang)
 
 
 def _compatibleStrings(a, b):
@@ -315,8 +321,8 @@ def Builtin_STRSTARTS(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strstarts
     """
 
-    a = expr.arg1
-    b = expr.arg2
+    a = value(ctx, expr.arg1)
+    b = value(ctx, expr.arg2)
     _compatibleStrings(a, b)
 
     return Literal(a.startswith(b))
@@ -326,8 +332,8 @@ def Builtin_STRENDS(expr, ctx):
     """
     http://www.w3.org/TR/sparql11-query/#func-strends
     """
-    a = expr.arg1
-    b = expr.arg2
+    a = value(ctx, expr.arg1)
+    b = value(ctx, expr.arg2)
 
     _compatibleStrings(a, b)
 
@@ -339,8 +345,8 @@ def Builtin_STRBEFORE(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strbefore
     """
 
-    a = expr.arg1
-    b = expr.arg2
+    a = value(ctx, expr.arg1)
+    b = value(ctx, expr.arg2)
     _compatibleStrings(a, b)
 
     i = a.find(b)
@@ -355,8 +361,8 @@ def Builtin_STRAFTER(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strafter
     """
 
-    a = expr.arg1
-    b = expr.arg2
+    a = value(ctx, expr.arg1)
+    b = value(ctx, expr.arg2)
     _compatibleStrings(a, b)
 
     i = a.find(b)
@@ -371,15 +377,16 @@ def Builtin_CONTAINS(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-strcontains
     """
 
-    a = expr.arg1
-    b = expr.arg2
+    a = value(ctx, expr.arg1)
+    b = value(ctx, expr.arg2)
     _compatibleStrings(a, b)
 
     return Literal(b in a)
 
 
 def Builtin_ENCODE_FOR_URI(expr, ctx):
-    return Literal(urllib2.quote(string(expr.arg).encode("utf-8")))
+    s = string(value(ctx, expr.arg)).encode("utf-8")
+    return Literal(urllib2.quote(s))
 
 
 def Builtin_SUBSTR(expr, ctx):
@@ -387,11 +394,11 @@ def Builtin_SUBSTR(expr, ctx):
     http://www.w3.org/TR/sparql11-query/#func-substr
     """
 
-    a = string(expr.arg)
+    a = string(value(ctx, expr.arg))
 
-    start = numeric(expr.start) - 1
+    start = numeric(value(ctx, expr.start)) - 1
 
-    length = expr.length
+    length = value(ctx, expr.length)
     if length is not None:
         length = numeric(length) + start
 
@@ -399,19 +406,19 @@ def Builtin_SUBSTR(expr, ctx):
 
 
 def Builtin_STRLEN(e, ctx):
-    l = string(e.arg)
+    l = string(value(ctx, e.arg))
 
     return Literal(len(l))
 
 
 def Builtin_STR(e, ctx):
-    arg = e.arg
+    arg = value(ctx, e.arg)
 
     return Literal(unicode(arg))  # plain literal
 
 
 def Builtin_LCASE(e, ctx):
-    l = string(e.arg)
+    l = string(value(ctx, e.arg))
 
     return Literal(l.lower(), datatype=l.datatype, lang=l.language)
 
@@ -422,8 +429,8 @@ def Builtin_LANGMATCHES(e, ctx):
 
 
     """
-    langTag = string(e.arg1)
-    langRange = string(e.arg2)
+    langTag = string(value(ctx, e.arg1))
+    langRange = string(value(ctx, e.arg2))
 
     if unicode(langTag) == "":
         return Literal(False)  # nothing matches empty!
@@ -436,32 +443,32 @@ def Builtin_NOW(e, ctx):
 
 
 def Builtin_YEAR(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.year)
 
 
 def Builtin_MONTH(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.month)
 
 
 def Builtin_DAY(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.day)
 
 
 def Builtin_HOURS(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.hour)
 
 
 def Builtin_MINUTES(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.minute)
 
 
 def Builtin_SECONDS(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     return Literal(d.second, datatype=XSD.decimal)
 
 
@@ -470,7 +477,7 @@ def Builtin_TIMEZONE(e, ctx):
     Returns the timezone part of arg as an xsd:dayTimeDuration.
     Raises an error if there is no timezone.
     """
-    dt = datetime(e.arg)
+    dt = datetime(value(ctx, e.arg))
     if not dt.tzinfo:
         raise SPARQLError('datatime has no timezone: %s' % dt)
 
@@ -499,7 +506,7 @@ def Builtin_TIMEZONE(e, ctx):
 
 
 def Builtin_TZ(e, ctx):
-    d = datetime(e.arg)
+    d = datetime(value(ctx, e.arg))
     if not d.tzinfo:
         return Literal("")
     n = d.tzinfo.tzname(d)
@@ -509,7 +516,7 @@ def Builtin_TZ(e, ctx):
 
 
 def Builtin_UCASE(e, ctx):
-    l = string(e.arg)
+    l = string(value(ctx, e.arg))
 
     return Literal(l.upper(), datatype=l.datatype, lang=l.language)
 
@@ -524,12 +531,12 @@ def Builtin_LANG(e, ctx):
     with an empty language tag.
     """
 
-    l = literal(e.arg)
+    l = literal(value(ctx, e.arg))
     return Literal(l.language or "")
 
 
 def Builtin_DATATYPE(e, ctx):
-    l = e.arg
+    l = value(ctx, e.arg)
     if not isinstance(l, Literal):
         raise SPARQLError('Can only get datatype of literal: %s' % l)
     if l.language:
@@ -540,8 +547,8 @@ def Builtin_DATATYPE(e, ctx):
 
 
 def Builtin_sameTerm(e, ctx):
-    a = e.arg1
-    b = e.arg2
+    a = value(ctx, e.arg1)
+    b = value(ctx, e.arg2)
     return Literal(a == b)
 
 
@@ -549,7 +556,7 @@ def Builtin_BOUND(e, ctx):
     """
     http://www.w3.org/TR/sparql11-query/#func-bound
     """
-    n = e.get('arg', variables=True)
+    n = value(ctx, e.arg, variables=True)
 
     return Literal(not isinstance(n, Variable))
 
@@ -574,12 +581,13 @@ def Function(e, ctx):
     if e.iri in XSD_DTs:
         # a cast
 
-        if not e.expr:
+        args = value(ctx, e.expr)
+        if not args:
             raise SPARQLError("Nothing given to cast.")
-        if len(e.expr) > 1:
+        if len(args) > 1:
             raise SPARQLError("Cannot cast more than one thing!")
 
-        x = e.expr[0]
+        x = args[0]
 
         if e.iri == XSD.string:
 
@@ -650,21 +658,21 @@ def Function(e, ctx):
 
 
 def UnaryNot(expr, ctx):
-    return Literal(not EBV(expr.expr))
+    return Literal(not EBV(value(ctx, expr.expr)))
 
 
 def UnaryMinus(expr, ctx):
-    return Literal(-numeric(expr.expr))
+    return Literal(-numeric(value(ctx, expr.expr)))
 
 
 def UnaryPlus(expr, ctx):
-    return Literal(+numeric(expr.expr))
+    return Literal(+numeric(value(ctx, expr.expr)))
 
 
 def MultiplicativeExpression(e, ctx):
 
-    expr = e.expr
-    other = e.other
+    expr = value(ctx, e.expr)
+    other = value(ctx, e.other)
 
     # because of the way the mul-expr production handled operator precedence
     # we sometimes have nothing to do
@@ -690,8 +698,8 @@ def MultiplicativeExpression(e, ctx):
 
 def AdditiveExpression(e, ctx):
 
-    expr = e.expr
-    other = e.other
+    expr = value(ctx, e.expr)
+    other = value(ctx, e.other)
 
     # because of the way the add-expr production handled operator precedence
     # we sometimes have nothing to do
@@ -721,8 +729,8 @@ def AdditiveExpression(e, ctx):
 
 def RelationalExpression(e, ctx):
 
-    expr = e.expr
-    other = e.other
+    expr = value(ctx, e.expr)
+    other = value(ctx, e.other)
     op = e.op
 
     # because of the way the add-expr production handled operator precedence
@@ -795,8 +803,8 @@ def ConditionalAndExpression(e, ctx):
 
     # TODO: handle returned errors
 
-    expr = e.expr
-    other = e.other
+    expr = value(ctx, e.expr)
+    other = value(ctx, e.other)
 
     # because of the way the add-expr production handled operator precedence
     # we sometimes have nothing to do
@@ -810,8 +818,8 @@ def ConditionalOrExpression(e, ctx):
 
     # TODO: handle errors
 
-    expr = e.expr
-    other = e.other
+    expr = value(ctx, e.expr)
+    other = value(ctx, e.other)
 
     # because of the way the add-expr production handled operator precedence
     # we sometimes have nothing to do
@@ -843,7 +851,11 @@ def and_(*args):
     return Expr('ConditionalAndExpression', ConditionalAndExpression,
                 expr=args[0], other=list(args[1:]))
 
-TrueFilter = Expr('TrueFilter', lambda _1, _2: Literal(True))
+
+def _true(expr, ctx):
+    return Literal(True)
+
+TrueFilter = Expr('TrueFilter', _true)
 
 
 def simplify(expr):
@@ -894,6 +906,15 @@ def string(s):
     return s
 
 
+_NUMERIC_TYPES = frozenset([XSD.float, XSD.double,
+                             XSD.decimal, XSD.integer,
+                             XSD.nonPositiveInteger, XSD.negativeInteger,
+                             XSD.nonNegativeInteger, XSD.positiveInteger,
+                             XSD.unsignedLong, XSD.unsignedInt,
+                             XSD.unsignedShort, XSD.unsignedByte,
+                             XSD.long, XSD.int, XSD.short, XSD.byte])
+
+
 def numeric(expr):
     """
     return a number from a literal
@@ -905,13 +926,7 @@ def numeric(expr):
     if not isinstance(expr, Literal):
         raise SPARQLTypeError("%s is not a literal!" % expr)
 
-    if expr.datatype not in (XSD.float, XSD.double,
-                             XSD.decimal, XSD.integer,
-                             XSD.nonPositiveInteger, XSD.negativeInteger,
-                             XSD.nonNegativeInteger, XSD.positiveInteger,
-                             XSD.unsignedLong, XSD.unsignedInt,
-                             XSD.unsignedShort, XSD.unsignedByte,
-                             XSD.long, XSD.int, XSD.short, XSD.byte):
+    if expr.datatype not in _NUMERIC_TYPES:
         raise SPARQLTypeError("%s does not have a numeric datatype!" % expr)
 
     return expr.toPython()
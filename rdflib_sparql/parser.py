@@ -1,15 +1,17 @@
 import sys
 import re
+import threading
 
 from pyparsing import (
-    Literal, Regex, Optional, OneOrMore, ZeroOrMore, Forward,
+    Literal, Optional, OneOrMore, ZeroOrMore, Forward,
     ParseException, Suppress, Combine, restOfLine, Group,
     ParseResults, delimitedList)
 from pyparsing import CaselessKeyword as Keyword  # watch out :)
 #from pyparsing import Keyword as CaseSensitiveKeyword
 
-from parserutils import Comp, Param, ParamList
+from parserutils import Comp, Param, ParamList, CompValue, Regex, Terms
 
+import rdflib_sparql
 import rdflib_sparql.operators as op
 from rdflib_sparql.py3compat import decodeStringEscape
 
@@ -17,6 +19,34 @@ import rdflib
 
 DEBUG = False
 
+# the terms of the request this thread is parsing, pyparsing parse
+# actions cannot be given any state
+_state = threading.local()
+
+
+def _term(cls, value, datatype=None):
+    """
+    The term for a value in the request being parsed, equal terms are
+    shared while parseQuery or parseUpdate parses it
+    """
+    terms = getattr(_state, 'terms', None)
+    if terms is None:
+        if datatype is None:
+            return cls(value)
+        return cls(value, datatype=datatype)
+    return terms.term(cls, value, datatype)
+
+
+def _parse(element, q):
+    """
+    Parse all of q with the grammar element, sharing equal terms
+    """
+    _state.terms = Terms()
+    try:
+        return element.parseString(q, parseAll=True)
+    finally:
+        _state.terms = None
+
 # ---------------- ACTIONS
 
 
@@ -32,6 +62,27 @@ def setDataType(terms):
     return rdflib.Literal(terms[0], datatype=terms[1])
 
 
+PathModRange_re = r'\{\s*([0-9]+)?\s*(,)?\s*([0-9]+)?\s*\}'
+
+
+def pathModRange(instring, loc, terms):
+    """
+    Turn {n,m}, {n}, {n,} and {,m} into a (min, max) tuple
+    """
+    m = re.match(PathModRange_re, terms[0])
+    n, comma, mx = m.groups()
+    if n is None and mx is None:
+        raise ParseException(instring, loc, 'Empty path repetition range')
+    n = int(n) if n is not None else 0
+    if comma:
+        mx = int(mx) if mx is not None else None
+    else:
+        mx = n
+    if mx is not None and mx < n:
+        raise ParseException(instring, loc, 'Invalid path repetition range')
+    return (n, mx)
+
+
 def expandTriples(terms):
 
     """
@@ -44,7 +95,10 @@ def expandTriples(terms):
             print "Terms", terms
         l = len(terms)
         for i, t in enumerate(terms):
-            if t == ',':
+            if isinstance(t, CompValue):
+                # never equal to the tokens below, but slow to compare
+                res.append(t)
+            elif t == ',':
                 res.append(res[i - 3])
                 res.append(res[i - 2])
             elif t == ';':
@@ -121,7 +175,7 @@ def expandCollection(terms):
 # [139] IRIREF ::= '<' ([^<>"{}|^`\]-[#x00-#x20])* '>'
 IRIREF = Combine(Suppress('<') + Regex(r'[^<>"{}|^`\\%s]*' % ''.join(
     '\\x%02X' % i for i in range(33))) + Suppress('>'))
-IRIREF.setParseAction(lambda x: rdflib.URIRef(x[0]))
+IRIREF.setParseAction(lambda x: _term(rdflib.URIRef, x[0]))
 
 # [164] P_CHARS_BASE ::= [A-Z] | [a-z] | [#x00C0-#x00D6] | [#x00D8-#x00F6] | [#x00F8-#x02FF] | [#x0370-#x037D] | [#x037F-#x1FFF] | [#x200C-#x200D] | [#x2070-#x218F] | [#x2C00-#x2FEF] | [#x3001-#xD7FF] | [#xF900-#xFDCF] | [#xFDF0-#xFFFD] | [#x10000-#xEFFFF]
 
@@ -207,7 +261,7 @@ LANGTAG = Combine(Suppress('@') + Regex('[a-zA-Z]+(?:-[a-zA-Z0-9]+)*'))
 INTEGER = Regex(r"[0-9]+")
 #INTEGER.setResultsName('integer')
 INTEGER.setParseAction(
-    lambda x: rdflib.Literal(x[0], datatype=rdflib.XSD.integer))
+    lambda x: _term(rdflib.Literal, x[0], rdflib.XSD.integer))
 
 # [155] EXPONENT ::= [eE] [+-]? [0-9]+
 EXPONENT_re = '[eE][+-]?[0-9]+'
@@ -216,19 +270,20 @@ EXPONENT_re = '[eE][+-]?[0-9]+'
 DECIMAL = Regex(r'[0-9]*\.[0-9]+')  # (?![eE])
 #DECIMAL.setResultsName('decimal')
 DECIMAL.setParseAction(
-    lambda x: rdflib.Literal(x[0], datatype=rdflib.XSD.decimal))
+    lambda x: _term(rdflib.Literal, x[0], rdflib.XSD.decimal))
 
 # [148] DOUBLE ::= [0-9]+ '.' [0-9]* EXPONENT | '.' ([0-9])+ EXPONENT | ([0-9])+ EXPONENT
 DOUBLE = Regex(
     r'[0-9]+\.[0-9]*%(e)s|\.([0-9])+%(e)s|[0-9]+%(e)s' % {'e': EXPONENT_re})
 #DOUBLE.setResultsName('double')
 DOUBLE.setParseAction(
-    lambda x: rdflib.Literal(x[0], datatype=rdflib.XSD.double))
+    lambda x: _term(rdflib.Literal, x[0], rdflib.XSD.double))
 
 
 # [149] INTEGER_POSITIVE ::= '+' INTEGER
 INTEGER_POSITIVE = Suppress('+') + INTEGER.copy().leaveWhitespace()
-INTEGER_POSITIVE.setParseAction(lambda x: rdflib.Literal("+"+x[0], datatype=rdflib.XSD.integer))
+INTEGER_POSITIVE.setParseAction(
+    lambda x: _term(rdflib.Literal, "+" + x[0], rdflib.XSD.integer))
 
 # [150] DECIMAL_POSITIVE ::= '+' DECIMAL
 DECIMAL_POSITIVE = Suppress('+') + DECIMAL.copy().leaveWhitespace()
@@ -256,13 +311,13 @@ DOUBLE_NEGATIVE.setParseAction(lambda x: neg(x[0]))
 #STRING_LITERAL_LONG1 = Literal("'''") + ( Optional( Literal("'") | "''" ) + ZeroOrMore( ~ Literal("'\\") | ECHAR ) ) + "'''"
 STRING_LITERAL_LONG1 = Regex(ur"'''((?:'|'')?(?:[^'\\]|\\['ntbrf\\]))*'''")
 STRING_LITERAL_LONG1.setParseAction(
-    lambda x: rdflib.Literal(decodeStringEscape(x[0][3:-3])))
+    lambda x: _term(rdflib.Literal, decodeStringEscape(x[0][3:-3])))
 
 # [159] STRING_LITERAL_LONG2 ::= '"""' ( ( '"' | '""' )? ( [^"\] | ECHAR ) )* '"""'
 #STRING_LITERAL_LONG2 = Literal('"""') + ( Optional( Literal('"') | '""' ) + ZeroOrMore( ~ Literal('"\\') | ECHAR ) ) +  '"""'
 STRING_LITERAL_LONG2 = Regex(ur'"""(?:(?:"|"")?(?:[^"\\]|\\["ntbrf\\]))*"""')
 STRING_LITERAL_LONG2.setParseAction(
-    lambda x: rdflib.Literal(decodeStringEscape(x[0][3:-3])))
+    lambda x: _term(rdflib.Literal, decodeStringEscape(x[0][3:-3])))
 
 # [156] STRING_LITERAL1 ::= "'" ( ([^#x27#x5C#xA#xD]) | ECHAR )* "'"
 #STRING_LITERAL1 = Literal("'") + ZeroOrMore( Regex(u'[^\u0027\u005C\u000A\u000D]',flags=re.U) | ECHAR ) + "'"
@@ -270,7 +325,7 @@ STRING_LITERAL_LONG2.setParseAction(
 STRING_LITERAL1 = Regex(
     ur"'(?:[^'\n\r\\]|\\['ntbrf\\])*'(?!')", flags=re.U)
 STRING_LITERAL1.setParseAction(
-    lambda x: rdflib.Literal(decodeStringEscape(x[0][1:-1])))
+    lambda x: _term(rdflib.Literal, decodeStringEscape(x[0][1:-1])))
 
 # [157] STRING_LITERAL2 ::= '"' ( ([^#x22#x5C#xA#xD]) | ECHAR )* '"'
 #STRING_LITERAL2 = Literal('"') + ZeroOrMore ( Regex(u'[^\u0022\u005C\u000A\u000D]',flags=re.U) | ECHAR ) + '"'
@@ -278,7 +333,7 @@ STRING_LITERAL1.setParseAction(
 STRING_LITERAL2 = Regex(
     ur'"(?:[^"\n\r\\]|\\["ntbrf\\])*"(?!")', flags=re.U)
 STRING_LITERAL2.setParseAction(
-    lambda x: rdflib.Literal(decodeStringEscape(x[0][1:-1])))
+    lambda x: _term(rdflib.Literal, decodeStringEscape(x[0][1:-1])))
 
 # [161] NIL ::= '(' WS* ')'
 NIL = Literal('(') + ')'
@@ -310,7 +365,7 @@ Prologue = Group(ZeroOrMore(BaseDecl | PrefixDecl))
 
 # [108] Var ::= VAR1 | VAR2
 Var = VAR1 | VAR2
-Var.setParseAction(lambda x: rdflib.term.Variable(x[0]))
+Var.setParseAction(lambda x: _term(rdflib.term.Variable, x[0]))
 
 # [137] PrefixedName ::= PNAME_LN | PNAME_NS
 PrefixedName = Comp('pname', PNAME_LN | PNAME_NS)
@@ -390,10 +445,15 @@ GraphNodePath = VarOrTerm | TriplesNodePath
 
 
 # [93] PathMod ::= '?' | '*' | '+'
-PathMod = Literal('?') | '*' | '+'
+# plus the repetition ranges from the SPARQL 1.1 working drafts:
+# '{' ( Integer ( ',' ( '}' | Integer '}' ) | '}' ) | ',' Integer '}' )
+PathModRange = Regex(PathModRange_re)
+PathModRange.setParseAction(pathModRange)
+
+PathMod = Literal('?') | '*' | '+' | PathModRange
 
 # [96] PathOneInPropertySet ::= iri | A | '^' ( iri | A )
-PathOneInPropertySet = iri | A | Comp('InversePath', '^' + (iri | A))
+PathOneInPropertySet = iri | A | Comp('InversePath', '^' + Param('part', iri | A))
 
 Path = Forward()
 
@@ -984,17 +1044,140 @@ def expandUnicodeEscapes(q):
 
 
 def parseQuery(q):
+    if rdflib_sparql.SPARQL_FAST_PARSER:
+        from rdflib_sparql import fastparser
+        return fastparser.parseQuery(q)
     if hasattr(q, 'read'):
         q = q.read()
     q = expandUnicodeEscapes(q)
-    return Query.parseString(q, parseAll=True)
+    return _parse(Query, q)
 
 
 def parseUpdate(q):
+    if rdflib_sparql.SPARQL_FAST_PARSER:
+        from rdflib_sparql import fastparser
+        return fastparser.parseUpdate(q)
     if hasattr(q, 'read'):
         q = q.read()
     q = expandUnicodeEscapes(q)
-    return UpdateUnit.parseString(q, parseAll=True)[0]
+    return _parse(UpdateUnit, q)[0]
+
+
+# the size of the parts of the request read at a time by splitUpdate
+UPDATE_CHUNK_SIZE = 65536
+
+# where a string, IRI, comment or group may start or the operation end
+_UPDATE_SPECIAL = re.compile(r'["\'<#{};]')
+
+_UPDATE_TOKENS = {
+    '"': re.compile(r'"(?:[^"\\\n\r]|\\.)*"'),
+    "'": re.compile(r"'(?:[^'\\\n\r]|\\.)*'"),
+    '<': re.compile(r'<[^<>"{}|^`\\%s]*>' % ''.join(
+        '\\x%02X' % i for i in range(33))),
+    '#': re.compile(r'#[^\n]*'),
+}
+
+_UPDATE_LONG_STRINGS = {
+    '"': re.compile(r'"""(?:(?:"|"")?(?:[^"\\]|\\.))*"""', re.S),
+    "'": re.compile(r"'''(?:(?:'|'')?(?:[^'\\]|\\.))*'''", re.S),
+}
+
+
+def splitUpdate(f, chunkSize=UPDATE_CHUNK_SIZE):
+    """
+    Split the update request read from the file-like object f into
+    the texts of its operations (each with its prologue), the request
+    is only read as far as needed for the next operation
+
+    Operations end at a ; outside of groups, strings, IRIs and
+    comments. Whether < starts an IRI or is less-than can only be told
+    by the grammar, it is taken for an IRI if one follows, the parser
+    finds out if this split an operation in the wrong place.
+    """
+    s = f.read(chunkSize)
+    eof = not s
+    start = i = depth = 0
+    while True:
+        m = _UPDATE_SPECIAL.search(s, i)
+        if m is None:
+            i = len(s)
+        else:
+            i = m.start()
+            c = s[i]
+            if c == ';':
+                if depth == 0:
+                    yield s[start:i]
+                    start = i + 1
+                i += 1
+                continue
+            if c == '{':
+                depth += 1
+                i += 1
+                continue
+            if c == '}':
+                depth -= 1
+                i += 1
+                continue
+            # only long strings span lines, the rest of the line
+            # must have been read
+            if eof or s.find('\n', i) != -1:
+                long = c in '"\'' and s.startswith(c * 3, i)
+                if long:
+                    m = _UPDATE_LONG_STRINGS[c].match(s, i)
+                else:
+                    m = _UPDATE_TOKENS[c].match(s, i)
+                if m is not None:
+                    i = m.end()
+                    continue
+                if eof or not long:
+                    i += 1  # not the start of a token after all
+                    continue
+
+        if eof:
+            yield s[start:]
+            return
+        # read at least as much again as the operation so far, so that
+        # large operations are not copied for every chunk
+        data = f.read(max(chunkSize, len(s) - start))
+        eof = not data
+        s = s[start:] + data
+        i -= start
+        start = 0
+
+
+def _parses(text):
+    try:
+        parseUpdate(text)
+        return True
+    except ParseException:
+        return False
+
+
+def parseUpdateStream(f, chunkSize=UPDATE_CHUNK_SIZE):
+    """
+    Parse the update request read from the file-like object f one
+    operation at a time, yields a parse-tree like that of parseUpdate
+    for each (with the prologue of that operation)
+    """
+    texts = splitUpdate(f, chunkSize)
+    empty = False
+    for text in texts:
+        if empty:
+            raise ParseException(text, 0, 'Expected update before ;')
+        while True:
+            try:
+                tree = parseUpdate(text)
+                break
+            except ParseException, e:
+                # not split between operations (i.e. at a \; in a
+                # prefixed name), or a syntax error if the next part
+                # is an operation of its own
+                following = next(texts, None)
+                if following is None or _parses(following):
+                    raise e
+                text += ';' + following
+        empty = not tree.request
+        yield tree
 
 
 if __name__ == '__main__':
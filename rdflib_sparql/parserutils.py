@@ -1,9 +1,11 @@
 
+import re
 from types import MethodType
 
 from rdflib_sparql.compat import OrderedDict
 
-from pyparsing import TokenConverter, ParseResults
+import pyparsing
+from pyparsing import TokenConverter, ParseResults, ParseException
 
 from rdflib import BNode, Variable, URIRef
 
@@ -58,9 +60,9 @@ def value(ctx, val, variables=False, errors=False):
 
     """
 
-    if isinstance(val, Expr):
+    if isinstance(val, (SlotExpr, Expr)):
         return val.eval(ctx)  # recurse?
-    elif isinstance(val, CompValue):
+    elif isinstance(val, (SlotValue, CompValue)):
         raise Exception("What do I do with this CompValue? %s" % val)
 
     elif isinstance(val, list):
@@ -133,6 +135,25 @@ class plist(list):
     pass
 
 
+class Terms(dict):
+    """
+    The terms of one request: equal IRIs, variables and literals
+    in it are parsed into one shared object
+    """
+
+    def term(self, cls, value, datatype=None):
+        key = (cls, value, datatype)
+        try:
+            return self[key]
+        except KeyError:
+            if datatype is None:
+                t = cls(value)
+            else:
+                t = cls(value, datatype=datatype)
+            self[key] = t
+            return t
+
+
 class CompValue(OrderedDict):
 
     """
@@ -140,6 +161,8 @@ class CompValue(OrderedDict):
     Any included Params are avaiable as Dict keys
     or as attributes
 
+    The translator replaces the CompValues of the algebra and
+    expressions with SlotValues
     """
 
     def __init__(self, name, **values):
@@ -153,24 +176,23 @@ class CompValue(OrderedDict):
     def __repr__(self):
         return self.name + "_" + dict.__repr__(self)
 
-    def _value(self, val, variables=False, errors=False):
-        if self.ctx is not None:
-            return value(self.ctx, val, variables)
-        else:
-            return val
+    def __reduce__(self):
+        # OrderedDict.__reduce__ would pass the items as name,
+        # they are set after creating the CompValue instead
+        state = dict((k, v) for k, v in vars(self).iteritems()
+                     if k != 'name' and not k.startswith('_OrderedDict'))
+        return self.__class__, (self.name,), state, None, self.iteritems()
 
-    def __getitem__(self, a):
-        return self._value(OrderedDict.__getitem__(self, a))
-
-    def get(self, a, variables=False, errors=False):
-        return self._value(OrderedDict.get(self, a, a), variables, errors)
+    def __setstate__(self, state):
+        # needed, as __getattr__ would return None for it
+        self.__dict__.update(state)
 
     def __getattr__(self, a):
         # Hack hack: OrderedDict relies on this
         if a in ('_OrderedDict__root', '_OrderedDict__end'):
             raise AttributeError
         try:
-            return self[a]
+            return dict.__getitem__(self, a)
         except KeyError:
             # raise AttributeError('no such attribute '+a)
             return None
@@ -179,6 +201,9 @@ class CompValue(OrderedDict):
 class Expr(CompValue):
     """
     A CompValue that is evaluatable
+
+    The evalfn is called with the Expr and the context, and
+    evaluates the parameters it needs with value
     """
 
     def __init__(self, name, evalfn=None, **values):
@@ -188,14 +213,141 @@ class Expr(CompValue):
         if evalfn:
             self._evalfn = MethodType(evalfn, self)
 
+    def __reduce__(self):
+        # bound methods cannot be pickled, the evalfn is bound again
+        cls, args, state, l, items = super(Expr, self).__reduce__()
+        del state['_evalfn']
+        evalfn = self._evalfn and self._evalfn.im_func
+        return cls, (self.name, evalfn), state, l, items
+
+    def eval(self, ctx={}):
+        try:
+            return self._evalfn(ctx)
+        except SPARQLError, e:
+            return e
+
+
+class SlotValue(object):
+
+    """
+    A translated algebra node, made from a CompValue
+
+    Its parameters are slots of a class made for the name and
+    parameters of the node, so reading one is a plain attribute
+    access and there is no dict per node. Reading any other
+    parameter gives None, like on a CompValue.
+
+    The parameters can also be read as items. They can be
+    replaced, but none can be added.
+    """
+
+    __slots__ = ()
+
+    name = None
+    # the names of the parameters, the other slots are
+    # attributes set on the CompValue by the translator
+    _fields = ()
+
+    def __getattr__(self, a):
+        if a.startswith('__'):
+            raise AttributeError(a)
+        return None
+
+    def __getitem__(self, k):
+        if k not in self._fields:
+            raise KeyError(k)
+        return getattr(self, k)
+
+    def __setitem__(self, k, v):
+        if k not in self._fields:
+            raise KeyError(k)
+        setattr(self, k, v)
+
+    def __contains__(self, k):
+        return k in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, k, default=None):
+        if k not in self._fields:
+            return default
+        return getattr(self, k)
+
+    def keys(self):
+        return list(self._fields)
+
+    def iterkeys(self):
+        return iter(self._fields)
+
+    def values(self):
+        return [getattr(self, k) for k in self._fields]
+
+    def itervalues(self):
+        return (getattr(self, k) for k in self._fields)
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self._fields]
+
+    def iteritems(self):
+        return ((k, getattr(self, k)) for k in self._fields)
+
+    def __str__(self):
+        return "%s_{%s}" % (self.name, ", ".join(
+            "%s: %s" % (k, v) for k, v in self.iteritems()))
+
+    __repr__ = __str__
+
+    def __reduce__(self):
+        return slotValue, (self.name, self._fields,
+                           self.__slots__[len(self._fields):],
+                           [getattr(self, k) for k in self.__slots__],
+                           vars(type(self)).get('_evalfn'))
+
+
+class SlotExpr(SlotValue):
+    """
+    A SlotValue that is evaluatable
+    """
+
+    __slots__ = ()
+
+    _evalfn = None
+
     def eval(self, ctx={}):
         try:
-            self.ctx = ctx
             return self._evalfn(ctx)
         except SPARQLError, e:
             return e
-        finally:
-            self.ctx = None
+
+
+_slotClasses = {}
+
+
+def slotValue(name, fields, attrs, values, evalfn=None):
+    """
+    Make a SlotValue (a SlotExpr if evalfn is given) with the
+    parameters fields and the attributes attrs set to values
+    """
+    key = (name, fields, attrs, evalfn)
+    cls = _slotClasses.get(key)
+    if cls is None:
+        base = SlotValue if evalfn is None else SlotExpr
+        for k in fields + attrs:
+            if hasattr(base, k):
+                raise ValueError('%s cannot be a slot of %s' % (k, name))
+        ns = {'__slots__': fields + attrs, 'name': name, '_fields': fields}
+        if evalfn is not None:
+            ns['_evalfn'] = evalfn
+        cls = _slotClasses[key] = type(str(name), (base,), ns)
+
+    node = cls.__new__(cls)
+    for k, v in zip(cls.__slots__, values):
+        setattr(node, k, v)
+    return node
 
 
 class Comp(TokenConverter):
@@ -238,6 +390,36 @@ class Comp(TokenConverter):
         return self
 
 
+_UNCOMPILED = re.compile('')
+
+
+class Regex(pyparsing.Regex):
+
+    """
+    A pyparsing Regex that compiles its pattern when it is first used.
+
+    Compiling the large unicode character classes of the SPARQL terminals
+    is most of the time taken to build the grammar, this way it is done
+    on the first parse rather than on import.
+    """
+
+    def __init__(self, pattern, flags=0):
+        # the base class is given an already compiled placeholder,
+        # so that it does not compile the pattern itself
+        pyparsing.Regex.__init__(self, _UNCOMPILED, flags)
+        self.pattern = self.reString = pattern
+        self.re = None
+        self.setName('Re:(%r)' % pattern)
+
+    def parseImpl(self, instring, loc, doActions=True):
+        if self.re is None:
+            self.re = re.compile(self.pattern, self.flags)
+        result = self.re.match(instring, loc)
+        if not result:
+            raise ParseException(instring, loc, self.errmsg, self)
+        return result.end(), result.group()
+
+
 if __name__ == '__main__':
     from pyparsing import Word, nums
     import sys
@@ -25,6 +25,11 @@ elt+        - A path that connects the subject and object of the path by one
 elt?        - A path that connects the subject and object of the path by zero
     or one matches of elt.
 
+elt{n,m}    - A path that connects the subject and object of the path by
+    between n and m matches of elt. elt{n} is exactly n matches, elt{n,} n
+    or more and elt{,m} at most m. (Not in the final SPARQL 1.1 spec, this
+    is from the earlier working drafts.)
+
 !iri or !(iri1| ...|irin) - Negated property set. An IRI which is not one of
     irii. !iri is short for !(iri).
 
@@ -64,6 +69,11 @@ defined as constants in this file
 >>> foaf.knows%OneOrMore
 Path(http://xmlns.com/foaf/0.1/knows+)
 
+Bounded repetition uses a tuple of (min, max), max may be None:
+
+>>> foaf.knows%(1,3)
+Path(http://xmlns.com/foaf/0.1/knows{1,3})
+
 The path objects can be used with the normal graph methods.
 
 First some example data:
@@ -110,6 +120,12 @@ True
 >>> list(evalPath(g, (e.c, e.p3%ZeroOrMore, None))) == [(e.c, e.c),
 ...     (e.c, e.g), (e.c, e.h), (e.c, e.a)]
 True
+>>> sorted(evalPath(g, (e.c, e.p3%(1,2), None))) == [(e.c, e.g), (e.c, e.h)]
+True
+>>> sorted(evalPath(g, (e.c, e.p3%(2,None), None))) == [(e.c, e.a), (e.c, e.h)]
+True
+>>> sorted(evalPath(g, (None, e.p3%(3,3), e.a))) == [(e.c, e.a)]
+True
 >>> list(evalPath(g, (e.a, -e.p1, None))) == [(e.a, e.f)]
 True
 >>> list(evalPath(g, (e.a, -(e.p1|e.p2), None))) == []
@@ -199,6 +215,11 @@ elt+        - A path that connects the subject and object of the path by one
 elt?        - A path that connects the subject and object of the path by zero
     or one matches of elt.
 
+elt{n,m}    - A path that connects the subject and object of the path by
+    between n and m matches of elt. elt{n} is exactly n matches, elt{n,} n
+    or more and elt{,m} at most m. (Not in the final SPARQL 1.1 spec, this
+    is from the earlier working drafts.)
+
 !iri or !(iri1| ...|irin) - Negated property set. An IRI which is not one of
     irii. !iri is short for !(iri).
 
@@ -238,6 +259,11 @@ defined as constants in this file
 >>> foaf.knows%OneOrMore
 Path(http://xmlns.com/foaf/0.1/knows+)
 
+Bounded repetition uses a tuple of (min, max), max may be None:
+
+>>> foaf.knows%(1,3)
+Path(http://xmlns.com/foaf/0.1/knows{1,3})
+
 The path objects can be used with the normal graph methods.
 
 First some example data:
@@ -284,6 +310,12 @@ True
 >>> list(evalPath(g, (e.c, e.p3%ZeroOrMore, None))) == [(e.c, e.c),
 ...     (e.c, e.g), (e.c, e.h), (e.c, e.a)]
 True
+>>> sorted(evalPath(g, (e.c, e.p3%(1,2), None))) == [(e.c, e.g), (e.c, e.h)]
+True
+>>> sorted(evalPath(g, (e.c, e.p3%(2,None), None))) == [(e.c, e.a), (e.c, e.h)]
+True
+>>> sorted(evalPath(g, (None, e.p3%(3,3), e.a))) == [(e.c, e.a)]
+True
 >>> list(evalPath(g, (e.a, -e.p1, None))) == [(e.a, e.f)]
 True
 >>> list(evalPath(g, (e.a, -(e.p1|e.p2), None))) == []
@@ -349,7 +381,12 @@ No vars specified
 """
 
 
+import collections
+
+from rdflib_sparql.compat import OrderedDict
+
 from rdflib import URIRef, Graph, ConjunctiveGraph, Namespace
+from rdflib.graph import QuotedGraph, ReadOnlyGraphAggregate
 
 DEBUG = True
 
@@ -364,12 +401,37 @@ class Path:
     def eval(self, graph, subj=None, obj=None):
         raise NotImplementedError()
 
+    def _key(self):
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return self.__class__ is getattr(other, '__class__', None) and \
+            self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__.__name__,) + self._key())
+
+    def evalMany(self, graph, subjs, obj=None):
+        """
+        Evaluate this path from each of the given start nodes,
+        subclasses override this to share work between the starts
+        """
+        for subj in subjs:
+            for s, o in self.eval(graph, subj, obj):
+                yield s, o
+
 
 class InvPath(Path):
 
     def __init__(self, arg):
         self.arg = arg
 
+    def _key(self):
+        return (self.arg,)
+
     def eval(self, graph, subj=None, obj=None):
         for s, o in evalPath(graph, (obj, self.arg, subj)):
             yield o, s
@@ -387,6 +449,9 @@ class SequencePath(Path):
             else:
                 self.args.append(a)
 
+    def _key(self):
+        return tuple(self.args)
+
     def eval(self, graph, subj=None, obj=None):
         def _eval_seq(paths, subj, obj):
             if paths[1:]:
@@ -415,6 +480,20 @@ class SequencePath(Path):
         else:  # no vars bound, we can start anywhere
             return _eval_seq(self.args, subj, obj)
 
+    def evalMany(self, graph, subjs, obj=None):
+        # walk the sequence one step at a time for all starts,
+        # each intermediate node is only expanded once
+        pairs = [(s, s) for s in subjs]
+        for i, p in enumerate(self.args):
+            last = i == len(self.args) - 1
+            reach = collections.defaultdict(list)
+            for s, o in evalPathMany(graph, set(o for s, o in pairs), p,
+                                     obj if last else None):
+                reach[s].append(o)
+            pairs = [(s, o2) for s, o in pairs for o2 in reach.get(o, ())]
+
+        return iter(pairs)
+
     def __repr__(self):
         return "Path(%s)" % " / ".join(str(x) for x in self.args)
 
@@ -428,11 +507,20 @@ class AlternativePath(Path):
             else:
                 self.args.append(a)
 
+    def _key(self):
+        return tuple(self.args)
+
     def eval(self, graph, subj=None, obj=None):
         for x in self.args:
             for y in evalPath(graph, (subj, x, obj)):
                 yield y
 
+    def evalMany(self, graph, subjs, obj=None):
+        subjs = set(subjs)
+        for x in self.args:
+            for y in evalPathMany(graph, subjs, x, obj):
+                yield y
+
     def __repr__(self):
         return "Path(%s)" % " | ".join(str(x) for x in self.args)
 
@@ -443,18 +531,83 @@ class ModPath(Path):
         self.mod = mod
 
         if mod == ZeroOrOne:
-            self.zero = True
-            self.more = False
+            self.min, self.max = 0, 1
         elif mod == ZeroOrMore:
-            self.zero = True
-            self.more = True
+            self.min, self.max = 0, None
         elif mod == OneOrMore:
-            self.zero = False
-            self.more = True
+            self.min, self.max = 1, None
+        elif isinstance(mod, tuple) and len(mod) == 2:
+            self.min, self.max = mod
+            if self.min is None:
+                self.min = 0
+            if self.min < 0 or (self.max is not None and self.max < self.min):
+                raise Exception('Invalid repetition range %s' % (mod,))
+        else:
+            raise Exception('Unknown modifier %s' % (mod,))
+
+        self.zero = self.min == 0
+        self.more = self.max is None or self.max > 1
+        # anything but ?, * and + needs exact path lengths
+        self.bounded = (self.min, self.max) not in (
+            (0, 1), (0, None), (1, None))
+
+    def _key(self):
+        return (self.path, self.min, self.max)
+
+    def _bounded(self, start, step):
+        """
+        Return all nodes reachable from start in min to max steps
+        step(n) gives the nodes one step away from n
+
+        Exploration stops at max steps, and once min steps are taken
+        each node is only expanded once.
+        """
+        res = set()
+        expanded = set()
+        level = set([start])
+        depth = 0
+        while level:
+            if depth >= self.min:
+                res.update(level)
+                if depth == self.max:
+                    break
+                level = level - expanded
+                expanded.update(level)
+            level = set(o for n in level for o in step(n))
+            depth += 1
+        return res
+
+    def _evalBounded(self, graph, subj, obj):
+
+        def _fwd(n):
+            return [o for s, o in evalPath(graph, (n, self.path, None))]
+
+        def _bwd(n):
+            return [s for s, o in evalPath(graph, (None, self.path, n))]
+
+        if subj:
+            for o in self._bounded(subj, _fwd):
+                if not obj or o == obj:
+                    yield subj, o
+        elif obj:
+            for s in self._bounded(obj, _bwd):
+                yield s, obj
         else:
-            raise Exception('Unknown modifier %s' % mod)
+            if self.zero:
+                for n in allNodes(graph):
+                    yield n, n
+            starts = set(s for s, o in evalPath(graph, (None, self.path, None)))
+            for s in starts:
+                for o in self._bounded(s, _fwd):
+                    if s != o or not self.zero:  # (s, s) is done above
+                        yield s, o
 
     def eval(self, graph, subj=None, obj=None, first=True):
+        if self.bounded:
+            for x in self._evalBounded(graph, subj, obj):
+                yield x
+            return
+
         if self.zero and first:
             if subj and obj:
                 if subj == obj:
@@ -491,19 +644,10 @@ class ModPath(Path):
 
         def _fwdbwd():
             if self.zero:
-                seen1 = set()
                 # According to the spec, ALL nodes are possible solutions
                 # (even literals)
-                # we cannot do this without going through ALL triples
-                # unless we keep an index of all terms somehow
-                # but lets just hope this query doesnt happen very often...
-                for s, o in graph.subject_objects(None):
-                    if s not in seen1:
-                        seen1.add(s)
-                        yield s, s
-                    if o not in seen1:
-                        seen1.add(o)
-                        yield o, o
+                for n in allNodes(graph):
+                    yield n, n
 
             for s, o in evalPath(graph, (None, self.path, None)):
                 if not self.more:
@@ -532,7 +676,57 @@ class ModPath(Path):
                     done.add(x)
                     yield x
 
+    def evalMany(self, graph, subjs, obj=None):
+        # the one-step successors of a node and the complete closure of
+        # each start are kept, and shared between all starts
+        succ = {}
+        closures = {}
+
+        def _succ(n):
+            try:
+                return succ[n]
+            except KeyError:
+                r = succ[n] = [o for s, o in evalPath(
+                    graph, (n, self.path, None))]
+                return r
+
+        def _closure(subj):
+            seen = set()
+            todo = list(_succ(subj))
+            while todo:
+                n = todo.pop()
+                if n in seen:
+                    continue
+                seen.add(n)
+                if n in closures:
+                    # everything reachable from n is already known
+                    seen.update(closures[n])
+                else:
+                    todo.extend(_succ(n))
+            closures[subj] = seen
+            return seen
+
+        for subj in set(subjs):
+            if self.bounded:
+                res = self._bounded(subj, _succ)
+            elif self.more:
+                res = _closure(subj)
+            else:
+                res = set(_succ(subj))
+            if self.zero:
+                res = res | set([subj])
+
+            if obj is not None:
+                if obj in res:
+                    yield subj, obj
+            else:
+                for o in res:
+                    yield subj, o
+
     def __repr__(self):
+        if isinstance(self.mod, tuple):
+            return "Path(%s{%s,%s})" % (
+                self.path, self.min, "" if self.max is None else self.max)
         return "Path(%s%s)" % (self.path, self.mod)
 
 
@@ -547,19 +741,30 @@ class NegatedPath(Path):
                 'Can only negate URIRefs, InvPaths or ' +
                 'AlternativePaths, not: %s' % (arg,))
 
+        for a in self.args:
+            if not isinstance(a, (URIRef, InvPath)):
+                raise Exception('Invalid path in NegatedPath: %s' % a)
+
+        self.fwd = frozenset(a for a in self.args if isinstance(a, URIRef))
+        self.inv = frozenset(
+            a.arg for a in self.args if isinstance(a, InvPath))
+
+    def _key(self):
+        return tuple(self.args)
+
     def eval(self, graph, subj=None, obj=None):
-        for s, p, o in graph.triples((subj, None, obj)):
-            for a in self.args:
-                if isinstance(a, URIRef):
-                    if p == a:
-                        break
-                elif isinstance(a, InvPath):
-                    if (o, a.arg, s) in graph:
-                        break
-                else:
-                    raise Exception('Invalid path in NegatedPath: %s' % a)
-            else:
-                yield s, o
+        # !(:a|^:b) is !:a UNION ^(!:b)
+        # http://www.w3.org/TR/sparql11-query/#eval_negatedPropertySet
+        if self.fwd or not self.inv:
+            for s, p, o in graph.triples((subj, None, obj)):
+                if p not in self.fwd:
+                    yield s, o
+
+        # all inverse elements are done in one scan of the reverse triples
+        if self.inv:
+            for s, p, o in graph.triples((obj, None, subj)):
+                if p not in self.inv:
+                    yield o, s
 
     def __repr__(self):
         return "Path(! %s)" % ",".join(str(x) for x in self.args)
@@ -585,13 +790,369 @@ def evalPath(graph, t):
     return ((s, o) for s, p, o in graph.triples(t))
 
 
+def evalPathMany(graph, subjs, path, obj=None):
+    """
+    Evaluate a path from a set of start nodes in one go,
+    returns (start, end) pairs like evalPath
+
+    Intermediate results are shared between the starts, so this is
+    cheaper than calling evalPath once for each start.
+    """
+    if isinstance(path, URIRef):
+        return ((s, o) for subj in subjs
+                for s, p, o in graph.triples((subj, path, obj)))
+    elif isinstance(path, Path):
+        return path.evalMany(graph, subjs, obj)
+    else:
+        raise Exception('I need a URIRef or path as predicate, not %s' % path)
+
+
+def _inc(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _dec(counts, key):
+    c = counts.get(key, 0) - 1
+    if c > 0:
+        counts[key] = c
+    else:
+        counts.pop(key, None)
+
+
+class NodeIndex(object):
+    """
+    All distinct subjects and objects of a graph
+
+    Each node is kept with the number of triples it occurs in, so the
+    index can be updated one triple at a time as the graph changes.
+    The number of triples for each predicate and each predicate/object
+    pair is kept as well, see tripleCount.
+    """
+
+    def __init__(self, triples=()):
+        self.counts = {}
+        self.predicates = {}
+        self.pairs = {}
+        self.size = 0
+        for t in triples:
+            self.add(t)
+
+    def add(self, (s, p, o)):
+        for n in (s, o):
+            _inc(self.counts, n)
+        _inc(self.predicates, p)
+        _inc(self.pairs, (p, o))
+        self.size += 1
+
+    def remove(self, (s, p, o)):
+        for n in (s, o):
+            _dec(self.counts, n)
+        _dec(self.predicates, p)
+        _dec(self.pairs, (p, o))
+        self.size -= 1
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, node):
+        return node in self.counts
+
+
+def _indexKey(store, context):
+    """
+    The key of the node index for a context, None is the union
+    of all contexts (as seen by a ConjunctiveGraph)
+    """
+    if context is None or not store.context_aware:
+        return None
+    return getattr(context, 'identifier', context)
+
+
+def _contains(store, t, context):
+    for x in store.triples(t, context):
+        return True
+    return False
+
+
+class _StoreHook(object):
+    """
+    Keeps the node indexes of a store up to date, and counts its
+    changes for the path caches
+
+    The add, addN and remove methods of the store object (not of
+    its class) are replaced, so only stores of graphs given to
+    enableNodeIndex or enablePathCache are affected. While a store
+    has a node index, writes
+    cost extra store lookups: each added triple is looked up first to
+    see if it is new, and the triples a remove matches are listed
+    before and looked up again after removing them.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.indexes = {}
+        self.generation = 0
+        self.busy = False  # in addN, which may call add
+        self._add = store.add
+        self._addN = store.addN
+        self._remove = store.remove
+        store.add = self.add
+        store.addN = self.addN
+        store.remove = self.remove
+
+    def _new(self, quads):
+        """
+        The (index key, triple) pairs that adding quads adds
+        """
+        new = []
+        seen = set()
+        for s, p, o, c in quads:
+            t = (s, p, o)
+            for key, context in ((None, None),
+                                 (_indexKey(self.store, c), c)):
+                if key in self.indexes and (key, t) not in seen:
+                    seen.add((key, t))
+                    if not _contains(self.store, t, context):
+                        new.append((key, t))
+        return new
+
+    def add(self, triple, context, quoted=False):
+        self.generation += 1
+        if self.busy or quoted or not self.indexes:
+            return self._add(triple, context, quoted)
+        new = self._new([tuple(triple) + (context,)])
+        self._add(triple, context, quoted)
+        for key, t in new:
+            self.indexes[key].add(t)
+
+    def addN(self, quads):
+        self.generation += 1
+        if self.busy or not self.indexes:
+            return self._addN(quads)
+        quads = list(quads)
+        new = self._new(quads)
+        self.busy = True
+        try:
+            self._addN(quads)
+        finally:
+            self.busy = False
+        for key, t in new:
+            self.indexes[key].add(t)
+
+    def remove(self, triple, context=None):
+        self.generation += 1
+        if self.busy or not self.indexes:
+            return self._remove(triple, context)
+        matched = [(t, list(cs))
+                   for t, cs in self.store.triples(triple, context)]
+        self._remove(triple, context)
+        for t, cs in matched:
+            t = tuple(t)
+            keys = set()
+            for c in [None] + cs:
+                key = _indexKey(self.store, c)
+                if key in self.indexes and key not in keys:
+                    keys.add(key)
+                    if not _contains(self.store, t,
+                                     None if key is None else c):
+                        self.indexes[key].remove(t)
+
+
+def _storeHook(store):
+    """
+    The _StoreHook of store, installing it on first use,
+    None if the store cannot have one
+    """
+    hook = getattr(store, '_sparql_hook', None)
+    if hook is None:
+        try:
+            store._sparql_hook = None
+        except AttributeError:
+            return None
+        hook = store._sparql_hook = _StoreHook(store)
+    return hook
+
+
+def _indexed(graph):
+    """
+    The store, node index key and context of graph,
+    None for graphs that cannot be indexed, i.e. read-only
+    aggregates and quoted graphs
+    """
+    if isinstance(graph, (ReadOnlyGraphAggregate, QuotedGraph)):
+        return None
+    store = graph.store
+    if isinstance(graph, ConjunctiveGraph):
+        context = None
+    else:
+        context = graph
+    key = _indexKey(store, context)
+    if key is None:
+        context = None
+    return store, key, context
+
+
+def enableNodeIndex(graph):
+    """
+    Keep a NodeIndex of graph, for zero-length paths with both ends
+    unbound and for counting the triples of trivial COUNT queries.
+    Returns the index, None if graph cannot be indexed.
+
+    The index is kept for the store and context of the graph, and
+    updated as triples are added and removed through any graph of the
+    store. This makes writes to the store more expensive, see
+    _StoreHook, until disableNodeIndex is called.
+    """
+    indexed = _indexed(graph)
+    if indexed is None:
+        return None
+    store, key, context = indexed
+    hook = _storeHook(store)
+    if hook is None:
+        return None
+
+    if key not in hook.indexes:
+        hook.indexes[key] = NodeIndex(
+            t for t, cs in store.triples((None, None, None), context))
+    return hook.indexes[key]
+
+
+def disableNodeIndex(graph):
+    """
+    Drop the NodeIndex of graph, writes no longer update it
+    """
+    indexed = _indexed(graph)
+    hook = indexed and getattr(indexed[0], '_sparql_hook', None)
+    if hook is not None:
+        hook.indexes.pop(indexed[1], None)
+
+
+def nodeIndex(graph):
+    """
+    The NodeIndex of graph, None unless it was enabled with
+    enableNodeIndex
+    """
+    indexed = _indexed(graph)
+    hook = indexed and getattr(indexed[0], '_sparql_hook', None)
+    if hook is None:
+        return None
+    return hook.indexes.get(indexed[1])
+
+
+def allNodes(graph):
+    """
+    All distinct subjects and objects in graph, from the node index
+    if it is enabled, otherwise by going through all triples
+    """
+    index = nodeIndex(graph)
+    if index is not None:
+        return iter(index)
+
+    def _scan():
+        seen = set()
+        for s, o in graph.subject_objects(None):
+            for n in (s, o):
+                if n not in seen:
+                    seen.add(n)
+                    yield n
+    return _scan()
+
+
+def tripleCount(graph, (s, p, o)):
+    """
+    The number of triples in graph matching a pattern, None matches
+    anything
+
+    If the node index of graph is enabled, patterns with no subject
+    and with only the predicate, or the predicate and object, given
+    are counted from it. All triples are counted with len(graph),
+    all other patterns by going through the matching triples.
+    """
+    if s is None and (p is not None or o is None):
+        index = nodeIndex(graph)
+        if index is not None:
+            if p is None:
+                return index.size
+            elif o is None:
+                return index.predicates.get(p, 0)
+            return index.pairs.get((p, o), 0)
+        if p is None:
+            return len(graph)
+
+    return sum(1 for t in graph.triples((s, p, o)))
+
+
+class PathCache(object):
+    """
+    LRU cache of path results for a graph
+
+    Maps (subj, path, obj) to the list of matching (s, o) pairs. All
+    results are dropped when the store of the graph changes.
+    """
+
+    def __init__(self, graph, size=1000):
+        self.hook = _storeHook(graph.store)
+        self.size = size
+        self.generation = self.hook.generation
+        self.results = OrderedDict()
+
+    def get(self, key):
+        if self.generation != self.hook.generation:
+            self.results.clear()
+            self.generation = self.hook.generation
+            return None
+        try:
+            res = self.results.pop(key)
+        except KeyError:
+            return None
+        self.results[key] = res  # most recently used is last
+        return res
+
+    def put(self, key, res):
+        self.results[key] = res
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def __len__(self):
+        return len(self.results)
+
+
+def enablePathCache(graph, size=1000):
+    """
+    Cache the results of path lookups through graph.triples,
+    until the graph is changed.
+    """
+    graph._sparql_pathcache = PathCache(graph, size)
+    return graph._sparql_pathcache
+
+
+def disablePathCache(graph):
+    graph._sparql_pathcache = None
+
+
+def _evalCached(graph, path, subj, obj):
+    cache = getattr(graph, '_sparql_pathcache', None)
+    if cache is None:
+        return path.eval(graph, subj, obj)
+
+    key = (subj, path, obj)
+    res = cache.get(key)
+    if res is None:
+        res = list(path.eval(graph, subj, obj))
+        cache.put(key, res)
+    return iter(res)
+
+
 def graph_triples(graph, t, context=None):
 #    if DEBUG: print ">>>",t
     subj, path, obj = t
     if path is None or isinstance(path, URIRef):
         return graph._triples((subj, path, obj))
     elif isinstance(path, Path):
-        return ((s, path, o) for s, o in path.eval(graph, subj, obj))
+        return ((s, path, o) for s, o in _evalCached(graph, path, subj, obj))
     else:
         raise Exception('I need a URIRef or path as predicate, not %s' % path)
 
@@ -602,7 +1163,8 @@ def conjunctive_graph_triples(graph, t, context=None):
         return graph._triples((subj, path, obj), context)
     elif isinstance(path, Path):
         if context is None:
-            return ((s, path, o) for s, o in path.eval(graph, subj, obj))
+            return ((s, path, o) for s, o in _evalCached(
+                graph, path, subj, obj))
         else:
             return ((s, path, o) for s, o in path.eval(graph.get_context(context), subj, obj))
     else:
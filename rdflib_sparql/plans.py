@@ -0,0 +1,129 @@
+"""
+Storing prepared queries
+
+The result of prepareQuery, a rdflib_sparql.sparql.Query with the
+prologue and the algebra of a query, can be pickled. dumpQuery and
+loadQuery write and read it in a compact (compressed binary pickle)
+format.
+
+A PlanStore is a directory of such files, one per query string,
+initNs and base. Processes sharing the directory only parse and
+translate each query once::
+
+    store = PlanStore('/var/cache/myapp/plans')
+    store.preload()  # i.e. before forking workers
+
+    q = store.prepareQuery('SELECT ?s WHERE { ?s a ?type }')
+    graph.query(q, initBindings={'type': FOAF.Person})
+
+The files depend on the version of rdflib_sparql, plans of other
+versions are not used.
+"""
+
+import os
+import zlib
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import rdflib_sparql
+from rdflib_sparql.processor import prepareQuery
+
+SUFFIX = '.plan'
+
+
+def dumpQuery(query, f):
+    """
+    Write a prepared query to the file-like object f
+    """
+    f.write(zlib.compress(pickle.dumps(query, pickle.HIGHEST_PROTOCOL)))
+
+
+def loadQuery(f):
+    """
+    Read a prepared query from the file-like object f
+    """
+    return pickle.loads(zlib.decompress(f.read()))
+
+
+class PlanStore(object):
+
+    """
+    A directory of prepared queries, the queries are kept in memory
+    once loaded or prepared
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.plans = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, queryString, initNs={}, base=None):
+        """
+        The file name (without SUFFIX) of the plan of a query
+        """
+        if isinstance(queryString, unicode):
+            queryString = queryString.encode('utf-8')
+        h = hashlib.sha1(queryString)
+        h.update(repr((rdflib_sparql.__version__, base,
+                       sorted((unicode(k), unicode(v))
+                              for k, v in initNs.iteritems()))))
+        return h.hexdigest()
+
+    def _load(self, key):
+        try:
+            f = open(os.path.join(self.directory, key + SUFFIX), 'rb')
+        except IOError:
+            return None
+        try:
+            return loadQuery(f)
+        except Exception:
+            return None  # written by another version or broken
+        finally:
+            f.close()
+
+    def _save(self, key, query):
+        # written to a temporary file first, so that other processes
+        # never read a half written plan
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dumpQuery(query, f)
+            os.rename(tmp, os.path.join(self.directory, key + SUFFIX))
+        except:
+            os.remove(tmp)
+            raise
+
+    def preload(self):
+        """
+        Load all plans in the directory into memory,
+        returns the number of plans loaded
+        """
+        n = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            key = name[:-len(SUFFIX)]
+            if key in self.plans:
+                continue
+            query = self._load(key)
+            if query is not None:
+                self.plans[key] = query
+                n += 1
+        return n
+
+    def prepareQuery(self, queryString, initNs={}, base=None):
+        """
+        Like rdflib_sparql.processor.prepareQuery, but the query is
+        only parsed and translated if it is not in the store yet
+        """
+        key = self.key(queryString, initNs, base)
+        query = self.plans.get(key)
+        if query is None:
+            query = self._load(key)
+            if query is None:
+                query = prepareQuery(queryString, initNs, base)
+                self._save(key, query)
+            self.plans[key] = query
+        return query
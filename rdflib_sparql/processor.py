@@ -11,7 +11,7 @@ from rdflib.query import Processor, Result
 
 from rdflib_sparql.sparql import Query
 
-from rdflib_sparql.parser import parseQuery, parseUpdate
+from rdflib_sparql.parser import parseQuery, parseUpdate, parseUpdateStream
 from rdflib_sparql.algebra import translateQuery, translateUpdate
 
 from rdflib_sparql.evaluate import evalQuery
@@ -34,6 +34,23 @@ def processUpdate(graph, updateString, initBindings={}, initNs={}, base=None):
         parseUpdate(updateString), base, initNs), initBindings)
 
 
+def processUpdateStream(graph, f, initBindings={}, initNs={}, base=None):
+    """
+    Process a SPARQL Update Request read from the file-like object f,
+    one operation at a time: each is parsed, translated and executed
+    before the next one is read
+
+    Unlike processUpdate, a syntax error only aborts the request when
+    it is reached, the operations before it have been executed
+    """
+    prologue = None
+    for tree in parseUpdateStream(f):
+        update = translateUpdate(tree, base, initNs, prologue)
+        if update:
+            prologue = update[-1].prologue
+            evalUpdate(graph, update, initBindings)
+
+
 class SPARQLResult(Result):
 
     def __init__(self, res):
@@ -43,6 +60,12 @@ class SPARQLResult(Result):
         self.askAnswer = res.get("askAnswer")
         self.graph = res.get("graph")
 
+        # for approximate queries, the sampled fraction and a list of
+        # {var: (low, high)} 95% confidence intervals for the
+        # estimated values of each solution
+        self.sample = res.get("sample")
+        self.intervals = res.get("intervals")
+
 
 class SPARQLProcessor(Processor):
 
@@ -51,11 +74,15 @@ class SPARQLProcessor(Processor):
 
     def query(
             self, strOrQuery, initBindings={},
-            initNs={}, base=None, DEBUG=False):
+            initNs={}, base=None, DEBUG=False, sample=None, sampleSeed=None):
         """
         Evaluate a query with the given initial bindings, and initial
         namespaces. The given base is used to resolve relative URIs in
         the query and will be overridden by any BASE given in the query.
+
+        If sample is a fraction between 0 and 1, the query is evaluated
+        approximately on a random sample of that size. COUNT and SUM
+        are scaled up, and the result has confidence intervals.
         """
 
         if not isinstance(strOrQuery, Query):
@@ -64,4 +91,5 @@ class SPARQLProcessor(Processor):
         else:
             query = strOrQuery
 
-        return evalQuery(self.graph, query, initBindings, base)
+        return evalQuery(self.graph, query, initBindings, base,
+                         sample, sampleSeed)
@@ -1,8 +1,9 @@
 import collections
 import itertools
 import datetime
+import random
 
-from rdflib.namespace import NamespaceManager
+from rdflib.namespace import NamespaceManager, RDF, RDFS, XSD
 from rdflib import Variable, BNode, Graph, ConjunctiveGraph, URIRef, Literal
 
 from parserutils import CompValue
@@ -120,6 +121,16 @@ class FrozenBindings(Mapping):
                 self._hash ^= hash(value)
         return self._hash
 
+    def __getstate__(self):
+        # the query context is not pickled, it must be set again
+        # by whoever unpickles the solution
+        return self._d
+
+    def __setstate__(self, d):
+        self.ctx = None
+        self._d = d
+        self._hash = None
+
     def project(self, vars):
         return FrozenBindings(
             self.ctx, (x for x in self.iteritems() if x[0] in vars))
@@ -172,6 +183,55 @@ class FrozenBindings(Mapping):
         return c
 
 
+class Sampling(object):
+
+    """
+    Approximate query evaluation
+
+    Only a random fraction of the matches of the first triple pattern
+    that is evaluated are used. Aggregates over the sample are scaled
+    up where that makes sense, and the confidence intervals of the
+    estimates are kept.
+    """
+
+    def __init__(self, fraction, seed=None):
+        if not 0 < fraction <= 1:
+            raise ValueError("Sample fraction must be in (0,1]")
+        self.fraction = fraction
+        self.random = random.Random(seed)
+        self.pattern = None
+        self.intervals = {}
+
+    def sample(self, pattern, triples):
+        """
+        Filter the matches of a triple pattern, if it is the sampled one
+        """
+        if self.pattern is None:
+            self.pattern = pattern
+        if pattern is not self.pattern:
+            return triples
+        return (t for t in triples if self.random.random() < self.fraction)
+
+    def estimate(self, value, low, high):
+        """
+        Remember the confidence interval of an estimated value
+        """
+        # the value itself is kept here, so its id stays unique
+        self.intervals[id(value)] = (value, low, high)
+
+    def interval(self, value):
+        """
+        Return the (low, high) confidence interval for a value
+        in the results, or None if the value is not an estimate
+        """
+        try:
+            v, low, high = self.intervals[id(value)]
+        except KeyError:
+            return None
+        if v is value:
+            return low, high
+
+
 class QueryContext(object):
 
     """
@@ -193,6 +253,7 @@ class QueryContext(object):
         self.now = datetime.datetime.now()
 
         self.bnodes = collections.defaultdict(BNode)
+        self.sampling = None
 
     def clone(self):
         r = QueryContext(
@@ -201,6 +262,7 @@ class QueryContext(object):
         r.bindings.update(self.bindings)
         r._graph = list(self._graph)
         r.bnodes = self.bnodes
+        r.sampling = self.sampling
         return r
 
     def _get_graph(self):
@@ -296,25 +358,89 @@ class QueryContext(object):
             raise Exception("We've bottomed out of the bindings stack!")
 
 
+# bound in every prologue, like in a NamespaceManager
+_DEFAULT_NAMESPACES = {
+    'xml': URIRef(u"http://www.w3.org/XML/1998/namespace"),
+    'rdf': URIRef(unicode(RDF)),
+    'rdfs': URIRef(unicode(RDFS)),
+    'xsd': URIRef(unicode(XSD)),
+}
+
+
+class _PrologueNamespaceManager(NamespaceManager):
+
+    """
+    The namespace manager of a Prologue, prefixes bound with it are
+    bound in the prologue too
+    """
+
+    def __init__(self, prologue):
+        self.prologue = None  # NamespaceManager.__init__ binds some
+        NamespaceManager.__init__(self, Graph())
+        for prefix, uri in prologue.namespaces.iteritems():
+            NamespaceManager.bind(self, prefix, uri)
+        self.prologue = prologue
+
+    def bind(self, prefix, namespace, override=True):
+        NamespaceManager.bind(self, prefix, namespace, override)
+        if self.prologue is not None:
+            prefix = prefix or ""
+            ns = self.store.namespace(prefix)
+            if ns is not None and ns != self.prologue.namespaces.get(prefix):
+                self.prologue.bind(prefix, ns)
+
+
 class Prologue:
 
     """
     A class for holding prefixing bindings and base URI information
+
+    The prefix map can be shared with other prologues, it is copied
+    before it is changed
     """
 
-    def __init__(self):
+    def __init__(self, namespaces=None):
         self.base = None
-        self.namespace_manager = NamespaceManager(
-            Graph())  # ns man needs a store
+        if namespaces is None:
+            namespaces = _DEFAULT_NAMESPACES
+        self.namespaces = namespaces
+        self._shared = True
+        self._namespace_manager = None
+
+    @property
+    def namespace_manager(self):
+        # only made when asked for, it needs a graph
+        if self._namespace_manager is None:
+            self._namespace_manager = _PrologueNamespaceManager(self)
+        return self._namespace_manager
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_namespace_manager'] = None
+        return state
+
+    def copy(self):
+        """
+        A copy of this prologue, sharing the prefix map until either
+        binds a prefix
+        """
+        p = Prologue(self.namespaces)
+        p.base = self.base
+        self._shared = True
+        return p
 
     def resolvePName(self, prefix, localname):
-        ns = self.namespace_manager.store.namespace(prefix or "")
+        ns = self.namespaces.get(prefix or "")
         if ns is None:
             raise Exception('Unknown namespace prefix : %s' % prefix)
         return URIRef(ns + (localname or ""))
 
     def bind(self, prefix, uri):
-        self.namespace_manager.bind(prefix, uri)
+        if self._shared:
+            self.namespaces = dict(self.namespaces)
+            self._shared = False
+        self.namespaces[prefix or ""] = URIRef(unicode(uri))
+        self._namespace_manager = None
 
     def absolutize(self, iri):
 
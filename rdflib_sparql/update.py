@@ -6,6 +6,7 @@ Code for carrying out Update Operations
 
 from rdflib import Graph, Variable
 
+import rdflib_sparql
 from rdflib_sparql.sparql import QueryContext
 from rdflib_sparql.evalutils import _fillTemplate, _join
 from rdflib_sparql.evaluate import evalBGP, evalPart
@@ -258,6 +259,8 @@ def evalUpdate(graph, update, initBindings=None):
 
     """
 
+    rdflib_sparql.loadCustomEvals()
+
     for u in update:
 
         ctx = QueryContext(graph)
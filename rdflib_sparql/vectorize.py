@@ -0,0 +1,326 @@
+"""
+Vectorized evaluation of numeric filters with NumPy
+
+Solutions are filtered in batches: the numeric values of each variable
+used in the filter are extracted once into a NumPy array, with a mask
+of rows where the variable is bound to a numeric literal. Comparisons
+and arithmetic are then done on whole arrays.
+
+Only rows where the vectorized result is certain are decided this way,
+all others are evaluated row by row as usual, so the SPARQL error
+semantics are exactly those of the normal filter evaluation. This
+covers:
+
+* rows where a variable is unbound or not a number
+* division by zero, NaN and infinite values
+* comparisons that are too close to call with float precision
+  (this also includes all equal values in = and !=)
+
+Along with the values, a bound of their rounding error is kept: large
+integers and most decimals are not exact as floats, and each operation
+may round again. A comparison is only certain if the values differ by
+more than their errors.
+
+Filters using anything but numeric literals and variables, + - * /,
+unary - +, the comparison operators and ! && || are not vectorized.
+
+NumPy is optional, this is only used if
+rdflib_sparql.SPARQL_VECTORIZED_FILTERS is true and NumPy is available.
+
+The numeric aggregates SUM, AVG, MIN and MAX can likewise collect the
+values of a group while they are all floats or all integers and reduce
+them a block at a time, see rdflib_sparql.aggregates.Numeric. This is
+enabled by rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES.
+"""
+
+from rdflib import Literal, Variable
+
+from rdflib_sparql.parserutils import CompValue, SlotValue
+from rdflib_sparql.operators import numeric
+from rdflib_sparql.evalutils import _ebv, _batches
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+BATCH_SIZE = 1024
+
+# fewer values than this are reduced in python
+MIN_BATCH = 32
+
+# relative difference under which a comparison is not trusted
+EPSILON = 1e-9
+
+# the relative rounding error of a float operation (with some margin)
+ULP = 2.0 ** -52
+
+
+class Unsupported(Exception):
+    """
+    The expression cannot be vectorized
+    """
+
+
+class Batch(object):
+    """
+    A batch of solutions, with numeric columns extracted on demand
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, var):
+        """
+        Return (values, valid, error) arrays for var
+        """
+        try:
+            return self.columns[var]
+        except KeyError:
+            pass
+
+        values = numpy.zeros(len(self.rows))
+        valid = numpy.zeros(len(self.rows), dtype=bool)
+        for i, row in enumerate(self.rows):
+            try:
+                values[i] = float(numeric(row[var]))
+                valid[i] = True
+            except:
+                pass  # unbound, not a number, or too large for a float
+        valid &= numpy.isfinite(values)
+        # ints beyond 2**53 and decimals are rounded to a float
+        self.columns[var] = values, valid, abs(values) * ULP
+        return self.columns[var]
+
+
+def _numeric(e):
+    """
+    Compile a numeric expression into a function of a Batch,
+    returning (values, valid, error) arrays
+    """
+    if isinstance(e, Variable):
+        return lambda batch: batch.column(e)
+
+    if isinstance(e, Literal):
+        try:
+            n = float(numeric(e))
+        except:
+            raise Unsupported(e)
+        return lambda batch: (n, True, abs(n) * ULP)
+
+    if not isinstance(e, (SlotValue, CompValue)):
+        raise Unsupported(e)
+
+    if e.name in ('UnaryMinus', 'UnaryPlus'):
+        f = _numeric(e['expr'])
+        if e.name == 'UnaryPlus':
+            return f
+
+        def _minus(batch):
+            x, valid, err = f(batch)
+            return -x, valid, err
+        return _minus
+
+    if e.name in ('AdditiveExpression', 'MultiplicativeExpression'):
+        first = _numeric(e['expr'])
+        rest = [(op, _numeric(x)) for op, x in zip(e['op'], e['other'])]
+
+        def _arith(batch):
+            res, valid, err = first(batch)
+            for op, f in rest:
+                x, v, xe = f(batch)
+                valid = valid & v
+                if op == '+':
+                    res = res + x
+                    err = err + xe
+                elif op == '-':
+                    res = res - x
+                    err = err + xe
+                elif op == '*':
+                    err = abs(res) * xe + abs(x) * err + err * xe
+                    res = res * x
+                else:
+                    # division by zero is an error, leave it to the row,
+                    # as are divisors that may be zero within their error
+                    d = abs(x) - xe
+                    valid = valid & (d > 0)
+                    res = res / numpy.where(d > 0, x, 1)
+                    err = (err + abs(res) * xe) / numpy.where(d > 0, d, 1)
+                err = err + abs(res) * ULP
+            return res, valid & numpy.isfinite(res) & numpy.isfinite(err), \
+                err
+        return _arith
+
+    raise Unsupported(e)
+
+
+_COMPARE = {
+    '<': lambda x, y: x < y,
+    '>': lambda x, y: x > y,
+    '<=': lambda x, y: x <= y,
+    '>=': lambda x, y: x >= y,
+    '=': lambda x, y: x == y,
+    '!=': lambda x, y: x != y,
+}
+
+
+def _boolean(e):
+    """
+    Compile a boolean expression into a function of a Batch,
+    returning (truth, valid) arrays
+    """
+    if not isinstance(e, (SlotValue, CompValue)):
+        raise Unsupported(e)
+
+    if e.name == 'RelationalExpression':
+        if e['op'] not in _COMPARE:
+            raise Unsupported(e)
+        cmp = _COMPARE[e['op']]
+        left = _numeric(e['expr'])
+        right = _numeric(e['other'])
+
+        def _relational(batch):
+            x, xv, xe = left(batch)
+            y, yv, ye = right(batch)
+            scale = numpy.maximum(numpy.maximum(abs(x), abs(y)), 1.0)
+            certain = abs(x - y) > xe + ye + EPSILON * scale
+            return cmp(x, y), xv & yv & certain
+        return _relational
+
+    if e.name in ('ConditionalAndExpression', 'ConditionalOrExpression'):
+        args = [_boolean(e['expr'])] + [_boolean(x) for x in e['other']]
+        combine = numpy.logical_and \
+            if e.name == 'ConditionalAndExpression' else numpy.logical_or
+
+        def _logical(batch):
+            truth, valid = args[0](batch)
+            for f in args[1:]:
+                t, v = f(batch)
+                truth = combine(truth, t)
+                valid = valid & v
+            return truth, valid
+        return _logical
+
+    if e.name == 'UnaryNot':
+        f = _boolean(e['expr'])
+
+        def _not(batch):
+            truth, valid = f(batch)
+            return numpy.logical_not(truth), valid
+        return _not
+
+    raise Unsupported(e)
+
+
+def compileFilter(expr):
+    """
+    Compile a filter expression for batch evaluation,
+    returns None if it cannot be vectorized
+    """
+    if numpy is None:
+        return None
+    try:
+        return _boolean(expr)
+    except Unsupported:
+        return None
+
+
+def vectorFilter(solutions, expr, f, size=BATCH_SIZE):
+    """
+    Filter solutions with expr, f is the compiled expr from compileFilter
+    """
+    for rows in _batches(solutions, size):
+        batch = Batch(rows)
+        with numpy.errstate(all='ignore'):  # such rows are not valid
+            truth, valid = f(batch)
+        truth = numpy.broadcast_to(truth, (len(rows),))
+        valid = numpy.broadcast_to(valid, (len(rows),))
+        for c, t, v in zip(rows, truth, valid):
+            if v:
+                if t:
+                    yield c
+            elif _ebv(expr, c):
+                yield c
+
+
+def numberKind(n):
+    """
+    float or int for the numbers that can be reduced with NumPy,
+    None for any other (i.e. Decimal) value
+    """
+    t = type(n)
+    if t is float:
+        return float
+    if t is int or t is long:
+        return int
+    return None
+
+
+def _array(values, kind):
+    """
+    The values as an array, None if they cannot be reduced exactly
+    """
+    if len(values) < MIN_BATCH:
+        return None
+    try:
+        if kind is float:
+            a = numpy.array(values, dtype=numpy.float64)
+            if numpy.isnan(a).any():
+                return None  # min/max of NaN depend on the order
+        else:
+            a = numpy.array(values, dtype=numpy.int64)
+            # the sum must not overflow either
+            if max(abs(int(a.min())), abs(int(a.max()))) > \
+                    (2 ** 63 - 1) // len(a):
+                return None
+        return a
+    except OverflowError:  # too large for an int64
+        return None
+
+
+def vectorSum(values, kind):
+    """
+    Return the sum of a list of floats or of integers,
+    as a python number
+    """
+    a = _array(values, kind)
+    if a is None:
+        return sum(values)
+    return kind(a.sum())
+
+
+def vectorSumSquares(values, kind):
+    """
+    The sum of the squares of a list of floats or of integers as a
+    float (infinite if too large), None if it must be found in python
+    """
+    a = _array(values, kind)
+    if a is not None:
+        f = a.astype(numpy.float64)
+        with numpy.errstate(over='ignore'):
+            return float(numpy.dot(f, f))
+
+
+def vectorMin(values, kind):
+    """
+    The minimum of a list of floats or of integers,
+    None if it must be found in python
+    """
+    a = _array(values, kind)
+    if a is not None:
+        return kind(a.min())
+
+
+def vectorMax(values, kind):
+    """
+    The maximum of a list of floats or of integers,
+    None if it must be found in python
+    """
+    a = _array(values, kind)
+    if a is not None:
+        return kind(a.max())
@@ -0,0 +1,40 @@
+"""
+Benchmark the time taken to import rdflib_sparql and to parse the first
+query, each is measured in a new python process.
+
+Run with: python test/importtime.py [repetitions]
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETUP = 'import time, rdflib\n'
+
+STEPS = [
+    ('import rdflib_sparql', 'import rdflib_sparql'),
+    ('import rdflib_sparql.processor', 'import rdflib_sparql.processor'),
+    ('first parse', 'import rdflib_sparql.processor\n'
+     'rdflib_sparql.processor.prepareQuery("SELECT * { ?s ?p ?o }")'),
+    ('first parse (fast parser)', 'import rdflib_sparql.processor\n'
+     'rdflib_sparql.SPARQL_FAST_PARSER = True\n'
+     'rdflib_sparql.processor.prepareQuery("SELECT * { ?s ?p ?o }")'),
+]
+
+
+def timeit(code):
+    """
+    Seconds taken by code in a new process, after rdflib is imported
+    """
+    script = SETUP + 't = time.time()\n' + code + \
+        '\nprint(time.time() - t)\n'
+    out = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+    return float(out.split()[-1])
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, code in STEPS:
+        print '%-30s %.3fs' % (name, min(timeit(code) for x in range(n)))
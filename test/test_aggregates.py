@@ -0,0 +1,378 @@
+"""
+Verify grouping and aggregation, see
+<http://www.w3.org/TR/sparql11-query/#aggregates>.
+"""
+import math
+from decimal import Decimal
+
+from rdflib import Graph, Literal, Variable, URIRef, XSD
+from rdflib_sparql.processor import SPARQLProcessor
+
+g = Graph()
+g.parse(data='''
+@prefix : <ex:> .
+
+:a :p 1, 2, 3 ; :q "x" .
+:b :p 2 ; :q "x" .
+:c :p 4, 4.5 ; :q "y" .
+''', format='n3')
+
+
+def query(q):
+    return SPARQLProcessor(g).query(q)['bindings']
+
+
+def test_aggregates():
+    def check(agg, expected):
+        r = query('SELECT ?s (%s AS ?x) WHERE { ?s <ex:p> ?o } GROUP BY ?s'
+                  % agg)
+        assert dict((b[Variable('s')].split(':')[1], b[Variable('x')])
+                    for b in r) == expected, r
+
+    yield check, 'COUNT(*)', dict(a=Literal(3), b=Literal(1), c=Literal(2))
+    yield check, 'SUM(?o)', dict(a=Literal(6), b=Literal(2),
+                                 c=Literal("8.5", datatype=XSD.decimal))
+    yield check, 'MIN(?o)', dict(a=Literal(1), b=Literal(2), c=Literal(4))
+    yield check, 'MAX(?o)', dict(a=Literal(3), b=Literal(2), c=Literal("4.5", datatype=XSD.decimal))
+
+
+def test_no_group():
+    r = query('SELECT (COUNT(*) AS ?c) WHERE { ?s <ex:nothing> ?o }')
+    assert r[0][Variable('c')] == Literal(0)
+
+
+def test_distinct():
+    r = query('SELECT (COUNT(DISTINCT ?q) AS ?c) (COUNT(?q) AS ?d) '
+              'WHERE { ?s <ex:q> ?q }')
+    assert r[0][Variable('c')] == Literal(2)
+    assert r[0][Variable('d')] == Literal(3)
+
+
+def test_parallel():
+    import multiprocessing
+    import rdflib_sparql
+    from rdflib_sparql import evaluate
+
+    big = Graph()
+    for i in range(200):
+        big.add((URIRef('ex:s%d' % (i % 7)), URIRef('ex:p'), Literal(i % 13)))
+        big.add((URIRef('ex:s%d' % (i % 7)), URIRef('ex:q'), Literal(i % 3)))
+
+    q = '''SELECT ?s (COUNT(*) AS ?c) (SUM(?o) AS ?sum) (AVG(?o) AS ?avg)
+                  (MIN(?o) AS ?min) (MAX(?o) AS ?max)
+                  (COUNT(DISTINCT ?o) AS ?dc) (GROUP_CONCAT(?o) AS ?gc)
+                  (SUM(DISTINCT ?o) AS ?ds)
+           WHERE { ?s <ex:p> ?o . ?s <ex:q> ?x } GROUP BY ?s'''
+
+    def run():
+        return set(SPARQLProcessor(big).query(q)['bindings'])
+
+    serial = run()
+    processes = rdflib_sparql.SPARQL_AGGREGATE_PROCESSES
+    size = rdflib_sparql.SPARQL_AGGREGATE_BATCH_SIZE
+    try:
+        rdflib_sparql.SPARQL_AGGREGATE_PROCESSES = 2
+        rdflib_sparql.SPARQL_AGGREGATE_BATCH_SIZE = 50
+        parallel = run()
+
+        # without fork, the query is not passed to workers at all
+        forking, pool = evaluate._forking, multiprocessing.Pool
+        evaluate._forking = lambda: False
+        multiprocessing.Pool = None
+        try:
+            unforked = run()
+        finally:
+            evaluate._forking, multiprocessing.Pool = forking, pool
+    finally:
+        rdflib_sparql.SPARQL_AGGREGATE_PROCESSES = processes
+        rdflib_sparql.SPARQL_AGGREGATE_BATCH_SIZE = size
+
+    assert parallel == serial
+    assert unforked == serial
+
+
+def test_hyperloglog():
+    from rdflib_sparql.aggregates import HyperLogLog
+
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(20000):
+        a.add(Literal(i))
+        b.add(Literal(i + 10000))
+    assert abs(len(a) - 20000) < 20000 * 0.05
+    a.merge(b)
+    assert abs(len(a) - 30000) < 30000 * 0.05
+
+
+def test_approx_count_distinct():
+    import rdflib_sparql
+
+    r = query('''SELECT (<http://rdflib.net/sparql/aggregate#approxCountDistinct>(?q) AS ?c)
+                 WHERE { ?s <ex:q> ?q }''')
+    assert r[0][Variable('c')] == Literal(2)
+
+    try:
+        rdflib_sparql.SPARQL_APPROX_COUNT_DISTINCT = True
+        r = query('SELECT (COUNT(DISTINCT ?o) AS ?c) WHERE { ?s <ex:p> ?o }')
+    finally:
+        rdflib_sparql.SPARQL_APPROX_COUNT_DISTINCT = False
+    assert r[0][Variable('c')] == Literal(5)
+
+
+def test_sampling():
+    big = Graph()
+    for i in range(2000):
+        big.add((URIRef('ex:s%d' % i), URIRef('ex:p'), Literal(i % 10)))
+
+    def run(q):
+        return SPARQLProcessor(big).query(q, sample=0.5, sampleSeed=1)
+
+    r = run('''SELECT (COUNT(*) AS ?c) (SUM(?o) AS ?s) (AVG(?o) AS ?a)
+                      (MAX(?o) AS ?m)
+               WHERE { ?x <ex:p> ?o }''')
+    # the same seed samples the same solutions
+    sample = [b[Variable('o')].toPython()
+              for b in run('SELECT ?o WHERE { ?x <ex:p> ?o }')['bindings']]
+
+    assert r['sample'] == 0.5
+    b, i = r['bindings'][0], r['intervals'][0]
+    c, s, a = Variable('c'), Variable('s'), Variable('a')
+
+    assert set(i) == set([c, s, a])  # no interval for MAX
+    n, total = len(sample), sum(sample)
+    sumsq = sum(x * x for x in sample)
+    mean = float(total) / n
+    var = (sumsq - n * mean * mean) / (n - 1)
+    for v, value, error in (
+            (c, 2 * n, 1.96 * math.sqrt(0.5 * n) / 0.5),
+            (s, 2 * total, 1.96 * math.sqrt(0.5 * sumsq) / 0.5),
+            (a, mean, 1.96 * math.sqrt(var / n * 0.5))):
+        assert abs(float(b[v]) - value) < 1e-9, (v, b[v], value)
+        low, high = i[v]
+        assert abs(low - (value - error)) < 1e-9, (v, low, value - error)
+        assert abs(high - (value + error)) < 1e-9, (v, high, value + error)
+
+
+def test_sampling_large():
+    import rdflib_sparql
+
+    r = SPARQLProcessor(Graph()).query(
+        'SELECT (SUM(?o) AS ?s) (AVG(?o) AS ?a) '
+        'WHERE { VALUES ?o { %d 1 } }' % 10 ** 400)
+    b = r['bindings'][0]
+    assert b[Variable('s')] == Literal(10 ** 400 + 1)
+    assert b[Variable('a')] == Literal(Decimal(10 ** 400 + 1) / 2)
+
+    # the estimates are kept, without a confidence interval
+    big = Graph()
+    for i in range(100):
+        big.add((URIRef('ex:s%d' % i), URIRef('ex:p'), Literal(10 ** 400)))
+        big.add((URIRef('ex:s%d' % i), URIRef('ex:q'), Literal(1e200)))
+
+    def check(vectorized):
+        try:
+            rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES = vectorized
+            r = SPARQLProcessor(big).query(
+                'SELECT (SUM(?o) AS ?s) (AVG(?o) AS ?a) (SUM(?f) AS ?t) '
+                'WHERE { ?x <ex:p> ?o ; <ex:q> ?f }',
+                sample=0.5, sampleSeed=1)
+        finally:
+            rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES = False
+        b = r['bindings'][0]
+        assert b[Variable('a')].toPython() == 10 ** 400
+        assert b[Variable('s')].toPython() % 10 ** 400 == 0
+        assert b[Variable('t')].toPython() > 1e200
+        assert r['intervals'][0] == {}
+
+    yield check, False
+    yield check, True
+
+
+def test_vectorized():
+    import rdflib_sparql
+    from nose import SkipTest
+    from rdflib_sparql.vectorize import numpy
+    if numpy is None:
+        raise SkipTest('NumPy is not installed')
+
+    big = Graph()
+    p = URIRef('ex:p')
+    for i in range(3000):
+        big.add((URIRef('ex:int'), p, Literal(i - 1000)))
+        big.add((URIRef('ex:double'), p,
+                 Literal(str(i * 0.5), datatype=XSD.double)))
+        big.add((URIRef('ex:mixed'), p, Literal(i % 100)))
+        big.add((URIRef('ex:huge'), p, Literal(2 ** 62 + i)))
+        big.add((URIRef('ex:huger'), p, Literal(10 ** 200 + i)))
+    for i in range(30):
+        big.add((URIRef('ex:mixed'), p, Literal('%d.25' % i,
+                                                 datatype=XSD.decimal)))
+        big.add((URIRef('ex:mixed'), p, Literal(i * 1.5)))
+
+    q = '''SELECT ?s (SUM(?o) AS ?sum) (AVG(?o) AS ?avg)
+                  (MIN(?o) AS ?min) (MAX(?o) AS ?max)
+           WHERE { ?s <ex:p> ?o } GROUP BY ?s'''
+
+    def run():
+        return set(SPARQLProcessor(big).query(q)['bindings'])
+
+    python = run()
+    try:
+        rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES = True
+        vectorized = run()
+    finally:
+        rdflib_sparql.SPARQL_VECTORIZED_AGGREGATES = False
+
+    assert vectorized == python, vectorized ^ python
+
+
+def test_sorted_groups():
+    from rdflib_sparql.algebra import translateQuery
+    from rdflib_sparql.parser import parseQuery
+
+    sub = '''SELECT ?s (COUNT(*) AS ?c) (SUM(?o) AS ?sum)
+             WHERE { { SELECT ?s ?o WHERE { ?s <ex:p> ?o } %s } }
+             GROUP BY ?s'''
+
+    def group(q):
+        n = translateQuery(parseQuery(q)).algebra
+        while n.name != 'Group':
+            n = n.p
+        return n
+
+    assert group(sub % 'ORDER BY DESC(?s) ?o').sorted
+    assert not group(sub % 'ORDER BY ?o ?s').sorted
+    assert not group(sub % '').sorted
+
+    assert set(query(sub % 'ORDER BY DESC(?s) ?o')) == set(query(sub % ''))
+
+
+def test_sorted_ties():
+    # ORDER BY does not tell these keys apart, so their groups may be
+    # interleaved, they must still be grouped like without ORDER BY
+    q = '''PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+           SELECT ?k (COUNT(*) AS ?c)
+           WHERE { { SELECT ?k WHERE {
+               VALUES ?k { "x" "x"^^xsd:string "x" 1 "1.0"^^xsd:decimal
+                           "01"^^xsd:integer "x"^^xsd:string 1.0 }
+           } %s } }
+           GROUP BY ?k'''
+
+    def run(q):
+        return sorted((b[Variable('k')].n3(), b[Variable('c')])
+                      for b in query(q))
+
+    assert run(q % 'ORDER BY ?k') == run(q % '') == [
+        ('"01"^^<http://www.w3.org/2001/XMLSchema#integer>', Literal(1)),
+        ('"1"^^<http://www.w3.org/2001/XMLSchema#integer>', Literal(1)),
+        ('"1.0"^^<http://www.w3.org/2001/XMLSchema#decimal>', Literal(2)),
+        ('"x"', Literal(2)),
+        ('"x"^^<http://www.w3.org/2001/XMLSchema#string>', Literal(2))]
+
+
+def test_sorted_streaming():
+    from rdflib_sparql.evaluate import _aggregateSorted
+    from rdflib_sparql.parserutils import CompValue
+
+    s, o, r = Variable('s'), Variable('o'), Variable('r')
+    consumed = []
+
+    def solutions():
+        for i in range(10):
+            consumed.append(i)
+            yield {s: Literal(i // 3), o: Literal(i)}
+
+    aggregators = _aggregateSorted(
+        [CompValue('Aggregate_Sum', vars=o, res=r, distinct=None)],
+        [s], solutions())
+    assert next(aggregators).finish() == {r: Literal(3)}
+    assert len(consumed) == 4  # the first solution of the next group
+    assert [a.finish()[r] for a in aggregators] == \
+        [Literal(12), Literal(21), Literal(9)]
+
+
+def test_count_pushdown():
+    from rdflib import ConjunctiveGraph
+    from rdflib_sparql import evaluate
+
+    data = '''
+    @prefix : <ex:> .
+    :a a :P ; :q 1, 2 ; :r :x .
+    :b a :P ; :q 3 .
+    :c a :Q ; :q 4 ; :r :x, :y .
+    '''
+
+    queries = [
+        'SELECT (COUNT(*) AS ?c) WHERE { ?s a <ex:P> }',
+        'SELECT (COUNT(?s) AS ?c) WHERE { ?s <ex:q> ?o }',
+        'SELECT (COUNT(*) AS ?c) WHERE { ?s ?p ?o }',
+        'SELECT (COUNT(*) AS ?c) WHERE { <ex:c> ?p ?o }',
+        'SELECT (COUNT(*) AS ?c) (COUNT(?o) AS ?d) '
+        'WHERE { ?s <ex:q> ?o ; <ex:r> ?r }',
+        'SELECT (COUNT(*) AS ?c) WHERE { _:x <ex:q> ?o ; a <ex:P> }',
+        'SELECT (COUNT(*) AS ?c) WHERE { ?s <ex:q> ?o ; <ex:r> ?o }',
+        'SELECT (COUNT(DISTINCT ?s) AS ?c) WHERE { ?s <ex:q> ?o }',
+        'SELECT (COUNT(*) AS ?c) WHERE { ?s <ex:q> ?o FILTER(?o > 1) }',
+    ]
+
+    def run(graph, q, pushdown):
+        count = evaluate._pushdownCount
+        if not pushdown:
+            evaluate._pushdownCount = lambda ctx, agg: None
+        try:
+            return SPARQLProcessor(graph).query(q)['bindings']
+        finally:
+            evaluate._pushdownCount = count
+
+    def check(graph, q):
+        assert run(graph, q, True) == run(graph, q, False), q
+
+    for cls in (Graph, ConjunctiveGraph):
+        graph = cls()
+        graph.parse(data=data, format='n3')
+        for q in queries:
+            yield check, graph, q
+
+    graph = Graph()
+    graph.parse(data=data, format='n3')
+    q = queries[0]
+    assert run(graph, q, True)[0][Variable('c')] == Literal(2)
+    graph.remove((URIRef('ex:a'), None, None))
+    graph.add((URIRef('ex:d'), URIRef('ex:p'), URIRef('ex:P')))
+    assert run(graph, q, True)[0][Variable('c')] == Literal(1)
+
+
+def test_group_concat():
+    import rdflib_sparql
+    from rdflib_sparql.aggregates import GroupConcat
+    from rdflib_sparql.parserutils import CompValue
+
+    o, r = Variable('o'), Variable('r')
+    rows = [{o: Literal(x)} for x in 'abcab']
+
+    def concat(rows, distinct=None, parts=1):
+        a = CompValue('Aggregate_GroupConcat', vars=o, res=r,
+                      distinct=distinct, separator=',')
+        accs = [GroupConcat(a) for i in range(parts)]
+        for i, row in enumerate(rows):
+            accs[i * parts // len(rows)].step(row)
+        for acc in accs[1:]:
+            accs[0].merge(acc)
+        b = {}
+        accs[0].finish(b)
+        return b[r]
+
+    def check(maxLength, distinct, expected):
+        try:
+            rdflib_sparql.SPARQL_GROUP_CONCAT_MAX_LENGTH = maxLength
+            for parts in (1, 2, 5):
+                assert concat(rows, distinct, parts) == Literal(expected), \
+                    (maxLength, distinct, parts)
+        finally:
+            rdflib_sparql.SPARQL_GROUP_CONCAT_MAX_LENGTH = None
+
+    yield check, None, None, 'a,b,c,a,b'
+    yield check, None, 'DISTINCT', 'a,b,c'
+    yield check, 4, None, 'a,b,'
+    yield check, 3, None, 'a,b'
+    yield check, 4, 'DISTINCT', 'a,b,'
+    yield check, 0, None, ''
@@ -0,0 +1,85 @@
+import pickle
+
+from rdflib import Graph, Variable, URIRef, Literal, RDF
+
+from rdflib_sparql import algebra, fastparser
+from rdflib_sparql.parserutils import CompValue, SlotValue, SlotExpr
+from rdflib_sparql.processor import SPARQLProcessor
+
+g = Graph()
+g.parse(data='''
+@prefix : <ex:> .
+
+:a :p7 1 ; :p900 2 .
+''', format='n3')
+
+
+def test_traverse_deep():
+    tree = []
+    for i in range(10000):
+        tree = [tree, i]
+    assert algebra.traverse(tree, visitPost=lambda x: x + 1)[1] == 10000
+
+
+def test_many_unions():
+    # well beyond the recursion limit if translated/evaluated recursively
+    q = 'SELECT * { %s }' % ' UNION '.join(
+        '{ ?s <ex:p%d> ?o FILTER(?o > 0 && isLiteral(?o)) }' % i
+        for i in range(1500))
+    q = algebra.translateQuery(fastparser.parseQuery(q))
+    r = SPARQLProcessor(g).query(q)
+    assert sorted(b[Variable('o')].toPython() for b in r['bindings']) == [
+        1, 2]
+
+
+def test_shared_prologue():
+    q = 'PREFIX : <ex:> PREFIX x: <ex:x> SELECT * { ?s :p7 ?o }'
+    p1 = algebra.translateQuery(fastparser.parseQuery(q)).prologue
+    p2 = algebra.translateQuery(fastparser.parseQuery(q)).prologue
+    assert p1 is not p2 and p1.namespaces is p2.namespaces
+
+    p2.bind('', 'ex:other')
+    assert p1.resolvePName('', 'a') == URIRef('ex:a')
+    assert p2.resolvePName('', 'a') == URIRef('ex:othera')
+    assert p2.resolvePName('rdf', 'type') == RDF.type
+
+    # binding with the namespace manager binds in the prologue
+    nm = p1.namespace_manager
+    assert nm is p1.namespace_manager
+    nm.bind('y', 'ex:y')
+    assert p1.resolvePName('y', 'a') == URIRef('ex:ya')
+    assert p2.namespaces.get('y') is None
+    p1.bind('z', 'ex:z')
+    assert ('z', URIRef('ex:z')) in list(p1.namespace_manager.namespaces())
+
+    # the later declaration wins
+    q = algebra.translateQuery(fastparser.parseQuery(
+        'PREFIX : <ex:a> PREFIX : <ex:> SELECT * { ?s :p7 ?o }'),
+        initNs={'': 'ex:b'})
+    assert len(list(SPARQLProcessor(g).query(q)['bindings'])) == 1
+
+
+def test_slotted_nodes():
+    q = algebra.translateQuery(fastparser.parseQuery('''
+        SELECT ?s (STR(?o) AS ?x) { ?s <ex:p7> ?o
+        FILTER(?o > 0 && EXISTS { ?s <ex:p900> ?y }) }'''))
+    nodes = []
+
+    def visit(n):
+        if isinstance(n, (CompValue, SlotValue)):
+            nodes.append(n)
+    algebra.traverse(q.algebra, visitPost=visit)
+    assert nodes and all(isinstance(n, SlotValue) for n in nodes)
+    assert not hasattr(q.algebra, '__dict__')
+
+    f = [n for n in nodes if n.name == 'Filter'][0]
+    assert isinstance(f.expr, SlotExpr)
+    assert f['expr'] is f.expr and 'expr' in f and f.get('var') is None
+    assert f.var is None and 'var' not in f
+    exists = f.expr.other[0]
+    assert isinstance(exists.graph, SlotValue)
+
+    r = SPARQLProcessor(g).query(q)['bindings']
+    assert [b[Variable('x')] for b in r] == [Literal('1')]
+    r = SPARQLProcessor(g).query(pickle.loads(pickle.dumps(q, 2)))
+    assert [b[Variable('x')] for b in r['bindings']] == [Literal('1')]
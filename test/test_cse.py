@@ -0,0 +1,89 @@
+"""
+Verify that aggregates and expressions used more than once are only
+computed once, without changing the results.
+"""
+from rdflib import Graph, Variable
+
+from rdflib_sparql import algebra
+from rdflib_sparql.algebra import translateQuery
+from rdflib_sparql.parser import parseQuery
+from rdflib_sparql.processor import SPARQLProcessor
+
+g = Graph()
+g.parse(data='''
+@prefix : <ex:> .
+
+:a :p 1, 2, 3 .
+:b :p 2, "x" .
+:c :p 4, 4.5, 10 .
+''', format='n3')
+
+
+def find(n, name):
+    """all algebra nodes called name"""
+    res = []
+
+    def visit(x):
+        if getattr(x, 'name', None) == name:
+            res.append(x)
+    algebra.traverse(n, visitPost=visit)
+    return res
+
+
+def test_aggregates():
+    q = translateQuery(parseQuery('''
+        SELECT ?s (SUM(?o) AS ?sum) (SUM(?o) * 2 AS ?twice)
+        WHERE { ?s <ex:p> ?o } GROUP BY ?s
+        HAVING (SUM(?o) > 3) ORDER BY DESC(SUM(?o)) (COUNT(?o))'''))
+    A = find(q.algebra, 'AggregateJoin')[0].A
+    assert sorted(a.name for a in A) == ['Aggregate_Count',
+                                         'Aggregate_Sample', 'Aggregate_Sum']
+
+
+def test_same_results():
+    queries = [
+        '''SELECT ?s (SUM(?o) AS ?sum) WHERE { ?s <ex:p> ?o } GROUP BY ?s
+           HAVING (SUM(?o) > 3) ORDER BY DESC(SUM(?o))''',
+        '''SELECT ?s (SUM(?o) AS ?sum) (SUM(DISTINCT ?o) AS ?d)
+           WHERE { ?s <ex:p> ?o } GROUP BY ?s''',
+        '''SELECT * WHERE { ?s <ex:p> ?o BIND(?o * 2 AS ?d)
+           FILTER(?o * 2 > 3 && ?o * 2 < 20) }''',
+        '''SELECT * WHERE { ?s <ex:p> ?o
+           FILTER(STR(?o) != "x" && STRLEN(STR(?o)) = 1) }''',
+        '''SELECT ?s (?o + 1 AS ?x) WHERE { ?s <ex:p> ?o }
+           ORDER BY (?o + 1) ?s''',
+        '''SELECT * WHERE { ?s <ex:p> ?o BIND(?o + 1 AS ?x)
+           BIND(?o + 1 AS ?y) }''',
+        '''SELECT * WHERE { ?s <ex:p> ?o
+           FILTER(RAND() < 2 && RAND() >= 0) }''',
+    ]
+
+    def run(q, cse):
+        common = algebra.commonExpressions
+        if not cse:
+            algebra.commonExpressions = lambda n, names: None
+        try:
+            return SPARQLProcessor(g).query(q)['bindings']
+        finally:
+            algebra.commonExpressions = common
+
+    def check(q):
+        assert run(q, True) == run(q, False), q
+
+    for q in queries:
+        yield check, q
+
+
+def test_shared_expressions():
+    q = translateQuery(parseQuery('''
+        SELECT * WHERE { ?s <ex:p> ?o BIND(?o * 2 AS ?d)
+        FILTER(?o * 2 > 3 && STR(?s) != STR(?o) && STR(?s) != "") }'''))
+    f = find(q.algebra, 'Filter')[0]
+    extends = find(f.p, 'Extend')
+    assert set(e.var for e in extends) == set([Variable('__cse_1__'),
+                                               Variable('d')])
+    assert f.expr.expr.expr == Variable('d')
+
+    q = translateQuery(parseQuery('''
+        SELECT * WHERE { ?s <ex:p> ?o FILTER(RAND() < RAND()) }'''))
+    assert not find(q.algebra, 'Extend')
@@ -0,0 +1,123 @@
+"""
+The hand-written parser must give the same parse-trees as the pyparsing
+grammar for all queries and updates of the DAWG test suite, and fail on
+the same ones.
+"""
+
+import os
+
+from pyparsing import ParseResults
+
+from rdflib import BNode, Literal, Variable
+
+from rdflib_sparql import parser, fastparser
+from rdflib_sparql.parserutils import CompValue, Expr
+
+DAWG = os.path.join(os.path.dirname(__file__), 'DAWG')
+
+
+def normalize(tree, bnodes=None):
+    """
+    A comparable version of a parse-tree, blank nodes generated while
+    parsing are numbered in the order they are first seen
+    """
+    if bnodes is None:
+        bnodes = {}
+
+    if isinstance(tree, CompValue):
+        fn = None
+        if isinstance(tree, Expr):
+            fn = tree._evalfn.im_func
+        return (tree.name, fn, [(k, normalize(v, bnodes))
+                                for k, v in tree.iteritems()])
+    if isinstance(tree, (list, ParseResults)):
+        return [normalize(x, bnodes) for x in tree]
+    if isinstance(tree, tuple):
+        return tuple(normalize(x, bnodes) for x in tree)
+    if isinstance(tree, BNode) and not tree.startswith('_:'):
+        return ('bnode', bnodes.setdefault(tree, len(bnodes)))
+    if isinstance(tree, Literal):
+        return (unicode(tree), tree.datatype, tree.language)
+    return (type(tree), tree)
+
+
+def compare(text, parse, fastparse):
+    try:
+        expected = parse(text)
+    except RuntimeError:
+        # pyparsing recurses too deep on very long requests
+        fastparse(text)
+        return
+    except Exception, e:
+        try:
+            fastparse(text)
+        except type(e):
+            return
+        assert False, 'should not parse'
+
+    assert normalize(fastparse(text)) == normalize(expected)
+
+
+def check(f, parse, fastparse):
+    compare(open(f).read(), parse, fastparse)
+
+
+def test_dawg():
+    for d, _, files in os.walk(DAWG):
+        for name in sorted(files):
+            f = os.path.join(d, name)
+            if name.endswith('.rq'):
+                yield check, f, parser.parseQuery, fastparser.parseQuery
+            elif name.endswith('.ru'):
+                yield check, f, parser.parseUpdate, fastparser.parseUpdate
+
+
+def test_whitespace():
+    # these depend on (the lack of) whitespace between tokens
+    for q in ('SELECT * { ?s ?p ?o FILTER(?a<?b&&?c>1) }',
+              'SELECT * { ?s ?p -1, +1, +1.5, - 1 }',
+              'SELECT * { ?s ?p "a"@en, "a" @en }',
+              'SELECT * { ?s ?p "a"^^<x>, "a"^^ <x> }',
+              'SELECT * { ?s :p* ?o ; :p{1,2} ?o ; :p * ?o }',
+              'SELECT * { ?s ?p :o. } # comment'):
+        yield compare, q, parser.parseQuery, fastparser.parseQuery
+
+
+def test_bulk_data():
+    from rdflib import ConjunctiveGraph, Namespace, URIRef
+    from rdflib_sparql.algebra import translateUpdate
+    from rdflib_sparql.update import evalUpdate
+
+    ex = Namespace('http://example.org/')
+    data = ''.join('ex:s%d ex:p "v%d"@en, %d ; a ex:C .\n' % (i, i, i)
+                   for i in range(5000))
+    q = ('PREFIX ex: <http://example.org/> BASE <http://example.org/> '
+         'INSERT DATA { %s GRAPH ex:g { <s> <p> ex:o } } ;'
+         'DELETE DATA { ex:s1 ex:p 1 }' % data)
+
+    g = ConjunctiveGraph()
+    evalUpdate(g, translateUpdate(fastparser.parseUpdate(q)))
+    assert len(g) == 14999 + 1
+    assert (ex.s7, ex.p, Literal('v7', lang='en')) in g
+    assert (ex.s1, ex.p, Literal(1)) not in g
+    assert (ex.s, ex.p, ex.o) in g.get_context(URIRef(ex.g))
+
+
+def test_interned():
+    from rdflib_sparql.algebra import translateQuery
+
+    q = ('PREFIX : <x:> SELECT * { ?s <x:p> "a", 1 ; :q "b"@en, :o . '
+         '?t <x:p> "a", 1 ; :q "b"@en, :o }')
+    for parse in (parser.parseQuery, fastparser.parseQuery):
+        bgp = translateQuery(parse(q)).algebra.p.p.triples
+        assert len(bgp) == 8
+        # the triples of ?t use the same objects as those of ?s
+        s = sorted((t for t in bgp if t[0] == Variable('s')), key=repr)
+        t = sorted((t for t in bgp if t[0] == Variable('t')), key=repr)
+        for x, y in zip(s, t):
+            assert x[1] is y[1] and x[2] is y[2]
+
+    # terms are only shared within one request
+    assert parser.Var.parseString('?s')[0] is not \
+        parser.Var.parseString('?s')[0]
+    assert getattr(parser._state, 'terms', None) is None
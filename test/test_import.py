@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+
+def test_lazy_import():
+    # see test/importtime.py for the timings
+    out = subprocess.check_output([sys.executable, '-c', '''
+import sys
+import rdflib_sparql
+print 'rdflib_sparql.parser' in sys.modules, rdflib_sparql._entryPointsLoaded
+'''], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert out.split() == ['False', 'False']
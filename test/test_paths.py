@@ -0,0 +1,200 @@
+from rdflib import Graph, Namespace, Variable
+
+from rdflib_sparql.paths import evalPath, evalPathMany, AlternativePath
+from rdflib_sparql.processor import SPARQLProcessor
+
+e = Namespace('ex:')
+
+g = Graph()
+g.parse(data='''
+@prefix : <ex:> .
+
+:a :p1 :c ; :p2 :f .
+:c :p2 :e ; :p3 :g .
+:g :p3 :h ; :p2 :j .
+:h :p3 :a ; :p2 :g .
+
+:q :px :q .
+''', format='n3')
+
+
+def test_eval_many():
+
+    paths = [e.p1, e.p3 % '*', e.p3 % '+', e.p2 % '?', e.p1 / e.p2,
+             e.p1 / e.p3 % '*' / e.p2, (e.p2 | e.p3) % '+', ~e.p3 / e.p2,
+             -e.p3, e.p3 % (1, 2), e.p3 % (2, None), (e.p2 | e.p3) % (0, 3)]
+
+    starts = set(g.subjects())
+
+    def check(path, obj):
+        many = set(evalPathMany(g, starts, path, obj))
+        single = set(x for s in starts for x in evalPath(g, (s, path, obj)))
+        assert many == single, (path, many, single)
+
+    for path in paths:
+        yield check, path, None
+        yield check, path, e.a
+
+
+def test_batched_bgp():
+    r = SPARQLProcessor(g).query('''
+        SELECT ?x ?y WHERE { ?x <ex:p1> ?z . ?z <ex:p3>+ ?y }''')
+
+    x, y = Variable('x'), Variable('y')
+    assert set((b[x], b[y]) for b in r['bindings']) == set(
+        [(e.a, e.g), (e.a, e.h), (e.a, e.a)])
+
+
+def test_negated():
+    # !(fwd|^inv) is !fwd UNION ^(!inv)
+    def check(fwd, inv, subj, obj):
+        path = -(AlternativePath(*(fwd + [~x for x in inv])))
+        expected = []
+        if fwd:
+            expected += [(s, o) for s, p, o in g.triples((subj, None, obj))
+                         if p not in fwd]
+        if inv:
+            expected += [(o, s) for s, p, o in g.triples((obj, None, subj))
+                         if p not in inv]
+        assert sorted(evalPath(g, (subj, path, obj))) == sorted(expected)
+
+    for fwd, inv in (([e.p1], []), ([], [e.p2]), ([e.p1, e.p3], [e.p2])):
+        for subj, obj in ((None, None), (e.g, None), (None, e.g)):
+            yield check, fwd, inv, subj, obj
+
+
+def test_negated_inverse_query():
+    def check(path, expected):
+        r = SPARQLProcessor(g).query(
+            'SELECT ?o WHERE { <ex:g> %s ?o }' % path)
+        assert sorted(x[Variable('o')] for x in r['bindings']) == expected
+
+    # forward :p3 to :h, reverse :p3 from :c and :p2 from :h
+    yield check, '!(<ex:p2>|^<ex:p3>)', [e.h, e.h]
+    yield check, '!(<ex:p3>|^<ex:p2>)', [e.c, e.j]
+    yield check, '!^<ex:p2>', [e.c]
+    yield check, '!(^<ex:p2>|^<ex:p3>)', []
+
+
+def test_bounded():
+    def check(mod, expected):
+        r = SPARQLProcessor(g).query(
+            'SELECT ?o WHERE { <ex:c> <ex:p3>%s ?o }' % mod)
+        assert set(x[Variable('o')] for x in r['bindings']) == expected
+
+    yield check, '{1,2}', set([e.g, e.h])
+    yield check, '{2}', set([e.h])
+    yield check, '{2,}', set([e.h, e.a])
+    yield check, '{,1}', set([e.c, e.g])
+
+
+def test_node_index():
+    from rdflib import ConjunctiveGraph, Literal
+    from rdflib_sparql.paths import (
+        nodeIndex, enableNodeIndex, disableNodeIndex)
+
+    for cg in (Graph(), ConjunctiveGraph()):
+        cg += g
+
+        def check():
+            expected = set(n for t in cg for n in (t[0], t[2]))
+            res = set(o for s, o in evalPath(cg, (None, e.p3 % '*', None))
+                      if s == o)
+            assert res == expected, (res, expected)
+
+        # queries do not index or hook the store by themselves
+        check()
+        r = SPARQLProcessor(cg).query(
+            'SELECT (COUNT(*) AS ?c) { ?s ?p ?o }')['bindings']
+        scanned = SPARQLProcessor(cg).query(
+            'SELECT (COUNT(*) AS ?c) { ?s ?p ?o FILTER(true) }')['bindings']
+        assert r == scanned
+        assert nodeIndex(cg) is None
+        assert '_sparql_hook' not in vars(cg.store)
+
+        index = enableNodeIndex(cg)
+        assert index is not None and nodeIndex(cg) is index
+        cg.add((e.x, e.p4, Literal(1)))
+        check()
+        cg.remove((e.q, None, None))
+        check()
+        cg.remove((None, e.p2, None))
+        check()
+
+        disableNodeIndex(cg)
+        assert nodeIndex(cg) is None
+        cg.add((e.y, e.p4, Literal(2)))
+        check()
+
+
+def test_node_index_contexts():
+    from rdflib import ConjunctiveGraph, Literal, URIRef
+    from rdflib_sparql.paths import (
+        nodeIndex, enableNodeIndex, tripleCount, NodeIndex)
+
+    cg = ConjunctiveGraph()
+    g1 = cg.get_context(URIRef('ex:g1'))
+    g2 = cg.get_context(URIRef('ex:g2'))
+    g1 += g
+    g2.add((e.a, e.p1, e.c))
+    for graph in (cg, g1, g2):
+        # counted without an index
+        for p, o in ((None, None), (e.p1, None), (e.p1, e.c)):
+            assert tripleCount(graph, (None, p, o)) == \
+                len(list(graph.triples((None, p, o))))
+        enableNodeIndex(graph)
+
+    def check():
+        for graph in (cg, g1, g2):
+            index = nodeIndex(graph)
+            expected = NodeIndex(graph.triples((None, None, None)))
+            assert index.counts == expected.counts, graph
+            assert index.pairs == expected.pairs, graph
+            assert index.size == expected.size == len(graph), graph
+            for p, o in ((None, None), (e.p1, None), (e.p1, e.c)):
+                assert tripleCount(graph, (None, p, o)) == \
+                    len(list(graph.triples((None, p, o))))
+
+    check()
+    g2.add((e.a, e.p1, e.c))
+    g2.add((e.x, e.p1, e.c))
+    cg.add((e.x, e.p1, e.c))
+    check()
+    cg.addN([(e.y, e.p2, Literal(1), g1), (e.y, e.p2, Literal(1), g2),
+             (e.y, e.p2, Literal(1), g2), (e.a, e.p1, e.c, g1)])
+    check()
+    g1.remove((e.a, e.p1, e.c))
+    check()
+    cg.remove((None, e.p2, None))
+    check()
+    cg.remove_context(g2)
+    check()
+
+
+def test_path_equality():
+    assert e.p1 / e.p2 == e.p1 / e.p2
+    assert hash(~e.p1 % '+') == hash(~e.p1 % '+')
+    assert e.p1 % '*' == e.p1 % (0, None)
+    assert e.p1 / e.p2 != e.p2 / e.p1
+    assert -(e.p1 | ~e.p2) == -(e.p1 | ~e.p2)
+    assert e.p1 % '*' != e.p1
+
+
+def test_path_cache():
+    from rdflib_sparql.paths import enablePathCache, disablePathCache
+
+    cg = Graph()
+    cg += g
+    cache = enablePathCache(cg, size=2)
+    try:
+        path = e.p3 % '+'
+        assert set(cg.objects(e.c, path)) == set([e.g, e.h, e.a])
+        assert len(cache) > 0
+        cg.remove((e.h, e.p3, e.a))
+        assert set(cg.objects(e.c, path)) == set([e.g, e.h])
+
+        for x in (e.a, e.c, e.g, e.h):
+            list(cg.objects(x, path))
+        assert len(cache) == 2
+    finally:
+        disablePathCache(cg)
@@ -0,0 +1,74 @@
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from rdflib import Graph, Namespace
+
+from rdflib_sparql import plans
+from rdflib_sparql.processor import prepareQuery, SPARQLProcessor
+
+ex = Namespace('http://example.org/')
+
+g = Graph()
+g.parse(data='''
+@prefix : <http://example.org/> .
+
+:a :p 1, 2 ; :q :b ; :name "a"@en .
+:b :p 3 ; :q :c ; :name "b" .
+:c :p 4.5 ; :q :a .
+''', format='n3')
+
+QUERIES = [
+    'PREFIX : <http://example.org/> SELECT * { ?s :p ?o FILTER(?o > 1) }',
+    'PREFIX : <http://example.org/> '
+    'SELECT ?s (SUM(?o) AS ?sum) (GROUP_CONCAT(?o) AS ?c) '
+    '{ ?s :p ?o } GROUP BY ?s HAVING (COUNT(*) > 0) ORDER BY DESC(?sum)',
+    'PREFIX : <http://example.org/> '
+    'SELECT * { ?s :q+ ?o OPTIONAL { ?o :name ?n FILTER(lang(?n) = "en") } '
+    'VALUES ?s { :a :b } }',
+    'BASE <http://example.org/> ASK { <a> <q>/<q> <c> }',
+    'PREFIX : <http://example.org/> CONSTRUCT { ?o :r ?s } '
+    'WHERE { ?s :q ?o BIND(STR(?s) AS ?x) }',
+]
+
+
+def results(q):
+    r = SPARQLProcessor(g).query(q)
+    if r['type_'] == 'SELECT':
+        return r['vars_'], [dict(b) for b in r['bindings']]
+    if r['type_'] == 'ASK':
+        return r['askAnswer']
+    return set(r['graph'])
+
+
+def test_pickle():
+    def check(text):
+        q = prepareQuery(text)
+        f = StringIO()
+        plans.dumpQuery(q, f)
+        f.seek(0)
+        assert results(plans.loadQuery(f)) == results(q)
+
+    for text in QUERIES:
+        yield check, text
+
+
+def test_store():
+    d = tempfile.mkdtemp()
+    try:
+        store = plans.PlanStore(d)
+        q = store.prepareQuery(QUERIES[0])
+        assert store.prepareQuery(QUERIES[0]) is q
+        assert store.prepareQuery(QUERIES[0], {'x': ex.x}) is not q
+
+        # a new store does not parse the queries again
+        prepare = plans.prepareQuery
+        plans.prepareQuery = None
+        try:
+            other = plans.PlanStore(d)
+            assert other.preload() == 2
+            assert results(other.prepareQuery(QUERIES[0])) == results(q)
+        finally:
+            plans.prepareQuery = prepare
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,84 @@
+"""
+Queries of a single triple pattern are evaluated directly on the graph,
+they must give the same results as the full evaluation.
+"""
+
+from rdflib import ConjunctiveGraph, URIRef, Literal, Variable
+
+import rdflib_sparql
+from rdflib_sparql.processor import prepareQuery
+from rdflib_sparql.evaluate import evalQuery, evalSimpleQuery
+
+g = ConjunctiveGraph()
+# in the default graph, whether or not it is the union of all graphs
+g.default_context.parse(data='''
+@prefix : <http://example.org/> .
+
+:a :p 1, 2, 3 ; :q :a .
+:b :p 1 ; :q :a .
+:c :q :c .
+''', format='n3')
+
+
+def _noCustomEval(ctx, part):
+    raise NotImplementedError()
+
+
+def rows(res):
+    if res['type_'] == 'ASK':
+        return res['askAnswer']
+    return sorted(sorted(b.iteritems()) for b in res['bindings'])
+
+
+def check(q, initBindings={}):
+    q = prepareQuery(q, initNs={'': 'http://example.org/'})
+    fast = evalSimpleQuery(g, q, initBindings)
+    assert fast is not None
+
+    # any custom eval disables the fast path
+    rdflib_sparql.CUSTOM_EVALS['test'] = _noCustomEval
+    try:
+        full = evalQuery(g, q, initBindings)
+    finally:
+        del rdflib_sparql.CUSTOM_EVALS['test']
+
+    assert rows(fast) == rows(full)
+    if q.algebra.name == 'SelectQuery':
+        assert fast['vars_'] == full['vars_']
+
+
+def test_simple():
+    for q, initBindings in (
+            ('ASK { :a :p 1 }', {}),
+            ('ASK { :a :p 4 }', {}),
+            ('ASK { ?x :q ?x }', {}),
+            ('ASK { :a :p ?o }', {'o': Literal(5)}),
+            ('SELECT * { ?s :p ?o }', {}),
+            ('SELECT ?o { :a :p ?o }', {}),
+            ('SELECT ?s ?o { ?s :p ?o }',
+             {'s': URIRef('http://example.org/b')}),
+            ('SELECT ?x { ?x :q ?x }', {}),
+            ('SELECT DISTINCT ?o { ?s :p ?o }', {}),
+            ('SELECT REDUCED ?s { ?s :p ?o }', {}),
+            ('SELECT ?o { ?s :p ?o } LIMIT 2', {}),
+            ('SELECT DISTINCT ?o { ?s :p ?o } LIMIT 2 OFFSET 1', {}),
+            ('SELECT ?s { ?s :q :a } OFFSET 1', {})):
+        yield check, q, initBindings
+
+
+def test_not_simple():
+    for q in ('SELECT * { ?s :p ?o ; :q ?t }',
+              'SELECT ?o { :a :p ?o } ORDER BY ?o',
+              'SELECT * { ?s :p ?o FILTER(?o > 1) }',
+              'SELECT * { ?s :q+ ?o }',
+              'SELECT * { [] :p ?o }',
+              'CONSTRUCT WHERE { ?s :p ?o }',
+              'SELECT * FROM NAMED :g { ?s :p ?o }'):
+        q = prepareQuery(q, initNs={'': 'http://example.org/'})
+        assert evalSimpleQuery(g, q, {}) is None
+
+
+def test_limit():
+    q = prepareQuery('SELECT ?o { ?s ?p ?o } LIMIT 1')
+    assert len(evalSimpleQuery(g, q, {})['bindings']) == 1
+    assert evalSimpleQuery(g, q, {})['bindings'][0].keys() == [Variable('o')]
@@ -0,0 +1,108 @@
+"""
+Update requests parsed and executed one operation at a time must give
+the same operations, in the same order, as when parsed in one go.
+"""
+
+import os
+from StringIO import StringIO
+
+from pyparsing import ParseException
+
+from rdflib import ConjunctiveGraph, URIRef
+
+from rdflib_sparql import fastparser
+from rdflib_sparql.parser import parseUpdate, parseUpdateStream
+from rdflib_sparql.processor import processUpdateStream
+
+from test_fastparser import DAWG, normalize
+
+
+def check(f, chunkSize):
+    try:
+        expected = fastparser.parseUpdate(open(f).read())
+    except ParseException:
+        try:
+            list(parseUpdateStream(open(f), chunkSize))
+        except ParseException:
+            return
+        assert False, 'should not parse'
+
+    try:
+        trees = list(parseUpdateStream(open(f), chunkSize))
+    except RuntimeError:
+        return  # pyparsing recurses too deep on very long operations
+    assert normalize(sum((list(t.prologue) for t in trees), [])) == \
+        normalize(list(expected.prologue))
+    assert normalize(sum((list(t.request or []) for t in trees), [])) == \
+        normalize(list(expected.request or []))
+
+
+def test_dawg():
+    for d, _, files in os.walk(DAWG):
+        for name in sorted(files):
+            if name.endswith('.ru'):
+                for chunkSize in (7, 65536):
+                    yield check, os.path.join(d, name), chunkSize
+
+
+def test_split():
+    # ; that do not end an operation
+    for q in ('INSERT DATA { <x:a> <x:b> "1;", """2;\n;""" ; <x:c> 1 }',
+              'DELETE WHERE { ?s <x:p> ?o } # ;',
+              'DELETE { ?s ?p ?o } WHERE { ?s ?p ?o ; <x:q> ?x '
+              'FILTER(?o<?x&&?x>0) }',
+              'PREFIX : <x:;> INSERT DATA { :a :b :c }'):
+        trees = list(parseUpdateStream(StringIO(q), 3))
+        assert len(trees) == 1
+        assert normalize(trees[0]) == normalize(parseUpdate(q))
+
+    # a ; in a prefixed name splits in the wrong place, only as many
+    # parts as needed are joined again
+    q = 'PREFIX : <x:> CLEAR GRAPH :a\\;b ; CLEAR ALL ; CLEAR ALL'
+    trees = list(parseUpdateStream(StringIO(q), 3))
+    assert len(trees) == 3
+    assert normalize(sum((list(t.request) for t in trees), [])) == \
+        normalize(list(parseUpdate(q).request))
+
+    for q in ('CLEAR ALL ; ; CLEAR ALL',
+              'CLEAR ALL ; not sparql ; CLEAR ALL ; CLEAR ALL',
+              'CLEAR ALL ; CLEAR GRAPH :a\\'):
+        try:
+            list(parseUpdateStream(StringIO(q)))
+            assert False, 'should not parse'
+        except ParseException:
+            pass
+
+
+def test_execute():
+    ex = 'http://example.org/'
+    q = '''PREFIX : <%s>
+    INSERT DATA { :a :p 1 } ;
+    LOAD SILENT <file:///does/not/exist> ;
+    INSERT { ?s :p 2 } WHERE { ?s :p 1 } ;
+    DELETE WHERE { ?s :p 1 } ;
+    INSERT DATA { :b :p 1 } ;
+    this is not sparql ;
+    INSERT DATA { :c :p 1 }''' % ex
+
+    g = ConjunctiveGraph()
+    try:
+        processUpdateStream(g, StringIO(q))
+        assert False, 'should not parse'
+    except ParseException:
+        pass
+    # all operations before the syntax error were executed, in order
+    assert sorted((s, o.toPython()) for s, p, o in g) == [
+        (URIRef(ex + 'a'), 2), (URIRef(ex + 'b'), 1)]
+
+    g = ConjunctiveGraph()
+    try:
+        processUpdateStream(g, StringIO(
+            'INSERT DATA { <x:a> <x:p> 1 } ; LOAD <file:///does/not/exist> ;'
+            'INSERT DATA { <x:b> <x:p> 1 }'))
+        assert False, 'should fail'
+    except ParseException:
+        raise
+    except Exception:
+        pass
+    assert len(g) == 1
@@ -0,0 +1,55 @@
+"""
+Verify that vectorized numeric filters give the same results as
+evaluating the filter row by row.
+"""
+from nose import SkipTest
+
+from rdflib import Graph, Variable
+
+import rdflib_sparql
+from rdflib_sparql.processor import SPARQLProcessor
+from rdflib_sparql.vectorize import numpy
+
+g = Graph()
+g.parse(data='''
+@prefix : <ex:> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+:a :x 1 ; :y 2 .
+:b :x 2.5 ; :y 0 .
+:c :x "3"^^xsd:double ; :y "3"^^xsd:integer .
+:d :x "a string" ; :y 1 .
+:e :x 0.1 ; :y 0.2 .
+:f :x 100000000000000000001 ; :y 100000000000000000000 .
+:g :y -4 .
+:h :x "1e308"^^xsd:double ; :y "1e308"^^xsd:double .
+''', format='n3')
+
+
+def test_vectorized_filters():
+    if numpy is None:
+        raise SkipTest('NumPy is not installed')
+
+    def run(f, vectorized):
+        old = rdflib_sparql.SPARQL_VECTORIZED_FILTERS
+        try:
+            rdflib_sparql.SPARQL_VECTORIZED_FILTERS = vectorized
+            r = SPARQLProcessor(g).query('''
+                SELECT ?s WHERE { ?s <ex:y> ?y OPTIONAL { ?s <ex:x> ?x }
+                FILTER (%s) }''' % f)
+        finally:
+            rdflib_sparql.SPARQL_VECTORIZED_FILTERS = old
+        return set(b[Variable('s')] for b in r['bindings'])
+
+    def check(f):
+        assert run(f, True) == run(f, False), f
+
+    for f in ['?x < ?y', '?x > ?y', '?x = ?y', '?x != ?y', '?x <= ?y',
+              '?x + ?y > 3', '?y / ?x > 1', '?x / ?y > 1', '?x * 2 >= ?y',
+              '-?x < -1', '!(?x < ?y)', '?x < ?y || ?y < 1',
+              '?x > 0 && ?y > 0', '!(?x > 0 && ?y > 0)',
+              '?x + ?x > ?y + ?y', '0.1 + 0.2 = 0.3', '?x + 0.2 = 0.3',
+              '?y - 1 < ?x && ?y + 1 > ?x', '?x - ?y > 0.5',
+              '?x - ?y < 0.5', '(?x - ?y) * 10 > 5', '1 / (?x - ?y) < 2',
+              '?x * ?x - ?y * ?y > 1']:
+        yield check, f